@@ -0,0 +1,135 @@
+"""
+Async versions of the S3 views, routed instead of the sync ones when the
+app runs under ASGI (USE_ASGI). S3 I/O goes through aiobotocore, so one
+uvicorn worker can hold hundreds of slow image downloads open at once.
+"""
+from asgiref.sync import sync_to_async
+from botocore.exceptions import ClientError
+from django.conf import settings
+from django.http import Http404, HttpResponseNotAllowed, HttpResponseRedirect, JsonResponse
+from django.utils.cache import patch_vary_headers
+from PIL import UnidentifiedImageError
+
+from s3_client import get_async_s3_client, get_s3_client, s3_key
+from .delivery import presigned_delivery_enabled, presigned_image_url
+from .derivatives import DECODE_ERRORS
+from .bucket_inventory import bucket_stats, format_page, parse_page_params
+from .image_cache import get_image_cache
+from .image_proxy import aproxy_s3_object
+from .transforms import (
+    TransformBusy, TransformError, parse_transform, render_variant, wants_transform
+)
+
+
+async def serve_s3_image_async(request, image_path):
+    """
+    Proxy endpoint to serve images from S3 without blocking the event loop
+
+    Behaves like api.views.serve_s3_image: conditional GET, byte ranges,
+    the disk cache, presigned redirects and on-demand transformations.
+    """
+    if request.method not in ('GET', 'HEAD'):
+        return HttpResponseNotAllowed(['GET', 'HEAD'])
+
+    if wants_transform(request):
+        return await _serve_transformed_async(request, image_path)
+
+    if presigned_delivery_enabled():
+        return HttpResponseRedirect(await sync_to_async(presigned_image_url)(image_path))
+
+    try:
+        s3_client = await get_async_s3_client()
+        return await aproxy_s3_object(
+            request,
+            s3_client,
+            settings.AWS_STORAGE_BUCKET_NAME,
+            s3_key(image_path),
+            cache=get_image_cache()
+        )
+    except ClientError as e:
+        if e.response['Error']['Code'] in ('NoSuchKey', '404'):
+            raise Http404("Image not found")
+        raise Http404("Error retrieving image")
+    except Exception:
+        raise Http404("Error retrieving image")
+
+
+async def _serve_transformed_async(request, image_path):
+    """
+    Serve a transformed variant; cached variants stream asynchronously and
+    missing ones are rendered in a worker thread, since Pillow is CPU-bound
+    """
+    key = s3_key(image_path)
+    try:
+        transform = parse_transform(request, key)
+    except TransformError as e:
+        return JsonResponse({'error': str(e)}, status=400)
+
+    bucket = settings.AWS_STORAGE_BUCKET_NAME
+    try:
+        try:
+            response = await aproxy_s3_object(
+                request,
+                await get_async_s3_client(),
+                bucket,
+                transform.variant_key(key),
+                cache=get_image_cache()
+            )
+        except ClientError as e:
+            if e.response['Error']['Code'] not in ('NoSuchKey', '404'):
+                raise
+            response = await sync_to_async(render_variant, thread_sensitive=False)(
+                get_s3_client(), bucket, key, transform
+            )
+    except TransformBusy:
+        response = JsonResponse({'error': 'Too many image transformations in progress'}, status=503)
+        response['Retry-After'] = '1'
+        return response
+    except TransformError as e:
+        return JsonResponse({'error': str(e)}, status=400)
+    except UnidentifiedImageError:
+        return JsonResponse({'error': 'File is not a supported image'}, status=400)
+    except DECODE_ERRORS:
+        # Truncated/corrupt originals, or too many pixels for Pillow
+        return JsonResponse({'error': 'Image could not be decoded'}, status=422)
+    except ClientError as e:
+        if e.response['Error']['Code'] in ('NoSuchKey', '404'):
+            raise Http404("Image not found")
+        raise Http404("Error retrieving image")
+
+    if transform.negotiated:
+        patch_vary_headers(response, ('Accept',))
+    return response
+
+
+async def debug_s3_bucket_async(request):
+    """
+    Debug endpoint to list the objects in the S3 bucket, one page at a time
+
+    Same parameters and payload as api.views.debug_s3_bucket.
+    """
+    if request.method != 'GET':
+        return HttpResponseNotAllowed(['GET'])
+
+    try:
+        params = parse_page_params(request.GET)
+    except ValueError as e:
+        return JsonResponse({'error': str(e)}, status=400)
+
+    try:
+        s3_client = await get_async_s3_client()
+
+        # List one page of the objects under the prefix
+        response = await s3_client.list_objects_v2(**params)
+
+        return JsonResponse({
+            **format_page(params, response),
+            'stats': await sync_to_async(bucket_stats)(params['Prefix'])
+        })
+
+    except Exception as e:
+        return JsonResponse({
+            'error': str(e),
+            'bucket': getattr(settings, 'AWS_STORAGE_BUCKET_NAME', None),
+            'endpoint': getattr(settings, 'AWS_S3_ENDPOINT_URL', None)
+        }, status=500)
@@ -0,0 +1,64 @@
+"""
+Multi-file image uploads: files are written to storage (and get their
+derivatives) concurrently, then all rows are inserted with one bulk_create
+"""
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.db import connections, transaction
+
+from .caching import invalidate_after_bulk_write
+from .derivatives import generate_derivatives
+from .models import Image
+from .upload_handlers import StreamedS3File
+
+
+def _store(image, upload):
+    """
+    Save one upload and its derivatives; runs in a worker thread. The
+    storage backend indexes every saved file (api_s3object), so the
+    thread's database connections are closed when it is done: nothing else
+    would, and pooled ones would keep their pool slot.
+    """
+    try:
+        image.image.save(upload.name, upload, save=False)
+        # A streamed upload too large to keep locally is read back from storage
+        image.derivatives = generate_derivatives(
+            image.image, None if isinstance(upload, StreamedS3File) and not upload.whole else upload
+        )
+        return image
+    finally:
+        connections.close_all()
+
+
+def _delete_stored(image):
+    if not image.image.name:
+        return
+    storage = image.image.storage
+    for name in image.stored_names():
+        try:
+            storage.delete(name)
+        except Exception:
+            pass
+
+
+def create_images(uploads, titles):
+    """
+    Store ``uploads`` through a pool of IMAGE_BATCH_WORKERS threads and
+    create their Image rows in one INSERT. If any file fails, the files
+    already stored are deleted again and the error is re-raised.
+    """
+    images = [Image(title=title) for title in titles]
+    workers = max(1, min(settings.IMAGE_BATCH_WORKERS, len(uploads)))
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(_store, image, upload) for image, upload in zip(images, uploads)]
+    errors = [future.exception() for future in futures if future.exception()]
+    if errors:
+        for image in images:
+            _delete_stored(image)
+        raise errors[0]
+
+    with transaction.atomic():
+        images = Image.objects.bulk_create(images)
+    invalidate_after_bulk_write(Image)
+    return images
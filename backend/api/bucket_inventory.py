@@ -0,0 +1,281 @@
+"""
+Bucket inventory for the debug endpoint: one page of a prefix listing per
+request, plus aggregate stats for the bucket and its top-level prefixes,
+computed by a single background paginated scan and cached for
+S3_INVENTORY_STATS_TTL seconds
+"""
+import hashlib
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.cache import cache
+
+from s3_client import get_s3_client
+
+# Upper bounds (exclusive) of the size histogram buckets, in bytes
+HISTOGRAM_BOUNDS = [
+    ('<10KB', 10 * 1024),
+    ('<100KB', 100 * 1024),
+    ('<1MB', 1024 * 1024),
+    ('<10MB', 10 * 1024 * 1024),
+    ('<100MB', 100 * 1024 * 1024),
+    ('>=100MB', None),
+]
+DEFAULT_PAGE_SIZE = 100
+# ListObjectsV2 never returns more than 1,000 keys per call
+MAX_PAGE_SIZE = 1000
+
+# Key-range boundaries used to split each top-level prefix into parallel scans
+SHARD_BOUNDARIES = '0123456789abcdefghijklmnopqrstuvwxyz'
+
+# Whether this process is scanning the bucket for stats
+_scanning = False
+_scan_lock = threading.Lock()
+
+
+def parse_page_params(query):
+    """
+    ``prefix``, ``continuation_token`` and ``page_size`` from the query
+    string as ListObjectsV2 parameters; raises ValueError if invalid
+    """
+    params = {
+        'Bucket': getattr(settings, 'AWS_STORAGE_BUCKET_NAME', None),
+        'Prefix': query.get('prefix', ''),
+    }
+    try:
+        page_size = int(query.get('page_size', DEFAULT_PAGE_SIZE))
+    except ValueError:
+        raise ValueError("'page_size' must be an integer")
+    if not 1 <= page_size <= MAX_PAGE_SIZE:
+        raise ValueError(f"'page_size' must be between 1 and {MAX_PAGE_SIZE}")
+    params['MaxKeys'] = page_size
+    if query.get('continuation_token'):
+        params['ContinuationToken'] = query['continuation_token']
+    return params
+
+
+def format_page(params, response):
+    """The endpoint payload for one ListObjectsV2 response"""
+    objects = [
+        {
+            'key': obj['Key'],
+            'size': obj['Size'],
+            'last_modified': obj['LastModified'].isoformat()
+        }
+        for obj in response.get('Contents', [])
+    ]
+    return {
+        'bucket': settings.AWS_STORAGE_BUCKET_NAME,
+        'endpoint': getattr(settings, 'AWS_S3_ENDPOINT_URL', None),
+        'prefix': params['Prefix'],
+        'page_size': params['MaxKeys'],
+        'object_count': len(objects),
+        'objects': objects,
+        'is_truncated': response.get('IsTruncated', False),
+        'next_continuation_token': response.get('NextContinuationToken'),
+    }
+
+
+def _stats_key():
+    digest = hashlib.sha256(settings.AWS_STORAGE_BUCKET_NAME.encode('utf-8')).hexdigest()
+    return f'bucket-stats:{digest}'
+
+
+def _top_level_prefix(key):
+    """'images/' for 'images/a/b.jpg'; '' for objects at the bucket root"""
+    head, sep, _ = key.partition('/')
+    return head + sep if sep else ''
+
+
+def is_top_level_prefix(prefix):
+    """Whether stats are kept for ``prefix``: the bucket root or one 'name/' segment"""
+    return prefix == '' or (prefix.endswith('/') and prefix.count('/') == 1)
+
+
+def _empty_totals():
+    return {
+        'object_count': 0,
+        'total_bytes': 0,
+        'size_histogram': {label: 0 for label, _ in HISTOGRAM_BOUNDS},
+    }
+
+
+def _add_object(totals, size):
+    totals['object_count'] += 1
+    totals['total_bytes'] += size
+    for label, bound in HISTOGRAM_BOUNDS:
+        if bound is None or size < bound:
+            totals['size_histogram'][label] += 1
+            break
+
+
+def scan_bucket():
+    """
+    Paginate over every object in the bucket and aggregate count, bytes and
+    sizes, for the whole bucket and for each top-level prefix
+    """
+    started = time.time()
+    totals = _empty_totals()
+    prefixes = {}
+    paginator = get_s3_client().get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=settings.AWS_STORAGE_BUCKET_NAME):
+        for obj in page.get('Contents', []):
+            _add_object(totals, obj['Size'])
+            prefix = _top_level_prefix(obj['Key'])
+            if prefix:
+                if prefix not in prefixes:
+                    prefixes[prefix] = _empty_totals()
+                _add_object(prefixes[prefix], obj['Size'])
+    return {
+        **totals,
+        'prefixes': prefixes,
+        'computed_at': started,
+        'scan_seconds': round(time.time() - started, 3),
+    }
+
+
+def _run_scan():
+    global _scanning
+    key = _stats_key()
+    try:
+        # Keep the result past the TTL so a stale value can be served while refreshing
+        cache.set(key, scan_bucket(), settings.S3_INVENTORY_STATS_TTL * 10)
+    finally:
+        cache.delete(f'{key}:scanning')
+        with _scan_lock:
+            _scanning = False
+
+
+def _start_scan():
+    """Start a background scan of the bucket unless one is already running"""
+    global _scanning
+    with _scan_lock:
+        if _scanning:
+            return
+        # The cache entry stops other workers from scanning the bucket too
+        if not cache.add(f'{_stats_key()}:scanning', True, settings.S3_INVENTORY_STATS_SCAN_TIMEOUT):
+            return
+        _scanning = True
+    threading.Thread(target=_run_scan, daemon=True).start()
+
+
+def bucket_stats(prefix):
+    """
+    Cached aggregate stats for the bucket root or a top-level ``prefix``;
+    other prefixes are ``unavailable``. Never scans in the request: a
+    missing or stale value starts a background scan of the whole bucket (at
+    most one per process, whatever the prefix), and the response says
+    whether the stats are ``ready``, ``stale`` (being refreshed) or
+    ``pending`` (first scan still running).
+    """
+    if not is_top_level_prefix(prefix):
+        return {'status': 'unavailable', 'detail': 'Stats are only kept for the bucket root and top-level prefixes'}
+    stats = cache.get(_stats_key())
+    if stats is None:
+        _start_scan()
+        return {'status': 'pending'}
+    totals = stats['prefixes'].get(prefix, _empty_totals()) if prefix else stats
+    result = {
+        'object_count': totals['object_count'],
+        'total_bytes': totals['total_bytes'],
+        'size_histogram': totals['size_histogram'],
+        'computed_at': stats['computed_at'],
+        'scan_seconds': stats['scan_seconds'],
+    }
+    age = time.time() - stats['computed_at']
+    if age > settings.S3_INVENTORY_STATS_TTL:
+        _start_scan()
+        return {**result, 'status': 'stale', 'age_seconds': round(age)}
+    return {**result, 'status': 'ready', 'age_seconds': round(age)}
+
+
+def _iter_range(s3_client, bucket, prefix, start_after, upper):
+    """
+    Pages of objects under ``prefix`` with keys in (start_after, upper];
+    open ends are None
+    """
+    params = {'Bucket': bucket, 'Prefix': prefix}
+    if start_after:
+        params['StartAfter'] = start_after
+    for page in s3_client.get_paginator('list_objects_v2').paginate(**params):
+        objects = page.get('Contents', [])
+        if upper is not None and objects and objects[-1]['Key'] > upper:
+            yield [obj for obj in objects if obj['Key'] <= upper]
+            return
+        yield objects
+
+
+def iter_bucket(root='', workers=16):
+    """
+    Iterate over every object under ``root`` except cached transformation
+    variants, without holding the listing in memory.
+
+    The top level is listed with a delimiter; each sub-prefix is then split
+    into key ranges at SHARD_BOUNDARIES that are scanned concurrently. The
+    ranges are contiguous, so every key is seen exactly once (in no
+    particular order). The scanning threads hand over their pages through a
+    bounded queue, so at most about ``2 * workers`` pages are buffered.
+    Yields the ListObjectsV2 entries (Key, Size, ETag, LastModified).
+    """
+    s3_client = get_s3_client()
+    bucket = settings.AWS_STORAGE_BUCKET_NAME
+    prefixes = []
+    for page in s3_client.get_paginator('list_objects_v2').paginate(Bucket=bucket, Prefix=root, Delimiter='/'):
+        yield from page.get('Contents', [])
+        prefixes.extend(p['Prefix'] for p in page.get('CommonPrefixes', []))
+    # Cached transformation variants are regenerated on demand
+    prefixes = [p for p in prefixes if not p.startswith(settings.IMAGE_TRANSFORM_PREFIX)]
+
+    ranges = []
+    for prefix in prefixes:
+        bounds = [None] + [prefix + c for c in SHARD_BOUNDARIES] + [None]
+        ranges.extend((prefix, bounds[i], bounds[i + 1]) for i in range(len(bounds) - 1))
+
+    pages = queue.Queue(maxsize=2 * workers)
+    stop = threading.Event()
+    done = object()
+
+    def put(item):
+        # Give up if the consumer stopped iterating
+        while not stop.is_set():
+            try:
+                pages.put(item, timeout=1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def scan(scan_range):
+        for page in _iter_range(s3_client, bucket, *scan_range):
+            if not put(page):
+                return
+
+    def produce():
+        try:
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                for future in [pool.submit(scan, r) for r in ranges]:
+                    future.result()
+        except Exception as exc:
+            put(exc)
+        finally:
+            put(done)
+
+    threading.Thread(target=produce, daemon=True).start()
+    try:
+        while True:
+            page = pages.get()
+            if page is done:
+                return
+            if isinstance(page, Exception):
+                raise page
+            yield from page
+    finally:
+        stop.set()
+
+
+def list_bucket(root='', workers=16):
+    """The objects of iter_bucket() as a list"""
+    return list(iter_bucket(root, workers))
@@ -0,0 +1,145 @@
+"""
+Versioned response cache for the list/detail endpoints.
+
+Every model has a version number stored in the cache and part of each
+response cache key; saving or deleting a row bumps it (see signals.py), so
+all cached pages of that model are invalidated at once without scanning keys.
+"""
+import hashlib
+
+from django.conf import settings
+from django.core.cache import cache
+from rest_framework.response import Response
+
+from .db_routing import replica_used, replicas_enabled
+from .delivery import presigned_delivery_enabled
+from .metrics import record_cache
+
+STATS_KEYS = {'hits': 'api-cache-stats:hits', 'misses': 'api-cache-stats:misses'}
+
+
+def cache_is_shared():
+    """Whether the default cache is visible to every worker process"""
+    backend = settings.CACHES['default']['BACKEND']
+    return not backend.endswith(('.LocMemCache', '.DummyCache'))
+
+
+def _version_key(model):
+    return 'api-cache-version:%s' % model._meta.label_lower
+
+
+def _written_key(model):
+    return 'api-cache-written:%s' % model._meta.label_lower
+
+
+def model_version(model):
+    """Current cache version of ``model``"""
+    key = _version_key(model)
+    cache.add(key, 1, timeout=None)
+    return cache.get(key, 1)
+
+
+def bump_model_version(model):
+    """Invalidate every cached response for ``model``"""
+    key = _version_key(model)
+    cache.add(key, 1, timeout=None)
+    try:
+        cache.incr(key)
+    except ValueError:
+        # The key was evicted between add() and incr()
+        cache.set(key, 1, timeout=None)
+    if replicas_enabled():
+        # Replicas may not have this write yet (see _may_be_stale)
+        cache.set(_written_key(model), True,
+                  settings.DB_REPLICA_MAX_LAG + settings.DB_REPLICA_CHECK_INTERVAL)
+
+
+def invalidate_after_bulk_write(model):
+    """
+    Invalidate the cached responses for ``model`` after bulk_create() or
+    bulk_update(), which send no post_save signals (see signals.py)
+    """
+    bump_model_version(model)
+
+
+def _may_be_stale(model):
+    """
+    Whether this request read ``model`` from a replica that may not have
+    its latest write yet. Such a response must not be cached under the new
+    version, or it would be served long after the replica caught up.
+    """
+    return replica_used() and cache.get(_written_key(model)) is not None
+
+
+def _count(stat):
+    record_cache('response', stat == 'hits')
+    key = STATS_KEYS[stat]
+    cache.add(key, 0, timeout=None)
+    try:
+        cache.incr(key)
+    except ValueError:
+        pass
+
+
+def cache_stats():
+    """Hit/miss counters of the response cache"""
+    hits = cache.get(STATS_KEYS['hits'], 0)
+    misses = cache.get(STATS_KEYS['misses'], 0)
+    total = hits + misses
+    return {
+        'hits': hits,
+        'misses': misses,
+        'hit_ratio': round(hits / total, 4) if total else None,
+    }
+
+
+def response_timeout():
+    """
+    How long a response may be cached. Presigned image URLs in a cached
+    payload must not outlive their signature, so in presigned delivery mode
+    the timeout is capped by the margin presigned URLs are refreshed at.
+    """
+    timeout = settings.API_CACHE_TIMEOUT
+    if presigned_delivery_enabled():
+        timeout = min(timeout, settings.S3_PRESIGNED_URL_REFRESH_MARGIN)
+    return timeout
+
+
+def response_cache_key(model, request):
+    """Cache key for ``request`` (absolute URI, so host and cursor are included)"""
+    uri = hashlib.sha256(request.build_absolute_uri().encode('utf-8')).hexdigest()
+    return 'api-response:%s:v%s:%s' % (model._meta.label_lower, model_version(model), uri)
+
+
+class CachedResponseMixin:
+    """
+    Serve ``list`` and ``retrieve`` from the response cache.
+
+    The serialized payload (not the rendered bytes) is cached, so content
+    negotiation still applies. Responses carry an ``X-Cache: HIT|MISS`` header.
+    """
+
+    def list(self, request, *args, **kwargs):
+        return self._cached_response(request, super().list, *args, **kwargs)
+
+    def retrieve(self, request, *args, **kwargs):
+        return self._cached_response(request, super().retrieve, *args, **kwargs)
+
+    def _cached_response(self, request, view, *args, **kwargs):
+        if not settings.API_CACHE_ENABLED:
+            return view(request, *args, **kwargs)
+
+        key = response_cache_key(self.queryset.model, request)
+        data = cache.get(key)
+        if data is not None:
+            _count('hits')
+            response = Response(data)
+            response['X-Cache'] = 'HIT'
+            return response
+
+        _count('misses')
+        response = view(request, *args, **kwargs)
+        if response.status_code == 200 and not _may_be_stale(self.queryset.model):
+            cache.set(key, response.data, response_timeout())
+        response['X-Cache'] = 'MISS'
+        return response
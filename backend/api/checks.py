@@ -0,0 +1,57 @@
+"""
+System checks for settings that work together but defeat their purpose.
+They run with every management command, including the migrate at startup.
+"""
+from django.conf import settings
+from django.core.checks import Error, Warning, register
+
+from .caching import cache_is_shared, response_timeout
+from .delivery import presigned_delivery_enabled, url_reuse_window
+
+
+@register()
+def check_response_cache(app_configs, **kwargs):
+    if settings.API_CACHE_ENABLED and not cache_is_shared():
+        return [Warning(
+            "API_CACHE_ENABLED is set with a per-process cache backend.",
+            hint=(
+                "A write only invalidates the cache of the worker that handled it, so "
+                "the other workers serve stale pages for up to API_CACHE_TIMEOUT seconds. "
+                "Use CACHE_BACKEND=file or redis, or unset API_CACHE_ENABLED."
+            ),
+            id='api.W001',
+        )]
+    return []
+
+
+@register()
+def check_metrics_token(app_configs, **kwargs):
+    if settings.METRICS_ENABLED and not settings.METRICS_TOKEN:
+        return [Warning(
+            "METRICS_ENABLED is set without a METRICS_TOKEN.",
+            hint=(
+                "/api/metrics/ is not served without a token, so metrics are collected "
+                "but cannot be scraped. Set METRICS_TOKEN, or unset METRICS_ENABLED."
+            ),
+            id='api.W002',
+        )]
+    return []
+
+
+@register()
+def check_presigned_url_ttl(app_configs, **kwargs):
+    if presigned_delivery_enabled() and url_reuse_window() < 1:
+        return [Error(
+            "S3_PRESIGNED_URL_TTL leaves no time to reuse presigned URLs.",
+            hint=(
+                "URLs are refreshed S3_PRESIGNED_URL_REFRESH_MARGIN (%ss) before they expire "
+                "and may be served from the response cache for another %ss, which uses up "
+                "S3_PRESIGNED_URL_TTL (%ss), so every request would sign new URLs. Raise "
+                "S3_PRESIGNED_URL_TTL or lower the margin."
+                % (settings.S3_PRESIGNED_URL_REFRESH_MARGIN,
+                   response_timeout() if settings.API_CACHE_ENABLED else 0,
+                   settings.S3_PRESIGNED_URL_TTL)
+            ),
+            id='api.E001',
+        )]
+    return []
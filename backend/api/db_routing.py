@@ -0,0 +1,205 @@
+"""
+Read-replica routing.
+
+replica_routing_middleware lets GET/HEAD/OPTIONS requests read from the
+replicas in DATABASE_REPLICAS; ReplicaRouter sends those reads to a healthy
+replica and everything else to ``default``. A client that just wrote is
+pinned to the primary for DB_REPLICA_STICKY_SECONDS so it reads its own
+writes, and replicas that are down or lag more than DB_REPLICA_MAX_LAG
+seconds are skipped until a later check finds them healthy again. A
+replica that goes down between checks is dropped as soon as connecting to
+it fails, and the read goes to the primary.
+"""
+import contextvars
+import hashlib
+import logging
+import random
+import threading
+import time
+
+from asgiref.sync import iscoroutinefunction
+from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import DEFAULT_DB_ALIAS, DatabaseError, connections
+from django.utils.decorators import sync_and_async_middleware
+
+logger = logging.getLogger(__name__)
+
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+# Seconds the replica applies WAL behind the primary (0 when fully caught up)
+LAG_SQL = (
+    'SELECT CASE WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0'
+    ' ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()) END'
+)
+
+# Whether the current request may read from a replica, and whether it did
+_replica_reads = contextvars.ContextVar('replica_reads', default=False)
+_replica_used = contextvars.ContextVar('replica_used', default=False)
+
+_health_lock = threading.Lock()
+_healthy = []
+_checked_at = None
+
+
+def replicas_enabled():
+    return bool(getattr(settings, 'DATABASE_REPLICAS', None))
+
+
+def replica_used():
+    """Whether the current request has read from a replica"""
+    return _replica_used.get()
+
+
+def replica_lag(alias):
+    """Replication lag of ``alias`` in seconds; raises if it is unreachable"""
+    with connections[alias].cursor() as cursor:
+        cursor.execute(LAG_SQL)
+        lag = cursor.fetchone()[0]
+    return float(lag or 0)
+
+
+def _check_replicas():
+    healthy = []
+    for alias in settings.DATABASE_REPLICAS:
+        try:
+            lag = replica_lag(alias)
+        except Exception:
+            logger.warning("Replica %s is unreachable, reading from the primary", alias, exc_info=True)
+            connections[alias].close()
+            continue
+        if lag > settings.DB_REPLICA_MAX_LAG:
+            logger.warning("Replica %s lags %.1fs behind, reading from the primary", alias, lag)
+            continue
+        healthy.append(alias)
+    return healthy
+
+
+def healthy_replicas():
+    """
+    Replicas currently fit for reads. Re-checked at most every
+    DB_REPLICA_CHECK_INTERVAL seconds per process, by one thread at a time
+    (the others keep using the previous result).
+    """
+    global _healthy, _checked_at
+    now = time.monotonic()
+    if _checked_at is not None and now - _checked_at < settings.DB_REPLICA_CHECK_INTERVAL:
+        return _healthy
+    if not _health_lock.acquire(blocking=_checked_at is None):
+        return _healthy
+    try:
+        if _checked_at is None or now - _checked_at >= settings.DB_REPLICA_CHECK_INTERVAL:
+            _healthy = _check_replicas()
+            _checked_at = time.monotonic()
+    finally:
+        _health_lock.release()
+    return _healthy
+
+
+def _mark_unhealthy(alias):
+    """Stop reading from ``alias`` until the next health check"""
+    global _healthy
+    with _health_lock:
+        _healthy = [replica for replica in _healthy if replica != alias]
+
+
+def _usable(alias):
+    """
+    Connect to ``alias`` (or health-check its persistent connection, once
+    per request) before reads are sent to it; False if it is unreachable
+    """
+    connection = connections[alias]
+    try:
+        connection.close_if_health_check_failed()
+        connection.ensure_connection()
+    except DatabaseError:
+        logger.warning("Replica %s is unreachable, reading from the primary", alias, exc_info=True)
+        connection.close()
+        _mark_unhealthy(alias)
+        return False
+    return True
+
+
+def _sticky_key(request):
+    """Cache key identifying the client (shared by workers with a shared cache)"""
+    forwarded = request.META.get('HTTP_X_FORWARDED_FOR', '')
+    client = forwarded.split(',')[0].strip() or request.META.get('REMOTE_ADDR', '')
+    agent = request.META.get('HTTP_USER_AGENT', '')
+    digest = hashlib.sha256(f'{client}|{agent}'.encode('utf-8')).hexdigest()
+    return f'db-sticky:{digest}'
+
+
+@sync_and_async_middleware
+def replica_routing_middleware(get_response):
+    """
+    Allow replica reads for safe requests of clients that haven't just
+    written (async-capable for ASGI). Not used without replicas.
+    """
+    if not replicas_enabled():
+        raise MiddlewareNotUsed
+    from .caching import cache_is_shared
+    if not cache_is_shared():
+        logger.warning(
+            "Read replicas are enabled but the %s cache is per process: a client "
+            "whose next request reaches another worker may not read its own writes. "
+            "Use CACHE_BACKEND=file or redis.",
+            settings.CACHES['default']['BACKEND'].rpartition('.')[2],
+        )
+
+    if iscoroutinefunction(get_response):
+        async def middleware(request):
+            key = _sticky_key(request)
+            safe = request.method in SAFE_METHODS
+            reads = _replica_reads.set(safe and not await cache.aget(key))
+            used = _replica_used.set(False)
+            try:
+                response = await get_response(request)
+            finally:
+                _replica_reads.reset(reads)
+                _replica_used.reset(used)
+            if not safe:
+                # Read-your-writes: this client reads from the primary for a while
+                await cache.aset(key, True, settings.DB_REPLICA_STICKY_SECONDS)
+            return response
+    else:
+        def middleware(request):
+            key = _sticky_key(request)
+            safe = request.method in SAFE_METHODS
+            reads = _replica_reads.set(safe and not cache.get(key))
+            used = _replica_used.set(False)
+            try:
+                response = get_response(request)
+            finally:
+                _replica_reads.reset(reads)
+                _replica_used.reset(used)
+            if not safe:
+                # Read-your-writes: this client reads from the primary for a while
+                cache.set(key, True, settings.DB_REPLICA_STICKY_SECONDS)
+            return response
+    return middleware
+
+
+class ReplicaRouter:
+    """Send reads allowed by replica_routing_middleware to a healthy replica"""
+
+    def db_for_read(self, model, **hints):
+        if not _replica_reads.get():
+            return DEFAULT_DB_ALIAS
+        replicas = list(healthy_replicas())
+        random.shuffle(replicas)
+        for alias in replicas:
+            if _usable(alias):
+                _replica_used.set(True)
+                return alias
+        return DEFAULT_DB_ALIAS
+
+    def db_for_write(self, model, **hints):
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Replicas hold the same data as the primary
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return db == DEFAULT_DB_ALIAS
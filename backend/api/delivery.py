@@ -0,0 +1,66 @@
+"""
+Presigned-URL image delivery: hand browsers short-lived S3 GET URLs so
+image bytes never pass through Django
+"""
+import hashlib
+
+from django.conf import settings
+from django.core.cache import cache
+
+from s3_client import get_presign_client, s3_key
+from .metrics import record_cache
+
+PRESIGNED_DELIVERY = 'presigned'
+
+
+def presigned_delivery_enabled():
+    """Whether images should be delivered through presigned S3 URLs"""
+    return (
+        getattr(settings, 'S3_IMAGE_DELIVERY', 'proxy') == PRESIGNED_DELIVERY
+        and getattr(settings, 'AWS_STORAGE_BUCKET_NAME', None) is not None
+    )
+
+
+def url_reuse_window():
+    """
+    How long a presigned URL may be reused, in seconds (zero or less when
+    the settings leave no room). A URL can also be served from a cached API
+    response for up to caching.response_timeout() after it was taken from
+    this cache, so that is subtracted along with the margin.
+    """
+    from .caching import response_timeout
+    ttl = settings.S3_PRESIGNED_URL_TTL
+    served_for = response_timeout() if settings.API_CACHE_ENABLED else 0
+    return ttl - settings.S3_PRESIGNED_URL_REFRESH_MARGIN - served_for
+
+
+def url_cache_timeout():
+    """
+    How long a presigned URL is cached: url_reuse_window(), but at least a
+    second (the api.E001 check reports settings that need the floor)
+    """
+    return max(url_reuse_window(), 1)
+
+
+def presigned_image_url(name):
+    """
+    Return a presigned GET URL for the stored file ``name``.
+
+    URLs are cached per key (see url_cache_timeout), so list endpoints reuse
+    one signature per image instead of re-signing on every request, and
+    every URL handed out, directly or in a cached response, is still valid
+    for at least S3_PRESIGNED_URL_REFRESH_MARGIN seconds.
+    """
+    key = s3_key(name)
+    cache_key = 'presigned-url:' + hashlib.sha256(key.encode('utf-8')).hexdigest()
+    url = cache.get(cache_key)
+    record_cache('presigned_url', url is not None)
+    if url is None:
+        ttl = settings.S3_PRESIGNED_URL_TTL
+        url = get_presign_client().generate_presigned_url(
+            'get_object',
+            Params={'Bucket': settings.AWS_STORAGE_BUCKET_NAME, 'Key': key},
+            ExpiresIn=ttl,
+        )
+        cache.set(cache_key, url, url_cache_timeout())
+    return url
@@ -0,0 +1,95 @@
+"""
+Responsive image derivatives (downscaled copies) generated at upload time
+"""
+import os
+from io import BytesIO
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from PIL import Image as PILImage, ImageOps
+
+# Pillow formats we can re-encode, mapped to their save() options
+SAVE_OPTIONS = {
+    'JPEG': {'quality': 85, 'optimize': True, 'progressive': True},
+    'PNG': {'optimize': True},
+    'WEBP': {'quality': 80, 'method': 4},
+    'AVIF': {'quality': 60},
+    'GIF': {},
+}
+
+# What Pillow raises for files it cannot decode (not an image, corrupt,
+# truncated or over the decompression bomb limit)
+DECODE_ERRORS = (OSError, SyntaxError, ValueError, PILImage.DecompressionBombError)
+
+
+def derivative_name(name, width):
+    """Name of the ``width``-pixel derivative stored next to the original ``name``"""
+    root, ext = os.path.splitext(name)
+    return f'{root}_{width}w{ext}'
+
+
+def encode_image(img, image_format):
+    """Encode a Pillow image, converting modes the target format cannot hold"""
+    if image_format == 'JPEG' and img.mode not in ('RGB', 'L'):
+        img = img.convert('RGB')
+    elif image_format in ('WEBP', 'AVIF') and img.mode not in ('RGB', 'RGBA'):
+        img = img.convert('RGBA' if 'A' in img.getbands() or 'transparency' in img.info else 'RGB')
+    buffer = BytesIO()
+    img.save(buffer, format=image_format, **SAVE_OPTIONS.get(image_format, {}))
+    return buffer.getvalue()
+
+
+def generate_derivatives(field_file, source=None, widths=None):
+    """
+    Create downscaled copies of an uploaded image for each configured width.
+
+    ``source`` is the uploaded file when it is still at hand, which avoids
+    reading the original back from storage. Widths at or above the original
+    width are skipped (no upscaling). Returns a ``{width: name}`` mapping
+    (widths as strings, ready for a JSONField) of the derivatives saved to
+    the same storage as the original. If one fails, those already saved
+    are deleted again before the error is re-raised. An original Pillow
+    cannot decode (e.g. a truncated file that passed validation) gets no
+    derivatives.
+    """
+    widths = sorted(set(widths if widths is not None else settings.IMAGE_DERIVATIVE_WIDTHS))
+    if not widths or not field_file:
+        return {}
+
+    if source is None or getattr(source, 'closed', False):
+        source = field_file.storage.open(field_file.name, 'rb')
+    source.seek(0)
+
+    try:
+        with PILImage.open(source) as original:
+            image_format = original.format
+            if image_format not in SAVE_OPTIONS:
+                return {}
+            # Animated GIFs would lose their frames when resized, keep them as-is
+            if getattr(original, 'is_animated', False):
+                return {}
+            img = ImageOps.exif_transpose(original)
+            img.load()
+    except DECODE_ERRORS:
+        return {}
+
+    derivatives = {}
+    try:
+        for width in widths:
+            if width >= img.width:
+                continue
+            height = max(1, round(img.height * width / img.width))
+            resized = img.resize((width, height), PILImage.LANCZOS)
+            saved_name = field_file.storage.save(
+                derivative_name(field_file.name, width),
+                ContentFile(encode_image(resized, image_format))
+            )
+            derivatives[str(width)] = saved_name
+    except Exception:
+        for saved_name in derivatives.values():
+            try:
+                field_file.storage.delete(saved_name)
+            except Exception:
+                pass
+        raise
+    return derivatives
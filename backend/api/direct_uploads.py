@@ -0,0 +1,185 @@
+"""
+Direct-to-S3 browser uploads: presigned POST policies plus a signed token
+the completion endpoint uses to find and verify the uploaded object
+"""
+import os
+import uuid
+from io import BytesIO
+
+from botocore.exceptions import ClientError
+from django.conf import settings
+from django.core import signing
+from django.utils.text import get_valid_filename
+from PIL import Image as PILImage
+
+from s3_client import get_presign_client, get_s3_client, object_params, s3_key
+from .derivatives import DECODE_ERRORS, generate_derivatives
+from .models import Image
+
+TOKEN_SALT = 'api.direct-upload'
+# Extra time a client gets to call the completion endpoint after the upload
+TOKEN_GRACE_SECONDS = 3600
+# Raster types accepted for uploads that bypass the ImageField; SVG in
+# particular is refused, as the proxy would serve its scripts from our origin
+ALLOWED_CONTENT_TYPES = ('image/jpeg', 'image/png', 'image/gif', 'image/webp')
+ALLOWED_IMAGE_FORMATS = ('JPEG', 'PNG', 'GIF', 'WEBP')
+# Bytes read from the start of an uploaded object to identify the image
+SNIFF_BYTES = 256 * 1024
+# Presigned POST form fields for the object parameters that have one
+POST_FIELDS = {
+    'ACL': 'acl',
+    'CacheControl': 'Cache-Control',
+    'ContentDisposition': 'Content-Disposition',
+    'ContentEncoding': 'Content-Encoding',
+}
+
+
+class DirectUploadError(ValueError):
+    """Raised when an upload request or completion is invalid"""
+
+
+def direct_uploads_enabled():
+    return getattr(settings, 'AWS_STORAGE_BUCKET_NAME', None) is not None
+
+
+def check_content_type(content_type):
+    if (content_type or '').split(';')[0].strip().lower() not in ALLOWED_CONTENT_TYPES:
+        raise DirectUploadError(f"'content_type' must be one of {', '.join(ALLOWED_CONTENT_TYPES)}")
+
+
+def new_upload_name(filename):
+    """
+    Unique storage name under ``images/`` for a client-supplied file name,
+    with the name shortened to fit the ``Image.image`` column (the records
+    are created with this name as-is, not through Storage.save)
+    """
+    base, ext = os.path.splitext(get_valid_filename(os.path.basename(filename or '')) or 'upload')
+    prefix = f'images/{uuid.uuid4().hex}_'
+    ext = ext[:10].lower()
+    max_length = Image._meta.get_field('image').max_length
+    return f'{prefix}{base[:max(0, max_length - len(prefix) - len(ext))]}{ext}'
+
+
+def create_upload_policy(filename, content_type):
+    """
+    Issue a presigned POST for a new object under ``images/``.
+
+    The policy pins the key and Content-Type and limits the size to
+    DIRECT_UPLOAD_MAX_BYTES, so S3 itself rejects anything else. Returns the
+    POST ``url`` and form ``fields`` for the browser, the storage ``name``
+    and an ``upload_token`` to hand back to the completion endpoint.
+    """
+    check_content_type(content_type)
+    name = new_upload_name(filename)
+
+    fields = {'Content-Type': content_type}
+    conditions = [
+        {'Content-Type': content_type},
+        ['content-length-range', 1, settings.DIRECT_UPLOAD_MAX_BYTES],
+    ]
+    for param, value in object_params().items():
+        if param in POST_FIELDS:
+            fields[POST_FIELDS[param]] = value
+            conditions.append({POST_FIELDS[param]: value})
+
+    post = get_presign_client().generate_presigned_post(
+        Bucket=settings.AWS_STORAGE_BUCKET_NAME,
+        Key=s3_key(name),
+        Fields=fields,
+        Conditions=conditions,
+        ExpiresIn=settings.DIRECT_UPLOAD_URL_TTL,
+    )
+    return {
+        'url': post['url'],
+        'fields': post['fields'],
+        'name': name,
+        'upload_token': signing.dumps({'name': name}, salt=TOKEN_SALT),
+        'max_bytes': settings.DIRECT_UPLOAD_MAX_BYTES,
+    }
+
+
+def verify_upload(upload_token):
+    """
+    Resolve an upload token to its storage name and check the object landed
+    in S3 with an acceptable size and type (a single HEAD request). Returns
+    the name and the HEAD response.
+    """
+    try:
+        payload = signing.loads(
+            upload_token or '',
+            salt=TOKEN_SALT,
+            max_age=settings.DIRECT_UPLOAD_URL_TTL + TOKEN_GRACE_SECONDS,
+        )
+    except signing.BadSignature:
+        raise DirectUploadError("Invalid or expired 'upload_token'")
+
+    name = payload['name']
+    head = get_s3_client().head_object(
+        Bucket=settings.AWS_STORAGE_BUCKET_NAME,
+        Key=s3_key(name),
+    )
+    try:
+        check_content_type(head.get('ContentType'))
+        if head['ContentLength'] > settings.DIRECT_UPLOAD_MAX_BYTES:
+            raise DirectUploadError("Uploaded file is too large")
+    except DirectUploadError:
+        discard_upload(name)
+        raise
+    return name, head
+
+
+def discard_upload(name):
+    """Delete an uploaded object that was refused"""
+    try:
+        get_s3_client().delete_object(Bucket=settings.AWS_STORAGE_BUCKET_NAME, Key=s3_key(name))
+    except ClientError:
+        pass
+
+
+def check_stored_image(name):
+    """
+    Check that the object ``name`` is a raster image we accept, from its
+    first SNIFF_BYTES (one ranged GET). Pillow must identify them as one of
+    ALLOWED_IMAGE_FORMATS; objects that fit in the range are fully verified.
+    """
+    response = get_s3_client().get_object(
+        Bucket=settings.AWS_STORAGE_BUCKET_NAME,
+        Key=s3_key(name),
+        Range=f'bytes=0-{SNIFF_BYTES - 1}',
+    )
+    try:
+        head = response['Body'].read(SNIFF_BYTES)
+    finally:
+        response['Body'].close()
+    size = response.get('ContentRange', '').rpartition('/')[2]
+    whole = int(size) <= len(head) if size.isdigit() else len(head) < SNIFF_BYTES
+    try:
+        with PILImage.open(BytesIO(head)) as img:
+            image_format = img.format
+            if whole:
+                img.verify()
+    except DECODE_ERRORS:
+        raise DirectUploadError("Uploaded file is not a valid image")
+    if image_format not in ALLOWED_IMAGE_FORMATS:
+        raise DirectUploadError("Uploaded file must be a JPEG, PNG, GIF or WebP image")
+
+
+def image_from_upload(name, title=''):
+    """
+    An unsaved Image for the uploaded object ``name``, with its derivatives
+    already generated. If the object is not an image we accept it is
+    deleted and DirectUploadError is raised, so no record is left behind.
+    """
+    image = Image(title=(title or '')[:200])
+    # The object is already in S3: point the field at it without re-uploading
+    image.image.name = name
+    try:
+        check_stored_image(name)
+        image.derivatives = generate_derivatives(image.image)
+    except DirectUploadError:
+        discard_upload(name)
+        raise
+    except DECODE_ERRORS:
+        discard_upload(name)
+        raise DirectUploadError("Uploaded file is not a valid image")
+    return image
@@ -0,0 +1,244 @@
+"""
+Node-local disk cache for immutable S3 images, shared by all gunicorn
+workers on the host
+"""
+import asyncio
+import fcntl
+import hashlib
+import json
+import os
+import tempfile
+import time
+
+from django.conf import settings
+
+from s3_client import s3_key
+from .metrics import record_cache
+
+# Evict down to this fraction of the byte budget once it is exceeded
+EVICT_TARGET_RATIO = 0.9
+# Rescan the cache after this fraction of the budget was written by a worker
+EVICT_CHECK_RATIO = 0.05
+# Leftover temp files from crashed fills are removed after this many seconds
+STALE_TEMP_SECONDS = 3600
+
+
+class CachedImage:
+    """A cache entry: the data file path plus the S3 metadata it was filled with"""
+
+    def __init__(self, path, meta):
+        self.path = path
+        self.size = meta['size']
+        self.content_type = meta['content_type']
+        self.etag = meta.get('etag')
+        self.last_modified = meta.get('last_modified')
+        self.cache_control = meta.get('cache_control')
+
+
+class DiskImageCache:
+    """
+    Size-bounded LRU cache of S3 objects on local disk.
+
+    Entries are content files named after the SHA-256 of the S3 key with a
+    JSON metadata sidecar. Fills are written to a temp file in the same
+    directory and published with os.replace(), so concurrent workers never
+    observe a partial entry. Recency is tracked through the data file's
+    mtime, which every hit bumps, and eviction runs under an flock so only
+    one worker on the node scans at a time.
+    """
+
+    def __init__(self, directory, max_bytes, max_object_bytes, prefixes=()):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_object_bytes = max_object_bytes
+        self.prefixes = tuple(prefixes)
+        self._written_since_evict = max_bytes
+        os.makedirs(directory, exist_ok=True)
+
+    def _paths(self, key):
+        digest = hashlib.sha256(key.encode('utf-8')).hexdigest()
+        shard = os.path.join(self.directory, digest[:2], digest[2:4])
+        return shard, os.path.join(shard, digest + '.bin'), os.path.join(shard, digest + '.json')
+
+    def accepts(self, key, size=None):
+        """Whether ``key`` (of ``size`` bytes, if known) may be cached"""
+        if self.prefixes and not key.startswith(self.prefixes):
+            return False
+        return size is None or size <= self.max_object_bytes
+
+    def get(self, key):
+        """Return the CachedImage for ``key`` or None on a miss"""
+        _, data_path, meta_path = self._paths(key)
+        try:
+            with open(meta_path) as f:
+                meta = json.load(f)
+            if os.path.getsize(data_path) != meta['size']:
+                record_cache('image', False)
+                return None
+            os.utime(data_path)
+        except (OSError, ValueError, KeyError):
+            record_cache('image', False)
+            return None
+        record_cache('image', True)
+        return CachedImage(data_path, meta)
+
+    def fill(self, key, s3_response, chunks):
+        """
+        Pass ``chunks`` through while writing them to the cache.
+
+        The entry is only published when the whole body was received; if the
+        client disconnects or S3 fails mid-stream the temp file is discarded.
+        """
+        tmp = self._open_temp(key)
+        if tmp is None:
+            yield from chunks
+            return
+
+        received = 0
+        published = False
+        try:
+            with tmp:
+                for chunk in chunks:
+                    tmp.write(chunk)
+                    received += len(chunk)
+                    yield chunk
+            published = self._publish(key, tmp.name, s3_response, received)
+        finally:
+            self._finish_fill(tmp.name, published, received)
+
+    async def afill(self, key, s3_response, chunks):
+        """
+        Async counterpart of fill() for async chunk iterators. The file
+        work (writes, publishing and an eviction scan, which can take a
+        while on a large cache) runs in worker threads, off the event loop.
+        """
+        tmp = await asyncio.to_thread(self._open_temp, key)
+        if tmp is None:
+            async for chunk in chunks:
+                yield chunk
+            return
+
+        received = 0
+        published = False
+        try:
+            try:
+                async for chunk in chunks:
+                    await asyncio.to_thread(tmp.write, chunk)
+                    received += len(chunk)
+                    yield chunk
+            finally:
+                await asyncio.to_thread(tmp.close)
+            published = await asyncio.to_thread(self._publish, key, tmp.name, s3_response, received)
+        finally:
+            await asyncio.to_thread(self._finish_fill, tmp.name, published, received)
+
+    def _open_temp(self, key):
+        shard, _, _ = self._paths(key)
+        try:
+            os.makedirs(shard, exist_ok=True)
+            return tempfile.NamedTemporaryFile(dir=shard, suffix='.tmp', delete=False)
+        except OSError:
+            return None
+
+    def _publish(self, key, tmp_path, s3_response, received):
+        """Atomically move a completely received body into place"""
+        expected = s3_response.get('ContentLength')
+        if expected is not None and received != expected:
+            return False
+        shard, data_path, meta_path = self._paths(key)
+        meta = {
+            'size': received,
+            'content_type': s3_response.get('ContentType'),
+            'etag': s3_response.get('ETag'),
+            'last_modified': (
+                s3_response['LastModified'].timestamp()
+                if s3_response.get('LastModified') else None
+            ),
+            'cache_control': s3_response.get('CacheControl'),
+        }
+        self._write_meta(shard, meta_path, meta)
+        os.replace(tmp_path, data_path)
+        return True
+
+    def _finish_fill(self, tmp_path, published, received):
+        if not published:
+            self._unlink(tmp_path)
+        self._written_since_evict += received
+        if self._written_since_evict >= self.max_bytes * EVICT_CHECK_RATIO:
+            self.evict()
+
+    def _write_meta(self, shard, meta_path, meta):
+        with tempfile.NamedTemporaryFile('w', dir=shard, suffix='.tmp', delete=False) as f:
+            json.dump(meta, f)
+        os.replace(f.name, meta_path)
+
+    def evict(self):
+        """Delete least recently used entries until the cache fits its budget"""
+        lock_path = os.path.join(self.directory, '.lock')
+        with open(lock_path, 'w') as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                # Another worker is already evicting
+                return
+            try:
+                self._written_since_evict = 0
+                self._evict_locked()
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _evict_locked(self):
+        entries = []
+        total = 0
+        now = time.time()
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                if name.endswith('.tmp'):
+                    if now - stat.st_mtime > STALE_TEMP_SECONDS:
+                        self._unlink(path)
+                elif name.endswith('.bin'):
+                    entries.append((stat.st_mtime, stat.st_size, path))
+                    total += stat.st_size
+
+        if total <= self.max_bytes:
+            return
+
+        target = self.max_bytes * EVICT_TARGET_RATIO
+        for _, size, path in sorted(entries):
+            self._unlink(path[:-len('.bin')] + '.json')
+            self._unlink(path)
+            total -= size
+            if total <= target:
+                break
+
+    @staticmethod
+    def _unlink(path):
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+
+
+_cache = None
+
+
+def get_image_cache():
+    """Return the configured DiskImageCache, or None when caching is disabled"""
+    global _cache
+    if not settings.S3_IMAGE_CACHE_DIR:
+        return None
+    if _cache is None:
+        _cache = DiskImageCache(
+            settings.S3_IMAGE_CACHE_DIR,
+            settings.S3_IMAGE_CACHE_MAX_BYTES,
+            settings.S3_IMAGE_CACHE_MAX_OBJECT_BYTES,
+            # Transformed variants are immutable too, so they are always cacheable
+            [s3_key(prefix) for prefix in settings.S3_IMAGE_CACHE_PREFIXES]
+            + [settings.IMAGE_TRANSFORM_PREFIX],
+        )
+    return _cache
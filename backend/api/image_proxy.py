@@ -0,0 +1,463 @@
+"""
+Helpers for proxying S3 objects through Django: chunked streaming,
+conditional GET (ETag / Last-Modified) and byte-range requests, for both
+the sync (boto3) and async (aiobotocore) views
+"""
+import asyncio
+import re
+import secrets
+from datetime import datetime, timezone
+
+from django.conf import settings
+from django.http import FileResponse, HttpResponse, HttpResponseNotModified, StreamingHttpResponse
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, parse_http_date_safe
+from botocore.exceptions import ClientError
+
+DEFAULT_CONTENT_TYPE = 'image/jpeg'
+
+_RANGE_SPEC_RE = re.compile(r'^\s*(\d*)\s*-\s*(\d*)\s*$')
+
+
+def stream_s3_body(body, chunk_size=None):
+    """
+    Yield an S3 object body in fixed-size chunks, always closing the
+    underlying botocore stream (also when the client disconnects early)
+    """
+    chunk_size = chunk_size or settings.S3_PROXY_CHUNK_SIZE
+    try:
+        for chunk in body.iter_chunks(chunk_size=chunk_size):
+            yield chunk
+    finally:
+        body.close()
+
+
+def parse_range_header(header):
+    """
+    Parse a ``Range: bytes=...`` header into a list of ``(start, end)`` specs.
+
+    ``start`` is None for suffix ranges (``bytes=-500``) and ``end`` is None
+    for open ranges (``bytes=500-``). Returns None when the header is absent,
+    malformed or not expressed in bytes, in which case it must be ignored.
+    """
+    if not header:
+        return None
+    unit, _, ranges = header.partition('=')
+    if unit.strip().lower() != 'bytes' or not ranges:
+        return None
+
+    specs = []
+    for spec in ranges.split(','):
+        match = _RANGE_SPEC_RE.match(spec)
+        if not match or match.group(1) == match.group(2) == '':
+            return None
+        start = int(match.group(1)) if match.group(1) else None
+        end = int(match.group(2)) if match.group(2) else None
+        if start is not None and end is not None and end < start:
+            return None
+        specs.append((start, end))
+    return specs
+
+
+def resolve_ranges(specs, size):
+    """Turn parsed range specs into absolute, satisfiable ``(start, end)`` pairs"""
+    resolved = []
+    for start, end in specs:
+        if start is None:
+            if end == 0:
+                continue
+            start, end = max(size - end, 0), size - 1
+        elif start >= size:
+            continue
+        else:
+            end = size - 1 if end is None else min(end, size - 1)
+        resolved.append((start, end))
+    return resolved
+
+
+def coalesce_ranges(ranges):
+    """Sort resolved ranges and merge the overlapping or adjacent ones"""
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def limit_ranges(specs):
+    """
+    ``specs``, or None (serve the whole object) when more than
+    S3_PROXY_MAX_RANGES ranges are asked for
+    """
+    if specs is not None and len(specs) > settings.S3_PROXY_MAX_RANGES:
+        return None
+    return specs
+
+
+def if_range_matches(header, head):
+    """
+    Whether an ``If-Range`` validator matches the object: its strong ETag
+    or its exact Last-Modified date. A weak ETag never matches.
+    """
+    header = header.strip()
+    if header.startswith('"'):
+        return header == head.get('ETag')
+    timestamp = parse_http_date_safe(header)
+    last_modified = head.get('LastModified')
+    return timestamp is not None and last_modified is not None and int(last_modified.timestamp()) == timestamp
+
+
+def format_range(start, end):
+    """Format a parsed range spec back into S3's ``Range`` parameter"""
+    return 'bytes=%s-%s' % ('' if start is None else start, '' if end is None else end)
+
+
+def conditional_params(request):
+    """
+    Map the request's validators onto S3 GetObject/HeadObject parameters so
+    S3 answers 304 without sending the body.
+    """
+    params = {}
+    if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+    if if_none_match:
+        params['IfNoneMatch'] = if_none_match
+    else:
+        # If-Modified-Since is ignored when If-None-Match is present (RFC 9110)
+        timestamp = parse_http_date_safe(request.META.get('HTTP_IF_MODIFIED_SINCE', ''))
+        if timestamp is not None:
+            params['IfModifiedSince'] = datetime.fromtimestamp(timestamp, tz=timezone.utc)
+    return params
+
+
+def apply_validators(response, s3_response):
+    """Copy ETag, Last-Modified and caching headers from an S3 response"""
+    if s3_response.get('ETag'):
+        response['ETag'] = s3_response['ETag']
+    if s3_response.get('LastModified'):
+        response['Last-Modified'] = http_date(s3_response['LastModified'].timestamp())
+    if s3_response.get('CacheControl'):
+        response['Cache-Control'] = s3_response['CacheControl']
+    response['Accept-Ranges'] = 'bytes'
+    return response
+
+
+def _error_status(error):
+    return error.response.get('ResponseMetadata', {}).get('HTTPStatusCode')
+
+
+def _not_modified(error):
+    """Build a 304 from the validators S3 returned alongside its NotModified error"""
+    headers = error.response.get('ResponseMetadata', {}).get('HTTPHeaders', {})
+    response = HttpResponseNotModified()
+    if headers.get('etag'):
+        response['ETag'] = headers['etag']
+    if headers.get('last-modified'):
+        response['Last-Modified'] = headers['last-modified']
+    if headers.get('cache-control'):
+        response['Cache-Control'] = headers['cache-control']
+    return response
+
+
+def _range_not_satisfiable(size=None):
+    response = HttpResponse(status=416)
+    response['Content-Range'] = 'bytes */%s' % (size if size is not None else '*')
+    return response
+
+
+def _full_response(s3_response, body):
+    response = StreamingHttpResponse(
+        body,
+        content_type=s3_response.get('ContentType', DEFAULT_CONTENT_TYPE)
+    )
+    if 'ContentLength' in s3_response:
+        response['Content-Length'] = str(s3_response['ContentLength'])
+    return apply_validators(response, s3_response)
+
+
+def _partial_response(s3_response, body):
+    response = StreamingHttpResponse(
+        body,
+        status=206,
+        content_type=s3_response.get('ContentType', DEFAULT_CONTENT_TYPE)
+    )
+    response['Content-Range'] = s3_response['ContentRange']
+    response['Content-Length'] = str(s3_response['ContentLength'])
+    return apply_validators(response, s3_response)
+
+
+def _head_response(head):
+    response = HttpResponse(content_type=head.get('ContentType', DEFAULT_CONTENT_TYPE))
+    response['Content-Length'] = str(head['ContentLength'])
+    return apply_validators(response, head)
+
+
+def _multipart_layout(head, ranges):
+    """Boundary, per-part headers and closing delimiter of a multipart/byteranges body"""
+    size = head['ContentLength']
+    content_type = head.get('ContentType', DEFAULT_CONTENT_TYPE)
+    boundary = secrets.token_hex(16)
+    part_headers = [
+        (
+            '\r\n--%s\r\nContent-Type: %s\r\nContent-Range: bytes %d-%d/%d\r\n\r\n'
+            % (boundary, content_type, start, end, size)
+        ).encode('ascii')
+        for start, end in ranges
+    ]
+    closing = ('\r\n--%s--\r\n' % boundary).encode('ascii')
+    return boundary, part_headers, closing
+
+
+def _multipart_response(head, ranges, boundary, part_headers, closing, body):
+    response = StreamingHttpResponse(
+        body,
+        status=206,
+        content_type='multipart/byteranges; boundary=%s' % boundary
+    )
+    response['Content-Length'] = str(
+        sum(len(header) for header in part_headers)
+        + sum(end - start + 1 for start, end in ranges)
+        + len(closing)
+    )
+    return apply_validators(response, head)
+
+
+def _cached_not_modified(request, cached):
+    """Check the request's validators against a disk cache entry locally"""
+    not_modified = get_conditional_response(
+        request,
+        etag=cached.etag,
+        last_modified=int(cached.last_modified) if cached.last_modified else None,
+    )
+    if not_modified is not None and cached.cache_control:
+        not_modified['Cache-Control'] = cached.cache_control
+    return not_modified
+
+
+def _apply_cached_validators(response, cached):
+    if cached.etag:
+        response['ETag'] = cached.etag
+    if cached.last_modified:
+        response['Last-Modified'] = http_date(cached.last_modified)
+    if cached.cache_control:
+        response['Cache-Control'] = cached.cache_control
+    response['Accept-Ranges'] = 'bytes'
+    return response
+
+
+def _handle_client_error(error):
+    """Turn S3's NotModified/InvalidRange errors into responses, re-raise the rest"""
+    if _error_status(error) == 304:
+        return _not_modified(error)
+    if error.response.get('Error', {}).get('Code') == 'InvalidRange':
+        return _range_not_satisfiable(error.response['Error'].get('ActualObjectSize'))
+    raise error
+
+
+def cached_response(request, cached):
+    """
+    Serve a disk cache entry with FileResponse, which lets the WSGI server
+    use sendfile(). Validators are checked locally, so a 304 costs nothing.
+    Returns None when the entry was evicted since it was looked up.
+    """
+    not_modified = _cached_not_modified(request, cached)
+    if not_modified is not None:
+        return not_modified
+    try:
+        f = open(cached.path, 'rb')
+    except FileNotFoundError:
+        return None
+    response = FileResponse(f, content_type=cached.content_type or DEFAULT_CONTENT_TYPE)
+    return _apply_cached_validators(response, cached)
+
+
+def proxy_s3_object(request, s3_client, bucket, key, cache=None):
+    """
+    Answer a GET/HEAD for ``key`` with a 200, 206, 304 or 416 response.
+
+    Validators and single ranges are forwarded to S3 so that unchanged
+    objects are never read and partial reads only transfer the requested
+    bytes. Multiple ranges are coalesced and capped (see limit_ranges());
+    with an ``If-Range`` that no longer matches, the whole object is sent.
+    When a disk ``cache`` is given, full GETs are served from it and misses
+    are written through to it. Other ClientErrors (e.g. NoSuchKey)
+    propagate to the caller.
+    """
+    params = conditional_params(request)
+    specs = limit_ranges(parse_range_header(request.META.get('HTTP_RANGE')))
+    if_range = request.META.get('HTTP_IF_RANGE')
+
+    if cache is not None and request.method == 'GET' and not specs and cache.accepts(key):
+        cached = cache.get(key)
+        response = cached_response(request, cached) if cached is not None else None
+        if response is not None:
+            return response
+
+    try:
+        if request.method == 'HEAD':
+            return _head_response(s3_client.head_object(Bucket=bucket, Key=key, **params))
+
+        head = None
+        if specs and if_range:
+            head = s3_client.head_object(Bucket=bucket, Key=key, **params)
+            if not if_range_matches(if_range, head):
+                specs = None
+
+        if not specs:
+            s3_response = s3_client.get_object(Bucket=bucket, Key=key, **params)
+            body = stream_s3_body(s3_response['Body'])
+            if cache is not None and cache.accepts(key, s3_response.get('ContentLength')):
+                body = cache.fill(key, s3_response, body)
+            return _full_response(s3_response, body)
+
+        if len(specs) == 1 and head is None:
+            s3_response = s3_client.get_object(
+                Bucket=bucket, Key=key, Range=format_range(*specs[0]), **params
+            )
+            body = stream_s3_body(s3_response['Body'])
+            if 'ContentRange' in s3_response:
+                return _partial_response(s3_response, body)
+            return _full_response(s3_response, body)
+
+        if head is None:
+            head = s3_client.head_object(Bucket=bucket, Key=key, **params)
+        ranges = coalesce_ranges(resolve_ranges(specs, head['ContentLength']))
+        if not ranges:
+            return _range_not_satisfiable(head['ContentLength'])
+        if len(ranges) == 1:
+            s3_response = s3_client.get_object(
+                Bucket=bucket, Key=key, Range=format_range(*ranges[0]), IfMatch=head['ETag']
+            )
+            return _partial_response(s3_response, stream_s3_body(s3_response['Body']))
+
+        # S3 only serves one range per GET, so each part is fetched lazily
+        # with its own ranged GetObject pinned to the object's ETag
+        boundary, part_headers, closing = _multipart_layout(head, ranges)
+
+        def parts():
+            for (start, end), header in zip(ranges, part_headers):
+                yield header
+                part = s3_client.get_object(
+                    Bucket=bucket, Key=key, Range=format_range(start, end), IfMatch=head['ETag']
+                )
+                yield from stream_s3_body(part['Body'])
+            yield closing
+
+        return _multipart_response(head, ranges, boundary, part_headers, closing, parts())
+
+    except ClientError as e:
+        return _handle_client_error(e)
+
+
+# Async variants used by the ASGI views (api/async_views.py). They mirror
+# the synchronous functions above but never block the event loop.
+
+async def astream_s3_body(body, chunk_size=None):
+    """Async counterpart of stream_s3_body() for aiobotocore bodies"""
+    chunk_size = chunk_size or settings.S3_PROXY_CHUNK_SIZE
+    try:
+        async for chunk in body.iter_chunks(chunk_size):
+            yield chunk
+    finally:
+        body.close()
+
+
+async def _astream_file(f, chunk_size=None):
+    """Read an open local file in a worker thread chunk by chunk, then close it"""
+    chunk_size = chunk_size or settings.S3_PROXY_CHUNK_SIZE
+    try:
+        while True:
+            chunk = await asyncio.to_thread(f.read, chunk_size)
+            if not chunk:
+                break
+            yield chunk
+    finally:
+        f.close()
+
+
+async def acached_response(request, cached):
+    """
+    Serve a disk cache entry without blocking the event loop; None when
+    the entry was evicted since it was looked up
+    """
+    not_modified = _cached_not_modified(request, cached)
+    if not_modified is not None:
+        return not_modified
+    try:
+        f = await asyncio.to_thread(open, cached.path, 'rb')
+    except FileNotFoundError:
+        return None
+    response = StreamingHttpResponse(
+        _astream_file(f),
+        content_type=cached.content_type or DEFAULT_CONTENT_TYPE
+    )
+    response['Content-Length'] = str(cached.size)
+    return _apply_cached_validators(response, cached)
+
+
+async def aproxy_s3_object(request, s3_client, bucket, key, cache=None):
+    """Async counterpart of proxy_s3_object() for an aiobotocore S3 client"""
+    params = conditional_params(request)
+    specs = limit_ranges(parse_range_header(request.META.get('HTTP_RANGE')))
+    if_range = request.META.get('HTTP_IF_RANGE')
+
+    if cache is not None and request.method == 'GET' and not specs and cache.accepts(key):
+        cached = await asyncio.to_thread(cache.get, key)
+        response = await acached_response(request, cached) if cached is not None else None
+        if response is not None:
+            return response
+
+    try:
+        if request.method == 'HEAD':
+            return _head_response(await s3_client.head_object(Bucket=bucket, Key=key, **params))
+
+        head = None
+        if specs and if_range:
+            head = await s3_client.head_object(Bucket=bucket, Key=key, **params)
+            if not if_range_matches(if_range, head):
+                specs = None
+
+        if not specs:
+            s3_response = await s3_client.get_object(Bucket=bucket, Key=key, **params)
+            body = astream_s3_body(s3_response['Body'])
+            if cache is not None and cache.accepts(key, s3_response.get('ContentLength')):
+                body = cache.afill(key, s3_response, body)
+            return _full_response(s3_response, body)
+
+        if len(specs) == 1 and head is None:
+            s3_response = await s3_client.get_object(
+                Bucket=bucket, Key=key, Range=format_range(*specs[0]), **params
+            )
+            body = astream_s3_body(s3_response['Body'])
+            if 'ContentRange' in s3_response:
+                return _partial_response(s3_response, body)
+            return _full_response(s3_response, body)
+
+        if head is None:
+            head = await s3_client.head_object(Bucket=bucket, Key=key, **params)
+        ranges = coalesce_ranges(resolve_ranges(specs, head['ContentLength']))
+        if not ranges:
+            return _range_not_satisfiable(head['ContentLength'])
+        if len(ranges) == 1:
+            s3_response = await s3_client.get_object(
+                Bucket=bucket, Key=key, Range=format_range(*ranges[0]), IfMatch=head['ETag']
+            )
+            return _partial_response(s3_response, astream_s3_body(s3_response['Body']))
+
+        boundary, part_headers, closing = _multipart_layout(head, ranges)
+
+        async def parts():
+            for (start, end), header in zip(ranges, part_headers):
+                yield header
+                part = await s3_client.get_object(
+                    Bucket=bucket, Key=key, Range=format_range(start, end), IfMatch=head['ETag']
+                )
+                async for chunk in astream_s3_body(part['Body']):
+                    yield chunk
+            yield closing
+
+        return _multipart_response(head, ranges, boundary, part_headers, closing, parts())
+
+    except ClientError as e:
+        return _handle_client_error(e)
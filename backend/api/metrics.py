@@ -0,0 +1,187 @@
+"""
+Prometheus metrics: request latency per view, SQL query time, S3 call
+latency and errors, and cache hits/misses.
+
+Under gunicorn every worker writes its samples to PROMETHEUS_MULTIPROC_DIR
+(set by gunicorn.conf.py) and the /api/metrics/ endpoint aggregates the
+files of all workers, so a scrape sees the whole server whichever worker
+answers it.
+"""
+import contextvars
+import hmac
+import os
+import time
+
+from asgiref.sync import iscoroutinefunction
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+from django.http import HttpResponse
+from django.utils.decorators import sync_and_async_middleware
+from prometheus_client import (
+    CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Histogram, generate_latest, multiprocess
+)
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200)
+
+REQUEST_LATENCY = Histogram(
+    'django_http_request_duration_seconds', 'Request latency by view',
+    ['view', 'method', 'status'], buckets=LATENCY_BUCKETS,
+)
+REQUEST_QUERIES = Histogram(
+    'django_http_request_db_queries', 'SQL queries run per request by view',
+    ['view'], buckets=QUERY_COUNT_BUCKETS,
+)
+DB_QUERY_LATENCY = Histogram(
+    'django_db_query_duration_seconds', 'SQL query execution time by database alias',
+    ['alias'], buckets=LATENCY_BUCKETS,
+)
+S3_LATENCY = Histogram(
+    's3_request_duration_seconds', 'S3 API call latency (until the response headers) by operation',
+    ['operation'], buckets=LATENCY_BUCKETS,
+)
+S3_ERRORS = Counter(
+    's3_request_errors_total', 'Failed S3 API calls by operation and error code',
+    ['operation', 'code'],
+)
+CACHE_REQUESTS = Counter(
+    'cache_requests_total', 'Cache lookups by cache (response, image, presigned_url) and result',
+    ['cache', 'result'],
+)
+
+# Queries run by the current request (a one-item list, so wrappers can update it)
+_request_queries = contextvars.ContextVar('request_queries', default=None)
+
+
+def metrics_enabled():
+    return settings.METRICS_ENABLED
+
+
+def record_cache(cache, hit):
+    """Count a lookup in ``cache`` as a hit or a miss"""
+    if metrics_enabled():
+        CACHE_REQUESTS.labels(cache, 'hit' if hit else 'miss').inc()
+
+
+# ----- SQL -----
+
+def _time_query(execute, sql, params, many, context):
+    start = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        DB_QUERY_LATENCY.labels(context['connection'].alias).observe(time.perf_counter() - start)
+        queries = _request_queries.get()
+        if queries is not None:
+            queries[0] += 1
+
+
+@receiver(connection_created)
+def instrument_connection(sender, connection, **kwargs):
+    # Wrappers live on the per-thread DatabaseWrapper, which reconnects many times
+    if metrics_enabled() and _time_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(_time_query)
+
+
+# ----- S3 (botocore event hooks) -----
+
+def _s3_before_call(model, context, **kwargs):
+    context['metrics_operation'] = model.name
+    context['metrics_start'] = time.perf_counter()
+
+
+def _s3_after_call(http_response, parsed, context, **kwargs):
+    operation = context.get('metrics_operation')
+    if operation is None:
+        return
+    S3_LATENCY.labels(operation).observe(time.perf_counter() - context['metrics_start'])
+    if http_response.status_code >= 300:
+        S3_ERRORS.labels(operation, parsed.get('Error', {}).get('Code') or str(http_response.status_code)).inc()
+
+
+def _s3_after_call_error(exception, context, **kwargs):
+    operation = context.get('metrics_operation')
+    if operation is None:
+        return
+    S3_LATENCY.labels(operation).observe(time.perf_counter() - context['metrics_start'])
+    S3_ERRORS.labels(operation, type(exception).__name__).inc()
+
+
+def instrument_s3_client(client):
+    """Time every API call of a boto3 or aiobotocore S3 client"""
+    if not metrics_enabled():
+        return
+    events = client.meta.events
+    events.register('before-call.s3', _s3_before_call)
+    events.register('after-call.s3', _s3_after_call)
+    events.register('after-call-error.s3', _s3_after_call_error)
+
+
+# ----- Requests -----
+
+def _view_name(request):
+    match = getattr(request, 'resolver_match', None)
+    return match.view_name if match is not None else 'unresolved'
+
+
+def _observe(request, response, start, queries):
+    view = _view_name(request)
+    REQUEST_LATENCY.labels(view, request.method, response.status_code).observe(time.perf_counter() - start)
+    REQUEST_QUERIES.labels(view).observe(queries[0])
+
+
+@sync_and_async_middleware
+def metrics_middleware(get_response):
+    """Record latency and SQL query count per view (async-capable for ASGI)"""
+    if not metrics_enabled():
+        raise MiddlewareNotUsed
+
+    if iscoroutinefunction(get_response):
+        async def middleware(request):
+            start = time.perf_counter()
+            queries = [0]
+            token = _request_queries.set(queries)
+            try:
+                response = await get_response(request)
+            finally:
+                _request_queries.reset(token)
+            _observe(request, response, start, queries)
+            return response
+    else:
+        def middleware(request):
+            start = time.perf_counter()
+            queries = [0]
+            token = _request_queries.set(queries)
+            try:
+                response = get_response(request)
+            finally:
+                _request_queries.reset(token)
+            _observe(request, response, start, queries)
+            return response
+    return middleware
+
+
+def has_metrics_token(request):
+    """Whether ``request`` sends "Authorization: Bearer <METRICS_TOKEN>" (False when unset)"""
+    token = settings.METRICS_TOKEN
+    if not token:
+        return False
+    authorization = request.headers.get('Authorization', '').encode('utf-8')
+    return hmac.compare_digest(authorization, f'Bearer {token}'.encode('utf-8'))
+
+
+def metrics_view(request):
+    """Prometheus text exposition of the metrics of every worker process"""
+    if not metrics_enabled() or not settings.METRICS_TOKEN:
+        return HttpResponse(status=404)
+    if not has_metrics_token(request):
+        return HttpResponse(status=401)
+
+    if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return HttpResponse(generate_latest(registry), content_type=CONTENT_TYPE_LATEST)
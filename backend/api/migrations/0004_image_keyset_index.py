@@ -0,0 +1,21 @@
+# Generated by Django 4.2.30 on 2026-10-16 20:32
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0003_image_derivatives'),
+    ]
+
+    operations = [
+        migrations.AlterModelOptions(
+            name='image',
+            options={'ordering': ['-uploaded_at', '-id']},
+        ),
+        migrations.AddIndex(
+            model_name='image',
+            index=models.Index(fields=['-uploaded_at', '-id'], name='api_image_uploaded_id_idx'),
+        ),
+    ]
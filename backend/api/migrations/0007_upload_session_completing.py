@@ -0,0 +1,18 @@
+# Generated by Django 4.2.30 on 2026-10-16 21:15
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0006_s3_object_index'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='uploadsession',
+            name='status',
+            field=models.CharField(choices=[('active', 'Active'), ('completing', 'Completing'), ('completed', 'Completed'), ('aborted', 'Aborted')], default='active', max_length=20),
+        ),
+    ]
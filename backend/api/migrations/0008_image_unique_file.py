@@ -0,0 +1,17 @@
+# Generated by Django 4.2.30 on 2026-10-16 22:29
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0007_upload_session_completing'),
+    ]
+
+    operations = [
+        migrations.AddConstraint(
+            model_name='image',
+            constraint=models.UniqueConstraint(condition=models.Q(('image', ''), _negated=True), fields=('image',), name='api_image_unique_file'),
+        ),
+    ]
@@ -1,3 +1,4 @@
+import uuid
 from django.db import models
 from django.conf import settings
 
@@ -27,9 +28,92 @@ class Image(models.Model):
         storage=image_storage if image_storage else None
     )
     uploaded_at = models.DateTimeField(auto_now_add=True)
+    # Responsive derivatives stored next to the original: {"<width>": "<name>"}
+    derivatives = models.JSONField(default=dict, blank=True)
 
     def __str__(self):
         return self.title or f"Image {self.id}"
 
+    def stored_names(self):
+        """All storage names this record references (original and derivatives)"""
+        names = [self.image.name] if self.image and self.image.name else []
+        names.extend((self.derivatives or {}).values())
+        return names
+
+    class Meta:
+        ordering = ['-uploaded_at', '-id']
+        indexes = [
+            # Supports the default ordering and keyset pagination
+            models.Index(fields=['-uploaded_at', '-id'], name='api_image_uploaded_id_idx'),
+        ]
+        constraints = [
+            # One record per stored file (completing a direct upload twice must not duplicate it)
+            models.UniqueConstraint(fields=['image'], condition=~models.Q(image=''), name='api_image_unique_file'),
+        ]
+
+class UploadSession(models.Model):
+    """A resumable upload, backed by an S3 multipart upload"""
+    ACTIVE = 'active'
+    # Parts are being assembled and checked (see complete_session)
+    COMPLETING = 'completing'
+    COMPLETED = 'completed'
+    ABORTED = 'aborted'
+    STATUS_CHOICES = [
+        (ACTIVE, 'Active'),
+        (COMPLETING, 'Completing'),
+        (COMPLETED, 'Completed'),
+        (ABORTED, 'Aborted'),
+    ]
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    name = models.CharField(max_length=255)
+    upload_id = models.CharField(max_length=1024)
+    content_type = models.CharField(max_length=100)
+    title = models.CharField(max_length=200, blank=True)
+    total_size = models.BigIntegerField(null=True, blank=True)
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default=ACTIVE)
+    image = models.OneToOneField(Image, null=True, blank=True, on_delete=models.SET_NULL)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"Upload {self.id} ({self.status})"
+
     class Meta:
-        ordering = ['-uploaded_at']
+        indexes = [
+            # Used by the stale session cleanup
+            models.Index(fields=['status', 'updated_at'], name='api_upload_status_idx'),
+        ]
+
+class UploadPart(models.Model):
+    """A part of an UploadSession that S3 has acknowledged"""
+    session = models.ForeignKey(UploadSession, related_name='parts', on_delete=models.CASCADE)
+    number = models.PositiveIntegerField()
+    etag = models.CharField(max_length=255)
+    size = models.BigIntegerField()
+
+    def __str__(self):
+        return f"Part {self.number} of {self.session_id}"
+
+    class Meta:
+        ordering = ['number']
+        constraints = [
+            models.UniqueConstraint(fields=['session', 'number'], name='api_upload_part_unique'),
+        ]
+
+class S3Object(models.Model):
+    """
+    Index of the objects stored in the bucket, kept up to date by the
+    storage backends and repaired by sync_s3_index.py, so consistency checks
+    can query the database instead of listing the bucket
+    """
+    key = models.CharField(max_length=1024, unique=True)
+    size = models.BigIntegerField()
+    etag = models.CharField(max_length=255, blank=True)
+    # Only known for objects written through the app (listings omit it)
+    content_type = models.CharField(max_length=255, blank=True)
+    last_modified = models.DateTimeField()
+    synced_at = models.DateTimeField()
+
+    def __str__(self):
+        return self.key
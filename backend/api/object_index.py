@@ -0,0 +1,161 @@
+"""
+The S3Object index: incremental updates from the storage backends, full
+bucket syncs to repair drift, and broken-link/orphan detection as SQL
+anti-joins against api_image instead of bucket-wide listings
+"""
+import logging
+from itertools import islice
+
+from django.conf import settings
+from django.db import connection
+from django.db.models import BooleanField, CharField, Exists, OuterRef, Value
+from django.db.models.expressions import RawSQL
+from django.db.models.functions import Concat
+from django.utils import timezone
+
+from s3_client import s3_key
+from .models import Image, S3Object
+
+logger = logging.getLogger(__name__)
+
+SYNC_BATCH_SIZE = 1000
+
+# Whether any derivative of an api_image row maps to the outer S3Object's key
+DERIVATIVE_REFERENCE_SQL = {
+    'postgresql': (
+        'EXISTS (SELECT 1 FROM {image} i CROSS JOIN LATERAL jsonb_each_text(i.derivatives) d'
+        ' WHERE %s || d.value = {object}."key")'
+    ),
+    'sqlite': (
+        'EXISTS (SELECT 1 FROM {image} i, json_each(i.derivatives) d'
+        ' WHERE %s || d.value = {object}."key")'
+    ),
+}
+
+
+def object_index_enabled():
+    return settings.S3_OBJECT_INDEX and getattr(settings, 'AWS_STORAGE_BUCKET_NAME', None) is not None
+
+
+def record_object(name, size, content_type='', etag=''):
+    """
+    Index the stored file ``name`` from what the writer already knows about
+    it, without asking S3 (sync_s3_index fills in missing ETags). Failures
+    are only logged: the upload itself succeeded and a sync repairs the index.
+    """
+    if not object_index_enabled():
+        return
+    key = s3_key(name)
+    now = timezone.now()
+    try:
+        S3Object.objects.update_or_create(key=key, defaults={
+            'size': size,
+            'etag': etag or '',
+            'content_type': content_type or '',
+            'last_modified': now,
+            'synced_at': now,
+        })
+    except Exception:
+        logger.warning("Could not index S3 object %s", key, exc_info=True)
+
+
+def forget_object(name):
+    """Drop the stored file ``name`` from the index"""
+    if not object_index_enabled():
+        return
+    try:
+        S3Object.objects.filter(key=s3_key(name)).delete()
+    except Exception:
+        logger.warning("Could not remove S3 object %s from the index", s3_key(name), exc_info=True)
+
+
+def _indexed_objects():
+    """Index rows under AWS_LOCATION, without cached transformation variants"""
+    return S3Object.objects.filter(key__startswith=s3_key('')).exclude(
+        key__startswith=settings.IMAGE_TRANSFORM_PREFIX
+    )
+
+
+def sync_index(objects, started):
+    """
+    Upsert ListObjectsV2 entries (any iterable, consumed SYNC_BATCH_SIZE at
+    a time) into the index, stamping them with ``started`` (the listing
+    start time); then delete the rows that were neither listed nor written
+    since. Returns ``(upserted, deleted)``.
+    """
+    upserted = 0
+    objects = iter(objects)
+    while True:
+        batch = list(islice(objects, SYNC_BATCH_SIZE))
+        if not batch:
+            break
+        S3Object.objects.bulk_create(
+            [
+                S3Object(
+                    key=obj['Key'],
+                    size=obj['Size'],
+                    etag=obj.get('ETag', ''),
+                    last_modified=obj['LastModified'],
+                    synced_at=started,
+                )
+                for obj in batch
+            ],
+            update_conflicts=True,
+            unique_fields=['key'],
+            # Listings carry no content type, keep the one recorded on upload
+            update_fields=['size', 'etag', 'last_modified', 'synced_at'],
+        )
+        upserted += len(batch)
+    deleted, _ = _indexed_objects().filter(synced_at__lt=started).delete()
+    return upserted, deleted
+
+
+def broken_images(older_than=None):
+    """
+    Images whose original file is not in the index (one anti-join). Rows
+    uploaded at or after ``older_than`` are left out: their file may be
+    stored but not indexed yet.
+    """
+    root = s3_key('')
+    key = Concat(Value(root), OuterRef('image'), output_field=CharField()) if root else OuterRef('image')
+    images = Image.objects.exclude(Exists(S3Object.objects.filter(key=key)))
+    if older_than is not None:
+        images = images.filter(uploaded_at__lt=older_than)
+    return images
+
+
+def orphaned_objects(older_than=None):
+    """
+    Indexed objects no Image references as original or derivative, as
+    anti-joins against api_image (the derivatives one expands the JSON
+    column in SQL on PostgreSQL and SQLite; other databases collect the
+    derivative names in Python instead)
+    """
+    root = s3_key('')
+    originals = Image.objects.alias(
+        key=Concat(Value(root), 'image', output_field=CharField())
+    ).filter(key=OuterRef('key'))
+    objects = _indexed_objects().exclude(Exists(originals))
+    sql = DERIVATIVE_REFERENCE_SQL.get(connection.vendor)
+    if sql is None:
+        objects = objects.exclude(key__in=_derivative_keys(root))
+    else:
+        objects = objects.exclude(RawSQL(
+            sql.format(
+                image=connection.ops.quote_name(Image._meta.db_table),
+                object=connection.ops.quote_name(S3Object._meta.db_table),
+            ),
+            (root,),
+            output_field=BooleanField(),
+        ))
+    if older_than is not None:
+        objects = objects.filter(last_modified__lt=older_than)
+    return objects
+
+
+def _derivative_keys(root):
+    """Keys of every derivative referenced by api_image, read in Python"""
+    keys = set()
+    for derivatives in Image.objects.values_list('derivatives', flat=True).iterator():
+        keys.update(root + name for name in (derivatives or {}).values())
+    return keys
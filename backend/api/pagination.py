@@ -0,0 +1,25 @@
+from django.conf import settings
+from rest_framework.pagination import CursorPagination
+
+
+class ImageCursorPagination(CursorPagination):
+    """
+    Keyset pagination over (-uploaded_at, -id), backed by the composite
+    index on Image. Fetching any page costs the same and never runs COUNT(*).
+
+    The cursor holds only the uploaded_at position; rows sharing it (e.g. a
+    batch upload) are stepped over with an offset, ordered by -id. DRF caps
+    that offset at 1000, well above IMAGE_BATCH_MAX_FILES.
+    """
+    ordering = ('-uploaded_at', '-id')
+    page_size = settings.API_PAGE_SIZE
+    page_size_query_param = 'page_size'
+    max_page_size = settings.API_MAX_PAGE_SIZE
+
+
+class MessageCursorPagination(CursorPagination):
+    """Keyset pagination over -id (the primary key index)"""
+    ordering = '-id'
+    page_size = settings.API_PAGE_SIZE
+    page_size_query_param = 'page_size'
+    max_page_size = settings.API_MAX_PAGE_SIZE
@@ -0,0 +1,259 @@
+"""
+Opt-in per-request profiling.
+
+When PROFILING_ENABLED is set, ProfilingMiddleware profiles a request that
+carries a valid signed ``X-Profile`` token (see make_profile_token) or is
+picked by PROFILING_SAMPLE_RATE. It records a cProfile summary, every SQL
+query with its duration and the time spent in S3 calls, and stores the
+result in the cache for PROFILING_RESULT_TTL seconds. The response carries
+an ``X-Profile-Id`` header; admins read results at /api/profiles/.
+
+The profile ends when the view returns, so the body of a streaming
+response (the image proxy) is sent outside of it, and S3 calls made from
+s3transfer's worker threads (multipart uploads) are not attributed.
+
+Under ASGI the middleware runs on the event loop: cProfile then sees the
+loop thread only (not the threads running sync ORM code, whose SQL is
+still recorded), including other requests' coroutines interleaved with
+the profiled one, and one request per worker is profiled at a time.
+"""
+import contextvars
+import cProfile
+import io
+import pstats
+import random
+import time
+import uuid
+from contextlib import ExitStack, contextmanager
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+
+from django.conf import settings
+from django.core import signing
+from django.core.cache import cache
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+from django.utils import timezone
+
+PROFILE_HEADER = 'X-Profile'
+TOKEN_SALT = 'api.profiling'
+INDEX_KEY = 'profiles:index'
+# At most this many SQL queries / S3 calls are kept per profile
+MAX_RECORDED_CALLS = 500
+
+# The profile being recorded by the current request, if any
+_active = contextvars.ContextVar('active_profile', default=None)
+
+
+def make_profile_token():
+    """A token for the X-Profile header, valid for PROFILING_TOKEN_MAX_AGE seconds"""
+    return signing.TimestampSigner(salt=TOKEN_SALT).sign(uuid.uuid4().hex)
+
+
+def _valid_token(value):
+    try:
+        signing.TimestampSigner(salt=TOKEN_SALT).unsign(value, max_age=settings.PROFILING_TOKEN_MAX_AGE)
+    except signing.BadSignature:
+        return False
+    return True
+
+
+def _profile_key(profile_id):
+    return f'profiles:{profile_id}'
+
+
+def store_profile(profile):
+    cache.set(_profile_key(profile['id']), profile, settings.PROFILING_RESULT_TTL)
+    # Newest first; entries whose profile expired are dropped when listed
+    index = cache.get(INDEX_KEY, [])
+    index = [profile['id']] + index[:settings.PROFILING_MAX_STORED - 1]
+    cache.set(INDEX_KEY, index, settings.PROFILING_RESULT_TTL)
+
+
+def get_profile(profile_id):
+    return cache.get(_profile_key(profile_id))
+
+
+def list_profiles():
+    """Summaries (without stats and call lists) of the stored profiles, newest first"""
+    index = cache.get(INDEX_KEY, [])
+    profiles = cache.get_many([_profile_key(profile_id) for profile_id in index])
+    return [
+        {k: v for k, v in profiles[_profile_key(profile_id)].items() if k not in ('stats', 'sql', 's3')}
+        for profile_id in index if _profile_key(profile_id) in profiles
+    ]
+
+
+# ----- Recorders -----
+
+def _record_query(execute, sql, params, many, context):
+    start = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        profile = _active.get()
+        if profile is not None:
+            duration = time.perf_counter() - start
+            profile['sql_ms'] += duration * 1000
+            profile['sql_count'] += 1
+            if len(profile['sql']) < MAX_RECORDED_CALLS:
+                profile['sql'].append({
+                    'alias': context['connection'].alias,
+                    'sql': sql,
+                    'many': many,
+                    'ms': round(duration * 1000, 3),
+                })
+
+
+def _s3_before_call(model, context, **kwargs):
+    if _active.get() is not None:
+        context['profile_operation'] = model.name
+        context['profile_start'] = time.perf_counter()
+
+
+def _s3_done(context, error=None):
+    profile = _active.get()
+    start = context.get('profile_start')
+    if profile is None or start is None:
+        return
+    duration = time.perf_counter() - start
+    profile['s3_ms'] += duration * 1000
+    profile['s3_count'] += 1
+    if len(profile['s3']) < MAX_RECORDED_CALLS:
+        profile['s3'].append({
+            'operation': context['profile_operation'],
+            'ms': round(duration * 1000, 3),
+            'error': error,
+        })
+
+
+def _s3_after_call(http_response, parsed, context, **kwargs):
+    error = parsed.get('Error', {}).get('Code') if http_response.status_code >= 300 else None
+    _s3_done(context, error)
+
+
+def _s3_after_call_error(exception, context, **kwargs):
+    _s3_done(context, type(exception).__name__)
+
+
+def instrument_s3_client(client):
+    """Record the S3 calls made while a request is being profiled"""
+    if not settings.PROFILING_ENABLED:
+        return
+    events = client.meta.events
+    events.register('before-call.s3', _s3_before_call)
+    events.register('after-call.s3', _s3_after_call)
+    events.register('after-call-error.s3', _s3_after_call_error)
+
+
+# ----- Middleware -----
+
+class ProfilingMiddleware:
+    """
+    Profile requests that ask for it with a signed X-Profile header, plus a
+    PROFILING_SAMPLE_RATE share of all requests. Off unless PROFILING_ENABLED.
+    Async-capable, so ASGI requests are not adapted to sync to be profiled.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        if not settings.PROFILING_ENABLED:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+        # Whether a request on the event loop is being profiled (cProfile
+        # profiles a thread, so concurrent profiles would clobber each other)
+        self._loop_busy = False
+
+    def _wanted(self, request):
+        token = request.headers.get(PROFILE_HEADER)
+        if token:
+            return _valid_token(token)
+        rate = settings.PROFILING_SAMPLE_RATE
+        return rate > 0 and random.random() < rate
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        if not self._wanted(request):
+            return self.get_response(request)
+
+        profile, profiler, start = self._new_profile(request), cProfile.Profile(), time.perf_counter()
+        token = _active.set(profile)
+        try:
+            with self._recording(profiler):
+                response = self.get_response(request)
+        finally:
+            _active.reset(token)
+        self._finish(request, response, profile, profiler, start)
+        store_profile(profile)
+        response['X-Profile-Id'] = profile['id']
+        return response
+
+    async def __acall__(self, request):
+        if self._loop_busy or not self._wanted(request):
+            return await self.get_response(request)
+
+        profile, profiler, start = self._new_profile(request), cProfile.Profile(), time.perf_counter()
+        token = _active.set(profile)
+        self._loop_busy = True
+        try:
+            with self._recording(profiler):
+                response = await self.get_response(request)
+        finally:
+            self._loop_busy = False
+            _active.reset(token)
+        self._finish(request, response, profile, profiler, start)
+        await sync_to_async(store_profile)(profile)
+        response['X-Profile-Id'] = profile['id']
+        return response
+
+    @staticmethod
+    def _new_profile(request):
+        return {
+            'id': uuid.uuid4().hex,
+            'method': request.method,
+            'path': request.get_full_path(),
+            'started_at': timezone.now().isoformat(),
+            'sql_count': 0,
+            'sql_ms': 0.0,
+            's3_count': 0,
+            's3_ms': 0.0,
+            'sql': [],
+            's3': [],
+        }
+
+    @staticmethod
+    @contextmanager
+    def _recording(profiler):
+        """Run the block under ``profiler``, recording the SQL it runs"""
+        with ExitStack() as stack:
+            for connection in connections.all():
+                stack.enter_context(connection.execute_wrapper(_record_query))
+            profiler.enable()
+            try:
+                yield
+            finally:
+                profiler.disable()
+
+    def _finish(self, request, response, profile, profiler, start):
+        match = getattr(request, 'resolver_match', None)
+        profile.update({
+            'view': match.view_name if match is not None else None,
+            'status': response.status_code,
+            'total_ms': round((time.perf_counter() - start) * 1000, 3),
+            'sql_ms': round(profile['sql_ms'], 3),
+            's3_ms': round(profile['s3_ms'], 3),
+            'stats': self._format_stats(profiler),
+        })
+
+    @staticmethod
+    def _format_stats(profiler):
+        """The top functions by cumulative time, as pstats prints them"""
+        out = io.StringIO()
+        stats = pstats.Stats(profiler, stream=out)
+        stats.strip_dirs().sort_stats(pstats.SortKey.CUMULATIVE).print_stats(settings.PROFILING_TOP_FUNCTIONS)
+        return out.getvalue()
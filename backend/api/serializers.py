@@ -1,28 +1,148 @@
 from rest_framework import serializers
-from .models import Message, Image
+from django.conf import settings
+from django.db import models
+from .models import Message, Image, UploadSession, UploadPart
+from .delivery import presigned_delivery_enabled, presigned_image_url
+from .upload_handlers import StreamedS3File
+from .values_lists import ValuesListSerializer, absolute_url_builder
 
 class MessageSerializer(serializers.ModelSerializer):
+    # Columns fetched by the list fast path (see values_lists.py)
+    values_fields = ('id', 'body')
+    
     class Meta:
         model = Message
         fields = '__all__'
+        list_serializer_class = ValuesListSerializer
+    
+    def prepare_rows(self):
+        return None
+    
+    def row_representation(self, row, state):
+        return {'id': row['id'], 'body': row['body']}
+
+class StreamedImageField(serializers.ImageField):
+    """
+    ImageField that validates files streamed to S3 from their header, as
+    only that part of them is held locally
+    """
+    def to_internal_value(self, data):
+        if not isinstance(data, StreamedS3File):
+            return super().to_internal_value(data)
+        file_object = serializers.FileField.to_internal_value(self, data)
+        try:
+            data.sniff_image()
+        except Exception:
+            self.fail('invalid_image')
+        return file_object
 
 class ImageSerializer(serializers.ModelSerializer):
+    serializer_field_mapping = {
+        **serializers.ModelSerializer.serializer_field_mapping,
+        models.ImageField: StreamedImageField,
+    }
     image_url = serializers.SerializerMethodField()
+    srcset = serializers.SerializerMethodField()
+    # Columns fetched by the list fast path (see values_lists.py)
+    values_fields = ('id', 'title', 'image', 'derivatives', 'uploaded_at')
     
     class Meta:
         model = Image
-        fields = '__all__'
+        exclude = ('derivatives',)
         read_only_fields = ('uploaded_at',)
+        list_serializer_class = ValuesListSerializer
+    
+    def _file_url(self, name):
+        if presigned_delivery_enabled():
+            # Hand out a short-lived presigned S3 URL, skipping the proxy
+            return presigned_image_url(name)
+        # Return the proxy URL that will serve the image from S3
+        request = self.context.get('request')
+        if request:
+            return request.build_absolute_uri(f'/api/s3-image/{name}')
+        else:
+            # Fallback URL when no request context is available
+            base_url = 'http://localhost:8000' if settings.DEBUG else ''
+            return f'{base_url}/api/s3-image/{name}'
     
     def get_image_url(self, obj):
         if obj.image and obj.image.name:
-            # Return the proxy URL that will serve the image from S3
-            request = self.context.get('request')
-            if request:
-                return request.build_absolute_uri(f'/api/s3-image/{obj.image.name}')
-            else:
-                # Fallback URL when no request context is available
-                from django.conf import settings
-                base_url = 'http://localhost:8000' if settings.DEBUG else ''
-                return f'{base_url}/api/s3-image/{obj.image.name}'
-        return None
\ No newline at end of file
+            return self._file_url(obj.image.name)
+        return None
+    
+    def get_srcset(self, obj):
+        """Derivative URLs keyed by width, ordered from smallest to largest"""
+        derivatives = obj.derivatives or {}
+        return {
+            width: self._file_url(derivatives[width])
+            for width in sorted(derivatives, key=int)
+        }
+    
+    def prepare_rows(self):
+        """Per-page state for row_representation(), resolved once"""
+        request = self.context.get('request')
+        absolute = absolute_url_builder(request)
+        if presigned_delivery_enabled():
+            file_url = presigned_image_url
+        elif absolute is not None:
+            file_url = lambda name: absolute(f'/api/s3-image/{name}')
+        else:
+            base_url = 'http://localhost:8000' if settings.DEBUG else ''
+            file_url = lambda name: f'{base_url}/api/s3-image/{name}'
+        return {
+            'file_url': file_url,
+            'absolute': absolute,
+            'storage': Image._meta.get_field('image').storage,
+            'uploaded_at': self.fields['uploaded_at'].to_representation,
+        }
+    
+    def row_representation(self, row, state):
+        """Same output as to_representation() for a ``values_fields`` row"""
+        name = row['image']
+        file_url = state['file_url']
+        image = None
+        if name:
+            # What the ImageField outputs: the storage URL, made absolute
+            image = state['storage'].url(name)
+            if state['absolute'] is not None:
+                image = state['absolute'](image)
+        derivatives = row['derivatives'] or {}
+        return {
+            'id': row['id'],
+            'image_url': file_url(name) if name else None,
+            'srcset': {
+                width: file_url(derivatives[width])
+                for width in sorted(derivatives, key=int)
+            },
+            'title': row['title'],
+            'image': image,
+            'uploaded_at': state['uploaded_at'](row['uploaded_at']) if row['uploaded_at'] is not None else None,
+        }
+
+class UploadPartSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = UploadPart
+        fields = ('number', 'size', 'etag')
+
+class UploadSessionSerializer(serializers.ModelSerializer):
+    parts = UploadPartSerializer(many=True, read_only=True)
+    uploaded_bytes = serializers.SerializerMethodField()
+    part_size = serializers.SerializerMethodField()
+    max_part_bytes = serializers.SerializerMethodField()
+    
+    class Meta:
+        model = UploadSession
+        fields = ('id', 'name', 'title', 'content_type', 'total_size', 'status',
+                  'image', 'part_size', 'max_part_bytes', 'uploaded_bytes', 'parts',
+                  'created_at', 'updated_at')
+        read_only_fields = fields
+    
+    def get_uploaded_bytes(self, obj):
+        return sum(part.size for part in obj.parts.all())
+    
+    def get_part_size(self, obj):
+        # Suggested size; S3 needs every part but the last to be >= 5 MiB
+        return settings.UPLOAD_SESSION_PART_SIZE
+    
+    def get_max_part_bytes(self, obj):
+        return settings.UPLOAD_SESSION_MAX_PART_BYTES
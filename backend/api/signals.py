@@ -0,0 +1,12 @@
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .caching import bump_model_version
+from .models import Image, Message
+
+
+@receiver([post_save, post_delete], sender=Message)
+@receiver([post_save, post_delete], sender=Image)
+def invalidate_cached_responses(sender, **kwargs):
+    """Drop every cached list/detail response of the changed model"""
+    bump_model_version(sender)
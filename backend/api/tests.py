@@ -1,3 +1,1779 @@
-from django.test import TestCase
+import fcntl
+import hashlib
+import hmac
+import importlib
+import os
+import shutil
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta, timezone as dt_timezone
+from io import BytesIO
+from unittest import mock
 
-# Create your tests here.
+import psycopg2
+from asgiref.sync import iscoroutinefunction, sync_to_async
+from botocore.exceptions import ClientError
+from botocore.response import StreamingBody
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.exceptions import MiddlewareNotUsed
+from django.core.files.base import ContentFile
+from django.core.files.storage import FileSystemStorage, default_storage
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import OperationalError
+from django.http import FileResponse, HttpResponse
+from django.test import AsyncRequestFactory, RequestFactory, SimpleTestCase, TestCase, override_settings
+from django.urls import clear_url_caches, resolve
+from django.utils import timezone
+from django.utils.http import http_date
+from PIL import Image as PILImage
+from psycopg2 import extensions as psycopg2_extensions
+from rest_framework.test import APIClient
+
+from db_backends.postgresql_pool.base import ConnectionPool
+from s3_client import get_s3_client, object_params
+
+from . import batch_uploads, bucket_inventory, db_routing, transforms, urls as api_urls
+from .async_views import serve_s3_image_async
+from .bucket_inventory import bucket_stats, iter_bucket, parse_page_params
+from .caching import bump_model_version
+from .checks import check_presigned_url_ttl
+from .delivery import presigned_image_url, url_cache_timeout
+from .direct_uploads import create_upload_policy, new_upload_name
+from .image_cache import DiskImageCache
+from .image_proxy import parse_range_header, resolve_ranges
+from .models import Image, Message, S3Object, UploadPart, UploadSession
+from .object_index import sync_index
+from .profiling import ProfilingMiddleware, get_profile, list_profiles, make_profile_token
+from .serializers import ImageSerializer, MessageSerializer
+from .upload_handlers import StreamedS3File
+from .upload_sessions import start_session
+
+
+def image_bytes(size=(400, 300), image_format='JPEG', mode='RGB', color=(200, 30, 30)):
+    """An encoded test image"""
+    buffer = BytesIO()
+    PILImage.new(mode, size, color).save(buffer, format=image_format)
+    return buffer.getvalue()
+
+
+class LocalMediaTestCase(TestCase):
+    """Stores uploads in a temporary MEDIA_ROOT (local file storage)"""
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root, ignore_errors=True)
+        overrides = override_settings(MEDIA_ROOT=self.media_root, S3_STREAMING_UPLOADS=False)
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+
+
+class FakeS3:
+    """
+    In-memory stand-in for the S3 client calls of the image proxy: ranged
+    and conditional GetObject/HeadObject, answered the way S3 answers them
+    """
+    def __init__(self, objects=None):
+        self.objects = dict(objects or {})
+        self.last_modified = datetime(2024, 1, 1, tzinfo=dt_timezone.utc)
+
+    def _etag(self, data):
+        return '"%s"' % hashlib.md5(data).hexdigest()
+
+    def _lookup(self, Key, IfNoneMatch=None, IfMatch=None, **kwargs):
+        if Key not in self.objects:
+            raise ClientError({'Error': {'Code': 'NoSuchKey'},
+                               'ResponseMetadata': {'HTTPStatusCode': 404}}, 'GetObject')
+        data = self.objects[Key]
+        etag = self._etag(data)
+        if IfNoneMatch is not None and IfNoneMatch == etag:
+            raise ClientError({'Error': {'Code': '304'}, 'ResponseMetadata': {
+                'HTTPStatusCode': 304, 'HTTPHeaders': {'etag': etag}}}, 'GetObject')
+        if IfMatch is not None and IfMatch != etag:
+            raise ClientError({'Error': {'Code': 'PreconditionFailed'},
+                               'ResponseMetadata': {'HTTPStatusCode': 412}}, 'GetObject')
+        return data, {'ETag': etag, 'LastModified': self.last_modified, 'ContentType': 'image/png'}
+
+    def head_object(self, Bucket, Key, **kwargs):
+        data, meta = self._lookup(Key, **kwargs)
+        return {**meta, 'ContentLength': len(data)}
+
+    def get_object(self, Bucket, Key, Range=None, **kwargs):
+        data, meta = self._lookup(Key, **kwargs)
+        response = dict(meta)
+        if Range is not None:
+            ranges = resolve_ranges(parse_range_header(Range), len(data))
+            if not ranges:
+                raise ClientError({'Error': {'Code': 'InvalidRange', 'ActualObjectSize': str(len(data))},
+                                   'ResponseMetadata': {'HTTPStatusCode': 416}}, 'GetObject')
+            start, end = ranges[0]
+            response['ContentRange'] = 'bytes %d-%d/%d' % (start, end, len(data))
+            data = data[start:end + 1]
+        response['ContentLength'] = len(data)
+        response['Body'] = StreamingBody(BytesIO(data), len(data))
+        return response
+
+
+
+class AsyncBody:
+    """aiobotocore-style streaming body"""
+    def __init__(self, data):
+        self.data = data
+        self.closed = False
+
+    async def iter_chunks(self, chunk_size):
+        for start in range(0, len(self.data), chunk_size):
+            yield self.data[start:start + chunk_size]
+
+    def close(self):
+        self.closed = True
+
+
+class AsyncFakeS3:
+    """FakeS3 behind the coroutine API of an aiobotocore client"""
+    def __init__(self, s3):
+        self.s3 = s3
+
+    async def head_object(self, **params):
+        return self.s3.head_object(**params)
+
+    async def get_object(self, **params):
+        response = self.s3.get_object(**params)
+        response['Body'] = AsyncBody(response['Body'].read())
+        return response
+
+
+async def aread(response):
+    """The body of an async streaming response"""
+    return b''.join([chunk async for chunk in response.streaming_content])
+
+@override_settings(AWS_STORAGE_BUCKET_NAME='test-bucket', S3_STREAMING_UPLOADS=True)
+class StreamingUploadTests(TestCase):
+    def setUp(self):
+        self.s3 = mock.Mock()
+        self.s3.create_multipart_upload.return_value = {'UploadId': 'upload-1'}
+        patcher = mock.patch('api.upload_handlers.get_s3_client', return_value=self.s3)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_empty_file_is_rejected(self):
+        response = APIClient().post('/api/images/', {
+            'title': 'empty',
+            'image': SimpleUploadedFile('empty.jpg', b'', content_type='image/jpeg'),
+        }, format='multipart')
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json()['image'], ['The submitted file is empty.'])
+        self.s3.abort_multipart_upload.assert_called_once()
+        self.s3.complete_multipart_upload.assert_not_called()
+        self.assertFalse(Image.objects.exists())
+
+
+    def test_long_file_name_is_shortened(self):
+        self.s3.upload_part.return_value = {'ETag': '"part-1"'}
+        with tempfile.TemporaryDirectory() as media_root, override_settings(MEDIA_ROOT=media_root):
+            response = APIClient().post('/api/images/', {
+                'title': 'long',
+                'image': SimpleUploadedFile('p' * 120 + '.jpg', image_bytes(), content_type='image/jpeg'),
+            }, format='multipart')
+
+        self.assertEqual(response.status_code, 201)
+        name = Image.objects.get().image.name
+        self.assertLessEqual(len(name), Image._meta.get_field('image').max_length)
+        self.assertEqual(self.s3.create_multipart_upload.call_args.kwargs['Key'], name)
+
+    def test_staged_object_is_copied_to_a_shortened_name(self):
+        # The module reads the S3 settings at import time
+        with override_settings(AWS_S3_REGION_NAME='us-east-1', AWS_S3_FILE_OVERWRITE=False, AWS_DEFAULT_ACL=None,
+                               AWS_LOCATION='', AWS_S3_CUSTOM_DOMAIN=None):
+            from storage_backends import StreamedUploadMixin
+
+        class StagedStorage(StreamedUploadMixin, FileSystemStorage):
+            bucket_name = 'test-bucket'
+            default_acl = None
+
+        staged_name = 'images/' + 'p' * 120 + '.jpg'
+        content = StreamedS3File(BytesIO(b'head'), staged_name, 'image/jpeg', 4, None)
+        with tempfile.TemporaryDirectory() as location, \
+                mock.patch('storage_backends.get_s3_client', return_value=self.s3):
+            name = StagedStorage(location=location).save(staged_name, content, max_length=100)
+
+        self.assertLessEqual(len(name), 100)
+        self.assertEqual(self.s3.copy.call_args.args[2], name)
+        self.s3.delete_object.assert_called_with(Bucket='test-bucket', Key=staged_name)
+        self.assertTrue(content.committed)
+
+@override_settings(IMAGE_DERIVATIVE_WIDTHS=[160])
+class DerivativeTests(LocalMediaTestCase):
+    def test_truncated_image_is_stored_without_derivatives(self):
+        # Noise so the scan data is long enough to cut in half
+        buffer = BytesIO()
+        PILImage.effect_noise((400, 300), 64).convert('RGB').save(buffer, format='JPEG')
+        data = buffer.getvalue()
+
+        response = APIClient().post('/api/images/', {
+            'title': 'truncated',
+            'image': SimpleUploadedFile('truncated.jpg', data[:len(data) // 2], content_type='image/jpeg'),
+        }, format='multipart')
+
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.json()['srcset'], {})
+        self.assertEqual(Image.objects.get().derivatives, {})
+
+    def test_derivatives_are_generated(self):
+        response = APIClient().post('/api/images/', {
+            'image': SimpleUploadedFile('photo.jpg', image_bytes(), content_type='image/jpeg'),
+        }, format='multipart')
+
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(list(Image.objects.get().derivatives), ['160'])
+
+
+@override_settings(AWS_STORAGE_BUCKET_NAME='test-bucket', AWS_LOCATION='')
+class IndexReconcileTests(TestCase):
+    def setUp(self):
+        import fix_broken_s3_links
+        self.script = fix_broken_s3_links
+        self.s3 = mock.Mock()
+        self.s3.head_object.side_effect = ClientError({'Error': {'Code': '404'}}, 'HeadObject')
+        patcher = mock.patch.object(fix_broken_s3_links, 'get_s3_client', return_value=self.s3)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _image(self, name, age):
+        image = Image.objects.create(title=name, image=name)
+        Image.objects.filter(pk=image.pk).update(uploaded_at=timezone.now() - age)
+        return image
+
+    def test_recent_records_are_not_broken(self):
+        self._image('images/new.jpg', timedelta(minutes=5))
+
+        report = self.script.reconcile_from_index()
+
+        self.assertEqual(report['broken'], [])
+        self.s3.head_object.assert_not_called()
+
+    def test_unindexed_objects_found_in_s3_are_not_broken(self):
+        missing = self._image('images/missing.jpg', timedelta(days=1))
+        self._image('images/unindexed.jpg', timedelta(days=1))
+        S3Object.objects.create(key='images/indexed.jpg', size=1,
+                                last_modified=timezone.now(), synced_at=timezone.now())
+        self._image('images/indexed.jpg', timedelta(days=1))
+
+        def head_object(Bucket, Key):
+            if Key == 'images/unindexed.jpg':
+                return {'ContentLength': 10, 'ContentType': 'image/jpeg', 'ETag': '"e"'}
+            raise ClientError({'Error': {'Code': '404'}}, 'HeadObject')
+        self.s3.head_object.side_effect = head_object
+
+        report = self.script.reconcile_from_index()
+
+        self.assertEqual([img['id'] for img in report['broken']], [missing.pk])
+        self.assertEqual(self.s3.head_object.call_count, 2)
+        self.assertTrue(S3Object.objects.filter(key='images/unindexed.jpg', size=10).exists())
+
+
+@override_settings(AWS_STORAGE_BUCKET_NAME='test-bucket', AWS_LOCATION='')
+class MigrateToS3Tests(LocalMediaTestCase):
+    def setUp(self):
+        super().setUp()
+        import migrate_to_s3
+        self.script = migrate_to_s3
+        self.s3 = mock.Mock()
+        self.s3.head_object.side_effect = ClientError({'Error': {'Code': '404'}}, 'HeadObject')
+        self.storage = Image._meta.get_field('image').storage
+        self.storage.save('images/photo.jpg', ContentFile(image_bytes()))
+
+    def test_uploaded_files_are_indexed(self):
+        name, sent = self.script.upload_file(self.s3, self.storage, 'images/photo.jpg')
+
+        self.assertEqual(name, 'images/photo.jpg')
+        self.s3.upload_file.assert_called_once()
+        indexed = S3Object.objects.get(key='images/photo.jpg')
+        self.assertEqual(indexed.size, sent)
+        self.assertEqual(indexed.content_type, 'image/jpeg')
+
+    def test_files_already_in_s3_are_indexed(self):
+        size = self.storage.size('images/photo.jpg')
+        self.s3.head_object.side_effect = None
+        self.s3.head_object.return_value = {'ContentLength': size, 'ETag': '"abc"'}
+
+        self.assertEqual(self.script.upload_file(self.s3, self.storage, 'images/photo.jpg'),
+                         ('images/photo.jpg', 0))
+        self.s3.upload_file.assert_not_called()
+        self.assertEqual(S3Object.objects.get(key='images/photo.jpg').etag, '"abc"')
+
+    @override_settings(API_CACHE_ENABLED=True)
+    def test_renamed_files_invalidate_cached_lists(self):
+        Image.objects.create(image='images/photo.jpg')
+        # A different object already holds the name in S3
+        self.s3.head_object.side_effect = lambda Bucket, Key: (
+            {'ContentLength': 1} if Key == 'images/photo.jpg' else mock.DEFAULT
+        )
+        self.s3.head_object.return_value = None
+        cache.clear()
+        client = APIClient()
+        client.get('/api/images/')
+
+        with mock.patch.object(self.script, 'get_s3_client', return_value=self.s3):
+            self.script.migrate_images_to_s3(workers=1, checkpoint_path=os.path.join(self.media_root, 'checkpoint'))
+
+        response = client.get('/api/images/')
+        self.assertEqual(response['X-Cache'], 'MISS')
+        renamed = Image.objects.get().image.name
+        self.assertNotEqual(renamed, 'images/photo.jpg')
+        self.assertTrue(response.json()['results'][0]['image_url'].endswith(renamed))
+
+
+
+@override_settings(AWS_STORAGE_BUCKET_NAME='test-bucket', AWS_LOCATION='', S3_IMAGE_CACHE_DIR='')
+class ImageProxyTests(TestCase):
+    data = bytes(range(256)) * 4
+
+    def setUp(self):
+        self.s3 = FakeS3({'images/a.png': self.data})
+        patcher = mock.patch('api.views.get_s3_client', return_value=self.s3)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def get(self, **headers):
+        return APIClient().get('/api/s3-image/images/a.png', **headers)
+
+    def test_full_response(self):
+        response = self.get()
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b''.join(response.streaming_content), self.data)
+        self.assertEqual(response['Accept-Ranges'], 'bytes')
+
+    def test_single_range(self):
+        response = self.get(HTTP_RANGE='bytes=10-19')
+
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response['Content-Range'], 'bytes 10-19/1024')
+        self.assertEqual(response['Content-Length'], '10')
+        self.assertEqual(b''.join(response.streaming_content), self.data[10:20])
+
+    def test_suffix_range(self):
+        response = self.get(HTTP_RANGE='bytes=-100')
+
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response['Content-Range'], 'bytes 924-1023/1024')
+        self.assertEqual(b''.join(response.streaming_content), self.data[-100:])
+
+    def test_multiple_ranges(self):
+        response = self.get(HTTP_RANGE='bytes=0-9, 100-109')
+
+        self.assertEqual(response.status_code, 206)
+        content_type, _, boundary = response['Content-Type'].partition('; boundary=')
+        self.assertEqual(content_type, 'multipart/byteranges')
+        body = b''.join(response.streaming_content)
+        self.assertEqual(int(response['Content-Length']), len(body))
+        self.assertEqual(body, (
+            b'\r\n--%(b)s\r\nContent-Type: image/png\r\nContent-Range: bytes 0-9/1024\r\n\r\n%(one)s'
+            b'\r\n--%(b)s\r\nContent-Type: image/png\r\nContent-Range: bytes 100-109/1024\r\n\r\n%(two)s'
+            b'\r\n--%(b)s--\r\n'
+        ) % {b'b': boundary.encode(), b'one': self.data[0:10], b'two': self.data[100:110]})
+
+    def test_unsatisfiable_range(self):
+        response = self.get(HTTP_RANGE='bytes=5000-6000')
+
+        self.assertEqual(response.status_code, 416)
+        self.assertEqual(response['Content-Range'], 'bytes */1024')
+
+    def test_unsatisfiable_multiple_ranges(self):
+        response = self.get(HTTP_RANGE='bytes=5000-6000, 7000-')
+
+        self.assertEqual(response.status_code, 416)
+        self.assertEqual(response['Content-Range'], 'bytes */1024')
+
+    def test_if_none_match(self):
+        etag = self.get()['ETag']
+
+        response = self.get(HTTP_IF_NONE_MATCH=etag)
+
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], etag)
+
+    def test_overlapping_and_adjacent_ranges_are_coalesced(self):
+        with mock.patch.object(self.s3, 'get_object', wraps=self.s3.get_object) as get_object:
+            response = self.get(HTTP_RANGE='bytes=100-109, 0-9, 5-19, 20-29')
+            body = b''.join(response.streaming_content)
+
+        self.assertEqual(response.status_code, 206)
+        self.assertIn('Content-Range: bytes 0-29/1024', body.decode('latin-1'))
+        self.assertIn('Content-Range: bytes 100-109/1024', body.decode('latin-1'))
+        self.assertEqual(get_object.call_count, 2)
+
+    @override_settings(S3_PROXY_MAX_RANGES=3)
+    def test_too_many_ranges_get_the_whole_object(self):
+        with mock.patch.object(self.s3, 'get_object', wraps=self.s3.get_object) as get_object:
+            response = self.get(HTTP_RANGE='bytes=0-0,2-2,4-4,6-6')
+            body = b''.join(response.streaming_content)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(body, self.data)
+        self.assertEqual(get_object.call_count, 1)
+
+    def test_if_range(self):
+        etag = self.s3._etag(self.data)
+        response = self.get(HTTP_RANGE='bytes=10-19', HTTP_IF_RANGE=etag)
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(b''.join(response.streaming_content), self.data[10:20])
+
+        response = self.get(HTTP_RANGE='bytes=10-19', HTTP_IF_RANGE=http_date(self.s3.last_modified.timestamp()))
+        self.assertEqual(response.status_code, 206)
+
+        for stale in ('"other"', 'W/' + etag, http_date(self.s3.last_modified.timestamp() - 60)):
+            with self.subTest(if_range=stale):
+                response = self.get(HTTP_RANGE='bytes=10-19', HTTP_IF_RANGE=stale)
+                self.assertEqual(response.status_code, 200)
+                self.assertEqual(b''.join(response.streaming_content), self.data)
+
+    async def test_if_range_async(self):
+        def get(**headers):
+            request = AsyncRequestFactory().get('/api/s3-image/images/a.png', headers=headers)
+            return serve_s3_image_async(request, 'images/a.png')
+
+        with mock.patch('api.async_views.get_async_s3_client', return_value=AsyncFakeS3(self.s3)):
+            response = await get(Range='bytes=0-9, 5-19', **{'If-Range': self.s3._etag(self.data)})
+            self.assertEqual(response.status_code, 206)
+            self.assertEqual(response['Content-Range'], 'bytes 0-19/1024')
+            self.assertEqual(await aread(response), self.data[:20])
+
+            response = await get(Range='bytes=0-9', **{'If-Range': '"other"'})
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(await aread(response), self.data)
+
+    def test_head(self):
+        response = APIClient().head('/api/s3-image/images/a.png')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Length'], '1024')
+        self.assertEqual(response['ETag'], self.s3._etag(self.data))
+        self.assertEqual(response.content, b'')
+        self.assertEqual(APIClient().head('/api/s3-image/images/missing.png').status_code, 404)
+
+    async def test_head_async(self):
+        request = AsyncRequestFactory().head('/api/s3-image/images/a.png')
+        with mock.patch('api.async_views.get_async_s3_client', return_value=AsyncFakeS3(self.s3)):
+            response = await serve_s3_image_async(request, 'images/a.png')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Length'], '1024')
+        self.assertEqual(response['ETag'], self.s3._etag(self.data))
+        self.assertEqual(response.content, b'')
+
+    def test_parse_range_header(self):
+        self.assertEqual(parse_range_header('bytes=0-9,-5, 7-'), [(0, 9), (None, 5), (7, None)])
+        self.assertIsNone(parse_range_header('items=0-9'))
+        self.assertIsNone(parse_range_header('bytes=9-0'))
+        self.assertIsNone(parse_range_header('bytes=-'))
+
+
+@override_settings(AWS_STORAGE_BUCKET_NAME='test-bucket', AWS_LOCATION='')
+class UploadSessionTests(TestCase):
+    def setUp(self):
+        self.s3 = mock.Mock()
+        self.s3.create_multipart_upload.return_value = {'UploadId': 'upload-1'}
+        self.s3.upload_part.side_effect = lambda **params: {'ETag': '"part-%d"' % params['PartNumber']}
+        self.s3.complete_multipart_upload.return_value = {'ETag': '"whole"'}
+        for target in ('api.upload_sessions.get_s3_client', 'api.direct_uploads.get_s3_client'):
+            patcher = mock.patch(target, return_value=self.s3)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        # The assembled object is only in the (stubbed) bucket: skip reading it back
+        patcher = mock.patch('api.upload_sessions.image_from_upload',
+                             side_effect=lambda name, title: Image(title=title or '', image=name))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.client = APIClient()
+
+    def start(self):
+        response = self.client.post('/api/upload-sessions/', {
+            'filename': 'photo.jpg', 'content_type': 'image/jpeg', 'title': 'Photo'
+        }, format='json')
+        self.assertEqual(response.status_code, 201)
+        return response.json()['id']
+
+    def put_part(self, session_id, number, body=b'data'):
+        return self.client.put(f'/api/upload-sessions/{session_id}/parts/{number}/',
+                               body, content_type='application/octet-stream')
+
+    def complete(self, session_id):
+        return self.client.post(f'/api/upload-sessions/{session_id}/complete/')
+
+    def test_resume_after_missing_parts(self):
+        session_id = self.start()
+        self.put_part(session_id, 1)
+        self.put_part(session_id, 3)
+
+        session = self.client.get(f'/api/upload-sessions/{session_id}/').json()
+        self.assertEqual([part['number'] for part in session['parts']], [1, 3])
+        response = self.complete(session_id)
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json()['error'], 'Missing parts: 2')
+        self.assertEqual(UploadSession.objects.get(pk=session_id).status, UploadSession.ACTIVE)
+
+        self.assertEqual(self.put_part(session_id, 2).status_code, 200)
+        response = self.complete(session_id)
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(
+            self.s3.complete_multipart_upload.call_args.kwargs['MultipartUpload']['Parts'],
+            [{'PartNumber': n, 'ETag': '"part-%d"' % n} for n in (1, 2, 3)]
+        )
+
+    def test_complete_twice_returns_the_same_image(self):
+        session_id = self.start()
+        self.put_part(session_id, 1)
+
+        first = self.complete(session_id)
+        second = self.complete(session_id)
+
+        self.assertEqual(first.status_code, 201)
+        self.assertEqual(second.status_code, 200)
+        self.assertEqual(first.json()['id'], second.json()['id'])
+        self.assertEqual(Image.objects.count(), 1)
+        self.s3.complete_multipart_upload.assert_called_once()
+
+    def test_long_file_name(self):
+        response = self.client.post('/api/upload-sessions/', {
+            'filename': 'a' * 64 + '.jpg', 'content_type': 'image/jpeg'
+        }, format='json')
+        session_id = response.json()['id']
+        self.put_part(session_id, 1)
+
+        self.assertEqual(self.complete(session_id).status_code, 201)
+        name = Image.objects.get().image.name
+        self.assertLessEqual(len(name), Image._meta.get_field('image').max_length)
+        self.assertEqual(self.s3.complete_multipart_upload.call_args.kwargs['Key'], name)
+
+    def test_upload_after_abort_is_rejected(self):
+        session_id = self.start()
+        self.put_part(session_id, 1)
+
+        self.assertEqual(self.client.delete(f'/api/upload-sessions/{session_id}/').status_code, 204)
+        response = self.put_part(session_id, 2)
+
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(self.s3.upload_part.call_count, 1)
+        self.s3.abort_multipart_upload.assert_called_once()
+        self.assertEqual(self.complete(session_id).status_code, 409)
+
+    def test_cleanup_aborts_expired_sessions(self):
+        from cleanup_upload_sessions import cleanup_upload_sessions
+        expired = self.start()
+        fresh = self.start()
+        self.put_part(expired, 1)
+        UploadSession.objects.filter(pk=expired).update(updated_at=timezone.now() - timedelta(hours=25))
+
+        cleanup_upload_sessions(24, dry_run=False)
+
+        self.assertEqual(UploadSession.objects.get(pk=expired).status, UploadSession.ABORTED)
+        self.assertFalse(UploadPart.objects.filter(session_id=expired).exists())
+        self.assertEqual(UploadSession.objects.get(pk=fresh).status, UploadSession.ACTIVE)
+        self.s3.abort_multipart_upload.assert_called_once_with(
+            Bucket='test-bucket', Key=UploadSession.objects.get(pk=expired).name, UploadId='upload-1'
+        )
+
+
+@override_settings(API_CACHE_ENABLED=True)
+class ResponseCacheTests(LocalMediaTestCase):
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        self.client = APIClient()
+
+    def get(self, url):
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return response
+
+    def assertFresh(self, url):
+        """``url`` is a cache miss now, then served from the cache"""
+        response = self.get(url)
+        self.assertEqual(response['X-Cache'], 'MISS')
+        self.assertEqual(self.get(url)['X-Cache'], 'HIT')
+        return response.json()
+
+    def test_create_invalidates_list(self):
+        self.assertFresh('/api/messages/')
+
+        self.client.post('/api/messages/', {'body': 'new'}, format='json')
+
+        self.assertEqual([m['body'] for m in self.assertFresh('/api/messages/')['results']], ['new'])
+
+    def test_update_invalidates_list_and_detail(self):
+        message = Message.objects.create(body='old')
+        self.assertFresh('/api/messages/')
+        self.assertFresh(f'/api/messages/{message.pk}/')
+
+        self.client.patch(f'/api/messages/{message.pk}/', {'body': 'edited'}, format='json')
+
+        self.assertEqual(self.assertFresh(f'/api/messages/{message.pk}/')['body'], 'edited')
+        self.assertEqual(self.assertFresh('/api/messages/')['results'][0]['body'], 'edited')
+
+    def test_delete_invalidates_list(self):
+        message = Message.objects.create(body='gone')
+        self.assertFresh('/api/messages/')
+
+        self.client.delete(f'/api/messages/{message.pk}/')
+
+        self.assertEqual(self.assertFresh('/api/messages/')['results'], [])
+
+    def test_message_bulk_create_invalidates_list(self):
+        self.assertFresh('/api/messages/')
+
+        response = self.client.post('/api/messages/bulk/', [{'body': 'a'}, {'body': 'b'}], format='json')
+
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(len(self.assertFresh('/api/messages/')['results']), 2)
+
+    def test_image_batch_upload_invalidates_list(self):
+        self.assertFresh('/api/images/')
+
+        response = self.client.post('/api/images/batch/', {
+            'images': [SimpleUploadedFile(f'{n}.png', image_bytes(image_format='PNG'), content_type='image/png')
+                       for n in range(2)],
+        }, format='multipart')
+
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(len(self.assertFresh('/api/images/')['results']), 2)
+
+    def test_queryset_update_needs_an_explicit_bump(self):
+        # QuerySet.update() sends no post_save: writers must bump the version
+        message = Message.objects.create(body='old')
+        self.assertFresh(f'/api/messages/{message.pk}/')
+
+        Message.objects.filter(pk=message.pk).update(body='edited')
+        self.assertEqual(self.get(f'/api/messages/{message.pk}/').json()['body'], 'old')
+        bump_model_version(Message)
+
+        self.assertEqual(self.assertFresh(f'/api/messages/{message.pk}/')['body'], 'edited')
+
+
+class ImageBatchTests(LocalMediaTestCase):
+    url = '/api/images/batch/'
+
+    def stored_files(self):
+        return sorted(
+            os.path.relpath(os.path.join(root, name), self.media_root)
+            for root, _, names in os.walk(self.media_root) for name in names
+        )
+
+    def png(self, name):
+        return SimpleUploadedFile(name, image_bytes(image_format='PNG'), content_type='image/png')
+
+    def test_creates_images_with_titles(self):
+        response = APIClient().post(self.url, {
+            'images': [self.png('a.png'), self.png('b.png')], 'titles': ['first'],
+        }, format='multipart')
+
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual([image['title'] for image in response.json()], ['first', ''])
+        self.assertTrue(all(image['srcset'] for image in response.json()))
+
+    def test_invalid_files_save_nothing(self):
+        response = APIClient().post(self.url, {
+            'images': [self.png('a.png'), SimpleUploadedFile('b.png', b'not an image', content_type='image/png')],
+        }, format='multipart')
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual([error['index'] for error in response.json()['errors']], [1])
+        self.assertFalse(Image.objects.exists())
+        self.assertEqual(self.stored_files(), [])
+
+    @override_settings(IMAGE_BATCH_MAX_FILES=1)
+    def test_too_many_files(self):
+        response = APIClient().post(self.url, {'images': [self.png('a.png'), self.png('b.png')]}, format='multipart')
+
+        self.assertEqual(response.status_code, 413)
+
+    def test_failed_file_removes_the_stored_ones(self):
+        real = batch_uploads.generate_derivatives
+
+        def generate(field, source):
+            if 'broken' in field.name:
+                raise OSError('storage failed')
+            return real(field, source)
+
+        with mock.patch('api.batch_uploads.generate_derivatives', side_effect=generate):
+            with self.assertRaises(OSError), self.assertLogs('django.request', 'ERROR'):
+                APIClient().post(self.url, {
+                    'images': [self.png('a.png'), self.png('broken.png'), self.png('c.png')],
+                }, format='multipart')
+
+        self.assertFalse(Image.objects.exists())
+        self.assertEqual(self.stored_files(), [])
+
+
+class MessageBulkTests(TestCase):
+    url = '/api/messages/bulk/'
+
+    def post_ndjson(self, body):
+        return APIClient().post(self.url, body, content_type='application/x-ndjson')
+
+    def test_json_array(self):
+        response = APIClient().post(self.url, [{'body': 'a'}, {'body': 'b'}], format='json')
+
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.json()['created'], 2)
+        self.assertEqual(
+            list(Message.objects.filter(pk__in=response.json()['ids']).values_list('body', flat=True).order_by('pk')),
+            ['a', 'b']
+        )
+
+    def test_ndjson(self):
+        response = self.post_ndjson('{"body": "a"}\n\n{"body": "b"}\n')
+
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.json()['created'], 2)
+
+    def test_malformed_ndjson_line(self):
+        response = self.post_ndjson('{"body": "a"}\n{"body": \n')
+
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('line 2', response.json()['detail'])
+        self.assertFalse(Message.objects.exists())
+
+    def test_per_item_errors_save_nothing(self):
+        response = APIClient().post(self.url, [{'body': 'a'}, {}, {'body': 'c'}, {'body': ''}], format='json')
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual([error['index'] for error in response.json()['errors']], [1, 3])
+        self.assertIn('body', response.json()['errors'][0]['errors'])
+        self.assertFalse(Message.objects.exists())
+
+    def test_expects_a_list(self):
+        response = APIClient().post(self.url, {'body': 'a'}, format='json')
+
+        self.assertEqual(response.status_code, 400)
+
+    @override_settings(MESSAGE_BULK_MAX_ITEMS=2)
+    def test_too_many_items(self):
+        self.assertEqual(self.post_ndjson('{"body": "a"}\n' * 2).status_code, 201)
+        self.assertEqual(self.post_ndjson('{"body": "a"}\n' * 3).status_code, 413)
+        self.assertEqual(Message.objects.count(), 2)
+
+    @override_settings(DATA_UPLOAD_MAX_MEMORY_SIZE=100)
+    def test_body_too_large(self):
+        items = [{'body': 'x' * 20}] * 5
+
+        self.assertEqual(APIClient().post(self.url, items, format='json').status_code, 413)
+        self.assertEqual(self.post_ndjson('{"body": "xxxxxxxxxxxxxxxxxxxx"}\n' * 5).status_code, 413)
+        self.assertEqual(self.post_ndjson('{"body": "a"}\n').status_code, 201)
+        self.assertEqual(Message.objects.count(), 1)
+
+
+@override_settings(
+    AWS_STORAGE_BUCKET_NAME='test-bucket', AWS_LOCATION='', S3_IMAGE_DELIVERY='presigned',
+    S3_PRESIGNED_URL_TTL=900, S3_PRESIGNED_URL_REFRESH_MARGIN=60,
+    API_CACHE_ENABLED=False, API_CACHE_TIMEOUT=300,
+)
+class PresignedDeliveryTests(LocalMediaTestCase):
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        self.presign = mock.Mock()
+        self.presign.generate_presigned_url.side_effect = lambda op, Params, ExpiresIn: (
+            f"https://s3.example/{Params['Key']}?signature={self.presign.generate_presigned_url.call_count}"
+        )
+        patcher = mock.patch('api.delivery.get_presign_client', return_value=self.presign)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_proxy_endpoint_redirects(self):
+        response = APIClient().get('/api/s3-image/images/a.png')
+
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(response['Location'], 'https://s3.example/images/a.png?signature=1')
+        self.presign.generate_presigned_url.assert_called_once_with(
+            'get_object', Params={'Bucket': 'test-bucket', 'Key': 'images/a.png'}, ExpiresIn=900
+        )
+
+    def test_image_urls_are_presigned(self):
+        Image.objects.create(title='a', image='images/a.png', derivatives={'480': 'images/derivatives/a-480.webp'})
+
+        image, = APIClient().get('/api/images/').json()['results']
+        self.assertEqual(image['image_url'], 'https://s3.example/images/a.png?signature=1')
+        self.assertEqual(image['srcset'], {'480': 'https://s3.example/images/derivatives/a-480.webp?signature=2'})
+
+    def test_urls_are_cached_for_the_reuse_window(self):
+        with mock.patch('api.delivery.cache', wraps=cache) as url_cache:
+            first = presigned_image_url('images/a.png')
+            self.assertEqual(presigned_image_url('images/a.png'), first)
+
+        self.assertEqual(self.presign.generate_presigned_url.call_count, 1)
+        # TTL minus the refresh margin
+        self.assertEqual(url_cache.set.call_args.args[2], 840)
+
+    @override_settings(API_CACHE_ENABLED=True)
+    def test_reuse_window_leaves_room_for_cached_responses(self):
+        # Cached responses live up to the margin in presigned mode
+        self.assertEqual(url_cache_timeout(), 900 - 60 - 60)
+
+    def test_ttl_check(self):
+        self.assertEqual(check_presigned_url_ttl(None), [])
+        with override_settings(S3_PRESIGNED_URL_TTL=100, API_CACHE_ENABLED=True):
+            self.assertEqual([e.id for e in check_presigned_url_ttl(None)], ['api.E001'])
+            # Cached URLs are still kept for a second
+            self.assertEqual(url_cache_timeout(), 1)
+            with override_settings(S3_IMAGE_DELIVERY='proxy'):
+                self.assertEqual(check_presigned_url_ttl(None), [])
+
+    @override_settings(AWS_STORAGE_BUCKET_NAME=None)
+    def test_falls_back_to_the_proxy_without_a_bucket(self):
+        Image.objects.create(title='a', image='images/a.png')
+
+        image, = APIClient().get('/api/images/').json()['results']
+        self.assertEqual(image['image_url'], 'http://testserver/api/s3-image/images/a.png')
+        self.presign.generate_presigned_url.assert_not_called()
+
+    @override_settings(S3_IMAGE_DELIVERY='proxy', S3_IMAGE_CACHE_DIR='')
+    def test_proxy_mode_streams_the_image(self):
+        with mock.patch('api.views.get_s3_client', return_value=FakeS3({'images/a.png': b'png'})):
+            response = APIClient().get('/api/s3-image/images/a.png')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b''.join(response.streaming_content), b'png')
+        self.presign.generate_presigned_url.assert_not_called()
+
+
+S3_SETTINGS = {
+    'AWS_STORAGE_BUCKET_NAME': 'test-bucket',
+    'AWS_ACCESS_KEY_ID': 'test',
+    'AWS_SECRET_ACCESS_KEY': 'test',
+    'AWS_S3_ENDPOINT_URL': 'http://localhost:4566',
+    'AWS_S3_REGION_NAME': 'us-east-1',
+    'AWS_S3_VERIFY': False,
+    'AWS_S3_USE_SSL': False,
+    'AWS_S3_FILE_OVERWRITE': False,
+    'AWS_DEFAULT_ACL': None,
+    'AWS_LOCATION': '',
+    'AWS_S3_CUSTOM_DOMAIN': None,
+}
+
+
+@override_settings(**S3_SETTINGS)
+class S3StorageTests(TestCase):
+    def test_each_thread_gets_its_own_bucket_on_the_shared_client(self):
+        from storage_backends import LocalStackS3Storage
+        storage = LocalStackS3Storage()
+        buckets = []
+
+        def use_storage():
+            buckets.append(storage.bucket)
+            # Reused within the thread
+            buckets.append(storage.bucket)
+
+        for _ in range(2):
+            thread = threading.Thread(target=use_storage)
+            thread.start()
+            thread.join()
+
+        self.assertIs(buckets[0], buckets[1])
+        self.assertIs(buckets[2], buckets[3])
+        self.assertIsNot(buckets[0], buckets[2])
+        self.assertIs(buckets[0].meta.client, get_s3_client())
+        self.assertIs(buckets[2].meta.client, get_s3_client())
+        self.assertEqual(buckets[0].name, 'test-bucket')
+
+
+@override_settings(DATABASE_REPLICAS=['replica1', 'replica2'], DB_REPLICA_CHECK_INTERVAL=60)
+class ReplicaRoutingTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        db_routing._healthy = []
+        db_routing._checked_at = None
+        self.addCleanup(setattr, db_routing, '_checked_at', None)
+        self.connections = {alias: mock.Mock() for alias in ('default', 'replica1', 'replica2')}
+        patcher = mock.patch.object(db_routing, 'connections', self.connections)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch.object(db_routing, 'replica_lag', return_value=0)
+        self.replica_lag = patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.router = db_routing.ReplicaRouter()
+        self.reads = []
+
+        def view(request):
+            self.reads.append(self.router.db_for_read(Message))
+            return HttpResponse()
+        self.middleware = db_routing.replica_routing_middleware(view)
+
+    def request(self, method):
+        self.middleware(RequestFactory().generic(method, '/api/messages/', REMOTE_ADDR='10.0.0.1'))
+        return self.reads[-1]
+
+    def test_safe_requests_read_from_a_replica(self):
+        self.assertIn(self.request('GET'), ('replica1', 'replica2'))
+
+    def test_unsafe_requests_read_from_the_primary(self):
+        self.assertEqual(self.request('POST'), 'default')
+
+    def test_client_reads_its_own_writes_from_the_primary(self):
+        self.request('POST')
+        self.assertEqual(self.request('GET'), 'default')
+
+        cache.clear()
+        self.assertIn(self.request('GET'), ('replica1', 'replica2'))
+
+    def test_all_replicas_down_reads_from_the_primary(self):
+        self.replica_lag.side_effect = OperationalError('connection refused')
+        self.assertEqual(self.request('GET'), 'default')
+
+    def test_replica_failing_between_checks_is_skipped(self):
+        self.assertIn(self.request('GET'), ('replica1', 'replica2'))
+        self.connections['replica1'].ensure_connection.side_effect = OperationalError('connection refused')
+
+        self.assertEqual({self.request('GET') for _ in range(10)}, {'replica2'})
+        self.assertEqual(db_routing.healthy_replicas(), ['replica2'])
+
+        self.connections['replica2'].ensure_connection.side_effect = OperationalError('connection refused')
+        self.assertEqual(self.request('GET'), 'default')
+        self.assertEqual(self.replica_lag.call_count, 2)
+
+
+class FakeConnection:
+    """The parts of a psycopg2 connection ConnectionPool uses"""
+    def __init__(self, status=psycopg2_extensions.TRANSACTION_STATUS_IDLE):
+        self.closed = 0
+        self.info = mock.Mock(transaction_status=status)
+        self.rollback_error = None
+
+    def rollback(self):
+        if self.rollback_error is not None:
+            raise self.rollback_error
+        self.info.transaction_status = psycopg2_extensions.TRANSACTION_STATUS_IDLE
+
+    def close(self):
+        self.closed = 1
+
+
+class ConnectionPoolTests(SimpleTestCase):
+    def make_pool(self, **kwargs):
+        self.opened = []
+
+        def connect():
+            self.opened.append(FakeConnection())
+            return self.opened[-1]
+        return ConnectionPool(connect, **{'max_size': 2, 'timeout': 0.05, **kwargs})
+
+    def test_returned_connections_are_reused(self):
+        pool = self.make_pool()
+        first = pool.getconn()
+        pool.putconn(first)
+
+        self.assertIs(pool.getconn(), first)
+        self.assertEqual(len(self.opened), 1)
+
+    def test_checkout_blocks_then_times_out_when_exhausted(self):
+        pool = self.make_pool()
+        held = [pool.getconn(), pool.getconn()]
+
+        started = time.monotonic()
+        with self.assertRaises(psycopg2.OperationalError):
+            pool.getconn()
+        self.assertGreaterEqual(time.monotonic() - started, 0.05)
+
+        pool.putconn(held[0])
+        self.assertIs(pool.getconn(), held[0])
+
+    def test_waiting_checkout_gets_a_released_connection(self):
+        pool = self.make_pool(timeout=5)
+        held = [pool.getconn(), pool.getconn()]
+        timer = threading.Timer(0.05, pool.putconn, (held[1],))
+        timer.start()
+        self.addCleanup(timer.join)
+
+        self.assertIs(pool.getconn(), held[1])
+
+    def test_open_transaction_is_rolled_back_on_release(self):
+        pool = self.make_pool()
+        connection = pool.getconn()
+        connection.info.transaction_status = psycopg2_extensions.TRANSACTION_STATUS_INTRANS
+        pool.putconn(connection)
+
+        self.assertIs(pool.getconn(), connection)
+        self.assertEqual(connection.info.transaction_status, psycopg2_extensions.TRANSACTION_STATUS_IDLE)
+
+    def test_broken_connections_are_discarded_on_release(self):
+        pool = self.make_pool(max_size=1)
+        cases = {
+            'closed': lambda c: setattr(c, 'closed', 1),
+            'unknown status': lambda c: setattr(
+                c.info, 'transaction_status', psycopg2_extensions.TRANSACTION_STATUS_UNKNOWN),
+            'failed rollback': lambda c: (
+                setattr(c.info, 'transaction_status', psycopg2_extensions.TRANSACTION_STATUS_INERROR),
+                setattr(c, 'rollback_error', psycopg2.InterfaceError('connection already closed')),
+            ),
+        }
+        for case, break_connection in cases.items():
+            with self.subTest(case):
+                connection = pool.getconn()
+                break_connection(connection)
+                pool.putconn(connection)
+
+                self.assertTrue(connection.closed)
+                # The slot was released and a new connection is opened
+                self.assertIsNot(pool.getconn(), connection)
+                pool.putconn(self.opened[-1])
+
+    def test_discard_closes_the_connection(self):
+        pool = self.make_pool()
+        connection = pool.getconn()
+        pool.putconn(connection, discard=True)
+
+        self.assertTrue(connection.closed)
+        self.assertIsNot(pool.getconn(), connection)
+
+    def test_idle_connections_expire(self):
+        pool = self.make_pool(max_idle=0)
+        connection = pool.getconn()
+        pool.putconn(connection)
+        time.sleep(0.01)
+
+        self.assertIsNot(pool.getconn(), connection)
+        self.assertTrue(connection.closed)
+
+
+@override_settings(AWS_STORAGE_BUCKET_NAME='test-bucket', AWS_LOCATION='', S3_IMAGE_CACHE_DIR='',
+                   IMAGE_TRANSFORM_SIZES=[100, 200])
+class TransformTests(TestCase):
+    def setUp(self):
+        self.s3 = FakeS3({'images/a.png': image_bytes((400, 200), 'PNG')})
+        self.s3.put_object = mock.Mock(return_value={'ETag': '"variant"'})
+        patcher = mock.patch('api.views.get_s3_client', return_value=self.s3)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def negotiate(self, accept):
+        request = RequestFactory().get('/api/s3-image/images/a.jpg', HTTP_ACCEPT=accept)
+        return transforms.negotiate_format(request, 'images/a.jpg')[0]
+
+    def test_renders_and_stores_a_variant(self):
+        response = APIClient().get('/api/s3-image/images/a.png?w=100&fmt=png')
+
+        self.assertEqual(response.status_code, 200)
+        with PILImage.open(BytesIO(response.content)) as img:
+            self.assertEqual(img.size, (100, 50))
+        self.assertEqual(self.s3.put_object.call_args.kwargs['Key'], '_transforms/images/a.png/w100-h0-inside.png')
+
+    def test_fit_is_ignored_for_a_single_dimension(self):
+        request = RequestFactory().get('/api/s3-image/images/a.png?w=100&fit=cover&fmt=png')
+        self.assertEqual(transforms.parse_transform(request, 'images/a.png').variant_key('images/a.png'),
+                         '_transforms/images/a.png/w100-h0-inside.png')
+
+    def test_corrupt_original_is_unprocessable(self):
+        self.s3.objects['images/broken.png'] = image_bytes((400, 200), 'PNG')[:200]
+        response = APIClient().get('/api/s3-image/images/broken.png?w=100')
+
+        self.assertEqual(response.status_code, 422)
+        self.s3.put_object.assert_not_called()
+
+    async def test_corrupt_original_is_unprocessable_async(self):
+        self.s3.objects['images/broken.png'] = image_bytes((400, 200), 'PNG')[:200]
+        request = AsyncRequestFactory().get('/api/s3-image/images/broken.png', {'w': '100'})
+        with mock.patch('api.async_views.get_async_s3_client', return_value=AsyncFakeS3(self.s3)), \
+                mock.patch('api.async_views.get_s3_client', return_value=self.s3):
+            response = await serve_s3_image_async(request, 'images/broken.png')
+
+        self.assertEqual(response.status_code, 422)
+
+    @override_settings(IMAGE_TRANSFORM_QUEUE_TIMEOUT=0.01)
+    def test_busy_worker_answers_503_without_waiting(self):
+        slots = threading.BoundedSemaphore(1)
+        slots.acquire()
+        with mock.patch.object(transforms, '_slots', slots):
+            response = APIClient().get('/api/s3-image/images/a.png?w=100')
+
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response['Retry-After'], '1')
+        self.s3.put_object.assert_not_called()
+
+    def test_negotiation_honours_q_values(self):
+        self.assertEqual(self.negotiate('image/avif;q=0, image/webp, */*'), 'webp')
+        self.assertEqual(self.negotiate('image/avif;q=0, image/webp;q=0'), 'jpeg')
+        self.assertEqual(self.negotiate('image/webp'), 'webp')
+        self.assertEqual(self.negotiate('*/*'), 'jpeg')
+        if transforms.format_supported('avif'):
+            self.assertEqual(self.negotiate('image/avif, image/webp'), 'avif')
+            self.assertEqual(self.negotiate('image/avif;q=0.5, image/webp;q=0.8'), 'webp')
+
+    def test_contain_pads_with_white_without_alpha(self):
+        data = image_bytes((400, 200), 'PNG', mode='RGBA', color=(255, 0, 0, 0))
+
+        jpeg = transforms.apply_transform(data, transforms.Transform(200, 200, 'contain', 'jpeg', False))
+        png = transforms.apply_transform(data, transforms.Transform(200, 200, 'contain', 'png', False))
+
+        with PILImage.open(BytesIO(jpeg)) as img:
+            self.assertEqual(img.size, (200, 200))
+            # Padding and the transparent image itself come out white
+            for point in ((100, 5), (100, 100)):
+                self.assertTrue(all(channel > 245 for channel in img.getpixel(point)))
+        with PILImage.open(BytesIO(png)) as img:
+            self.assertEqual(img.getpixel((100, 5))[3], 0)
+
+    @override_settings(IMAGE_TRANSFORM_MAX_PIXELS=10000)
+    def test_originals_over_the_pixel_cap_are_refused(self):
+        response = APIClient().get('/api/s3-image/images/a.png?w=100')
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json()['error'], 'Image is too large to transform')
+        self.s3.put_object.assert_not_called()
+
+
+@override_settings(METRICS_ENABLED=True, METRICS_TOKEN='s3cret')
+class MetricsEndpointTests(TestCase):
+    def get(self, **headers):
+        return APIClient().get('/api/metrics/', **headers)
+
+    @override_settings(METRICS_TOKEN='')
+    def test_not_served_without_a_configured_token(self):
+        self.assertEqual(self.get(HTTP_AUTHORIZATION='Bearer ').status_code, 404)
+
+    @override_settings(METRICS_ENABLED=False)
+    def test_not_served_when_disabled(self):
+        self.assertEqual(self.get(HTTP_AUTHORIZATION='Bearer s3cret').status_code, 404)
+
+    def test_missing_or_wrong_token_is_unauthorized(self):
+        self.assertEqual(self.get().status_code, 401)
+        self.assertEqual(self.get(HTTP_AUTHORIZATION='Bearer wrong').status_code, 401)
+        self.assertEqual(self.get(HTTP_AUTHORIZATION='s3cret').status_code, 401)
+
+    def test_correct_token_gets_the_exposition(self):
+        with mock.patch('api.metrics.hmac.compare_digest', wraps=hmac.compare_digest) as compare_digest:
+            response = self.get(HTTP_AUTHORIZATION='Bearer s3cret')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response['Content-Type'].startswith('text/plain'))
+        self.assertIn(b'# TYPE django_http_request_duration_seconds histogram', response.content)
+        compare_digest.assert_called_once_with(b'Bearer s3cret', b'Bearer s3cret')
+
+    def test_cache_stats_take_the_same_token(self):
+        self.assertEqual(APIClient().get('/api/cache-stats/').status_code, 401)
+        self.assertEqual(APIClient().get('/api/cache-stats/', HTTP_AUTHORIZATION='Bearer wrong').status_code, 401)
+        response = APIClient().get('/api/cache-stats/', HTTP_AUTHORIZATION='Bearer s3cret')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('hits', response.json())
+        with override_settings(METRICS_TOKEN=''):
+            self.assertEqual(APIClient().get('/api/cache-stats/', HTTP_AUTHORIZATION='Bearer ').status_code, 404)
+
+
+@override_settings(PROFILING_ENABLED=True, PROFILING_SAMPLE_RATE=0)
+class ProfilingTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.middleware = ProfilingMiddleware(lambda request: HttpResponse('ok'))
+
+    def request(self, **headers):
+        return self.middleware(RequestFactory().get('/api/messages/', **headers))
+
+    @override_settings(PROFILING_ENABLED=False)
+    def test_middleware_is_not_used_when_disabled(self):
+        with self.assertRaises(MiddlewareNotUsed):
+            ProfilingMiddleware(lambda request: HttpResponse())
+
+    def test_signed_header_opts_in(self):
+        response = self.request(HTTP_X_PROFILE=make_profile_token())
+
+        profile = get_profile(response['X-Profile-Id'])
+        self.assertEqual(profile['path'], '/api/messages/')
+        self.assertEqual(profile['status'], 200)
+        self.assertIn('cumulative', profile['stats'])
+
+    def test_invalid_header_is_ignored(self):
+        self.assertFalse(self.request(HTTP_X_PROFILE='forged').has_header('X-Profile-Id'))
+        self.assertEqual(list_profiles(), [])
+
+    def test_sampling(self):
+        self.assertFalse(self.request().has_header('X-Profile-Id'))
+        with override_settings(PROFILING_SAMPLE_RATE=0.5):
+            with mock.patch('api.profiling.random.random', return_value=0.7):
+                self.assertFalse(self.request().has_header('X-Profile-Id'))
+            with mock.patch('api.profiling.random.random', return_value=0.3):
+                self.assertTrue(self.request().has_header('X-Profile-Id'))
+        self.assertEqual(len(list_profiles()), 1)
+
+    async def test_async_requests_are_profiled_on_the_event_loop(self):
+        async def view(request):
+            return HttpResponse('ok')
+        middleware = ProfilingMiddleware(view)
+        self.assertTrue(iscoroutinefunction(middleware))
+
+        request = AsyncRequestFactory().get('/api/messages/', headers={'X-Profile': make_profile_token()})
+        response = await middleware(request)
+
+        profile = await sync_to_async(get_profile)(response['X-Profile-Id'])
+        self.assertEqual(profile['status'], 200)
+        self.assertIn('cumulative', profile['stats'])
+
+    async def test_one_async_request_is_profiled_at_a_time(self):
+        async def view(request):
+            if request.path == '/outer/':
+                inner = await middleware(AsyncRequestFactory().get('/inner/', headers=headers))
+                self.assertFalse(inner.has_header('X-Profile-Id'))
+            return HttpResponse('ok')
+        middleware = ProfilingMiddleware(view)
+        headers = {'X-Profile': make_profile_token()}
+
+        outer = await middleware(AsyncRequestFactory().get('/outer/', headers=headers))
+        self.assertTrue(outer.has_header('X-Profile-Id'))
+
+    def test_stored_profiles_are_hidden_once_disabled(self):
+        profile_id = self.request(HTTP_X_PROFILE=make_profile_token())['X-Profile-Id']
+        client = APIClient()
+        client.force_authenticate(User(username='admin', is_staff=True))
+
+        self.assertEqual(client.get(f'/api/profiles/{profile_id}/').status_code, 200)
+        with override_settings(PROFILING_ENABLED=False):
+            self.assertEqual(client.get(f'/api/profiles/{profile_id}/').status_code, 404)
+            self.assertEqual(client.get('/api/profiles/').status_code, 404)
+
+
+class ValuesListParityTests(LocalMediaTestCase):
+    """The values() list path must output exactly what the regular serializers do"""
+    def setUp(self):
+        super().setUp()
+        Image.objects.create(title='Café 東京 🚀', image='images/naïve résumé 東京.jpg', derivatives={
+            '640': 'images/derivatives/naïve résumé 東京-640.webp',
+            '1280': 'images/derivatives/naïve résumé 東京-1280.webp',
+        })
+        Image.objects.create(title='spaces & symbols', image='images/a b+c%20d.png')
+        Image.objects.create(title='no file', image='')
+        Message.objects.create(body='Grüße, 世界')
+
+    def assert_parity(self, serializer_class, queryset, context):
+        expected = serializer_class(list(queryset), many=True, context=context).data
+        rows = queryset.values(*serializer_class.values_fields)
+        self.assertEqual(serializer_class(rows, many=True, context=context).data, expected)
+
+    def test_images(self):
+        queryset = Image.objects.order_by('id')
+        self.assert_parity(ImageSerializer, queryset, {'request': RequestFactory().get('/api/images/')})
+        self.assert_parity(ImageSerializer, queryset, {})
+        with override_settings(DEBUG=True):
+            self.assert_parity(ImageSerializer, queryset, {})
+
+    def test_messages(self):
+        self.assert_parity(MessageSerializer, Message.objects.order_by('id'), {})
+
+    def test_list_endpoint(self):
+        request = RequestFactory().get('/api/images/')
+        expected = ImageSerializer(
+            list(Image.objects.order_by('-uploaded_at', '-id')), many=True, context={'request': request}
+        ).data
+        response = APIClient().get('/api/images/')
+        self.assertEqual(response.json()['results'], expected)
+
+
+class CursorPaginationTests(TestCase):
+    def walk(self, url, direction='next'):
+        """Follow the ``direction`` links from ``url``, returning the ids of each page"""
+        client = APIClient()
+        pages = []
+        while url:
+            body = client.get(url).json()
+            pages.append([item['id'] for item in body['results']])
+            url = body[direction]
+        return pages
+
+    def assert_walks(self, first_url, expected, page_size):
+        pages = self.walk(first_url)
+        self.assertEqual([id for page in pages for id in page], expected)
+        self.assertTrue(all(len(page) == page_size for page in pages[:-1]))
+
+        # And back again, from the last page
+        body = APIClient().get(first_url).json()
+        while body['next']:
+            last = body['next']
+            body = APIClient().get(last).json()
+        back = self.walk(last, 'previous')
+        self.assertEqual([id for page in reversed(back) for id in page], expected)
+
+    def test_messages(self):
+        ids = [Message.objects.create(body=f'm{n}').id for n in range(7)]
+        self.assert_walks('/api/messages/?page_size=3', ids[::-1], 3)
+
+    def test_images(self):
+        now = timezone.now()
+        images = [Image.objects.create(title=f'i{n}', image=f'images/{n}.jpg') for n in range(5)]
+        for offset, image in enumerate(images):
+            Image.objects.filter(pk=image.pk).update(uploaded_at=now - timedelta(minutes=offset))
+        bump_model_version(Image)
+        self.assert_walks('/api/images/?page_size=2', [image.id for image in images], 2)
+
+    def test_images_with_the_same_timestamp(self):
+        # E.g. one batch upload: bulk_create rows can share uploaded_at
+        now = timezone.now()
+        older = Image.objects.create(title='older', image='images/older.jpg')
+        batch = Image.objects.bulk_create(
+            [Image(title=f'b{n}', image=f'images/b{n}.jpg') for n in range(7)]
+        )
+        newer = Image.objects.create(title='newer', image='images/newer.jpg')
+        Image.objects.filter(pk=older.pk).update(uploaded_at=now - timedelta(minutes=1))
+        Image.objects.filter(pk__in=[image.pk for image in batch]).update(uploaded_at=now)
+        Image.objects.filter(pk=newer.pk).update(uploaded_at=now + timedelta(minutes=1))
+        bump_model_version(Image)
+
+        expected = [newer.id] + sorted((image.id for image in batch), reverse=True) + [older.id]
+        for page_size in (2, 3, 4):
+            with self.subTest(page_size=page_size):
+                self.assert_walks(f'/api/images/?page_size={page_size}', expected, page_size)
+
+
+class FakeListing:
+    """ListObjectsV2 paginator over a set of keys, ``page_size`` keys per page"""
+    def __init__(self, keys, page_size=2):
+        self.keys = sorted(keys)
+        self.page_size = page_size
+        self.last_modified = timezone.now() - timedelta(days=1)
+
+    def get_paginator(self, operation):
+        return self
+
+    def paginate(self, Bucket, Prefix='', Delimiter=None, StartAfter=''):
+        entries, prefixes = [], []
+        for key in self.keys:
+            if not key.startswith(Prefix) or key <= StartAfter:
+                continue
+            head, sep, _ = key[len(Prefix):].partition(Delimiter or '/')
+            if Delimiter and sep:
+                if Prefix + head + sep not in prefixes:
+                    prefixes.append(Prefix + head + sep)
+                continue
+            entries.append({'Key': key, 'Size': len(key), 'ETag': '"e"', 'LastModified': self.last_modified})
+        for i in range(0, max(len(entries), 1), self.page_size):
+            page = {'Contents': entries[i:i + self.page_size]}
+            if i == 0:
+                page['CommonPrefixes'] = [{'Prefix': prefix} for prefix in prefixes]
+            yield page
+
+
+@override_settings(AWS_STORAGE_BUCKET_NAME='bucket', S3_INVENTORY_STATS_TTL=60)
+class BucketInventoryTests(TestCase):
+    keys = ['root.txt', 'images/a.jpg', 'images/b/c.jpg', 'other/x']
+
+    def setUp(self):
+        cache.clear()
+        patcher = mock.patch('api.bucket_inventory.get_s3_client', return_value=FakeListing(self.keys))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_page_params(self):
+        self.assertEqual(parse_page_params({}), {'Bucket': 'bucket', 'Prefix': '', 'MaxKeys': 100})
+        self.assertEqual(
+            parse_page_params({'prefix': 'images/', 'page_size': '1000', 'continuation_token': 'token'}),
+            {'Bucket': 'bucket', 'Prefix': 'images/', 'MaxKeys': 1000, 'ContinuationToken': 'token'}
+        )
+        # An empty token starts from the beginning
+        self.assertNotIn('ContinuationToken', parse_page_params({'continuation_token': ''}))
+
+    def test_invalid_page_size(self):
+        for page_size in ('0', '1001', '-5'):
+            with self.assertRaisesMessage(ValueError, 'between 1 and 1000'):
+                parse_page_params({'page_size': page_size})
+        with self.assertRaisesMessage(ValueError, 'must be an integer'):
+            parse_page_params({'page_size': 'ten'})
+
+    def test_debug_endpoint_rejects_invalid_page_size(self):
+        response = APIClient().get('/api/debug-s3/', {'page_size': '5000'})
+
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('page_size', response.json()['error'])
+
+    def test_stats_are_unavailable_below_top_level_prefixes(self):
+        self.assertEqual(bucket_stats('images/b/')['status'], 'unavailable')
+
+    def test_first_request_starts_a_scan(self):
+        with mock.patch('api.bucket_inventory._start_scan') as start_scan:
+            self.assertEqual(bucket_stats(''), {'status': 'pending'})
+        start_scan.assert_called_once_with()
+
+    def test_ready_stats(self):
+        bucket_inventory._run_scan()
+
+        stats = bucket_stats('')
+        self.assertEqual(stats['status'], 'ready')
+        self.assertEqual(stats['object_count'], 4)
+        self.assertEqual(stats['total_bytes'], sum(len(key) for key in self.keys))
+        self.assertEqual(stats['size_histogram']['<10KB'], 4)
+        self.assertEqual(bucket_stats('images/')['object_count'], 2)
+        self.assertEqual(bucket_stats('missing/')['object_count'], 0)
+
+    def test_stale_stats_are_served_while_refreshing(self):
+        bucket_inventory._run_scan()
+        computed_at = cache.get(bucket_inventory._stats_key())['computed_at']
+
+        with mock.patch('api.bucket_inventory.time.time', return_value=computed_at + 61), \
+                mock.patch('api.bucket_inventory._start_scan') as start_scan:
+            stats = bucket_stats('images/')
+        self.assertEqual((stats['status'], stats['age_seconds'], stats['object_count']), ('stale', 61, 2))
+        start_scan.assert_called_once_with()
+
+    def test_one_scan_at_a_time(self):
+        self.addCleanup(setattr, bucket_inventory, '_scanning', False)
+        with mock.patch('api.bucket_inventory.threading.Thread') as thread:
+            bucket_inventory._start_scan()
+            bucket_inventory._start_scan()
+            self.assertEqual(thread.call_count, 1)
+            # Another worker: the scan is claimed in the shared cache
+            bucket_inventory._scanning = False
+            bucket_inventory._start_scan()
+            self.assertEqual(thread.call_count, 1)
+
+
+@override_settings(AWS_STORAGE_BUCKET_NAME='bucket')
+class IndexSyncTests(TestCase):
+    keys = [
+        'root.txt', 'images/a.jpg', 'images/b.jpg', 'images/m1.jpg', 'images/m2.jpg',
+        'images/z.jpg', 'images/Z.jpg', 'images/0.jpg', 'images/~.jpg',
+        'images/derivatives/a-640.webp', 'other/x', '_transforms/images/a.jpg/w640-h0-inside.jpeg',
+    ]
+
+    def setUp(self):
+        patcher = mock.patch('api.bucket_inventory.get_s3_client', return_value=FakeListing(self.keys))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_iter_bucket_lists_every_key_once(self):
+        listed = [obj['Key'] for obj in iter_bucket(workers=3)]
+        expected = [key for key in self.keys if not key.startswith('_transforms/')]
+        self.assertCountEqual(listed, expected)
+
+    def test_iter_bucket_stops_when_abandoned(self):
+        objects = iter_bucket(workers=1)
+        next(objects)
+        objects.close()
+
+    def test_sync_streams_and_sweeps(self):
+        started = timezone.now()
+        S3Object.objects.create(key='images/gone.jpg', size=1, last_modified=started,
+                                synced_at=started - timedelta(hours=1))
+        # Written by the app while the sync runs
+        S3Object.objects.create(key='images/new.jpg', size=1, last_modified=started,
+                                synced_at=started + timedelta(seconds=1))
+        S3Object.objects.create(key='images/a.jpg', size=0, content_type='image/jpeg',
+                                last_modified=started, synced_at=started - timedelta(hours=1))
+
+        with mock.patch('api.object_index.SYNC_BATCH_SIZE', 3):
+            upserted, deleted = sync_index(iter_bucket(workers=2), started)
+
+        self.assertEqual((upserted, deleted), (11, 1))
+        self.assertFalse(S3Object.objects.filter(key='images/gone.jpg').exists())
+        self.assertTrue(S3Object.objects.filter(key='images/new.jpg').exists())
+        indexed = S3Object.objects.get(key='images/a.jpg')
+        self.assertEqual((indexed.size, indexed.content_type), (len('images/a.jpg'), 'image/jpeg'))
+
+
+@override_settings(AWS_STORAGE_BUCKET_NAME='test-bucket', AWS_LOCATION='', AWS_DEFAULT_ACL='public-read',
+                   AWS_S3_OBJECT_PARAMETERS={'CacheControl': 'max-age=86400', 'ContentType': 'text/plain'})
+class ObjectParamsTests(TestCase):
+    def setUp(self):
+        self.s3 = mock.Mock()
+        self.s3.create_multipart_upload.return_value = {'UploadId': 'upload-1'}
+        self.s3.generate_presigned_post.return_value = {'url': 'https://s3', 'fields': {}}
+
+    def test_object_params(self):
+        self.assertEqual(object_params(), {
+            'CacheControl': 'max-age=86400', 'ContentType': 'text/plain', 'ACL': 'public-read'
+        })
+        with override_settings(AWS_DEFAULT_ACL=None, AWS_S3_OBJECT_PARAMETERS=None):
+            self.assertEqual(object_params(), {})
+
+    def test_upload_session(self):
+        with mock.patch('api.upload_sessions.get_s3_client', return_value=self.s3):
+            start_session('photo.jpg', 'image/jpeg')
+
+        params = self.s3.create_multipart_upload.call_args.kwargs
+        self.assertEqual(params['CacheControl'], 'max-age=86400')
+        self.assertEqual(params['ACL'], 'public-read')
+        # The call site's own parameters win
+        self.assertEqual(params['ContentType'], 'image/jpeg')
+
+    def test_upload_policy(self):
+        with mock.patch('api.direct_uploads.get_presign_client', return_value=self.s3):
+            create_upload_policy('photo.jpg', 'image/jpeg')
+
+        params = self.s3.generate_presigned_post.call_args.kwargs
+        self.assertEqual(params['Fields'], {
+            'Content-Type': 'image/jpeg', 'Cache-Control': 'max-age=86400', 'acl': 'public-read'
+        })
+        self.assertIn({'acl': 'public-read'}, params['Conditions'])
+
+    def test_transform_variant(self):
+        s3 = FakeS3({'images/a.png': image_bytes((400, 200), 'PNG')})
+        s3.put_object = mock.Mock(return_value={'ETag': '"variant"'})
+        transform = transforms.Transform(100, None, 'inside', 'png', False)
+
+        response = transforms.render_variant(s3, 'test-bucket', 'images/a.png', transform)
+
+        params = s3.put_object.call_args.kwargs
+        self.assertEqual((params['ACL'], params['ContentType']), ('public-read', 'image/png'))
+        self.assertEqual(response['Cache-Control'], 'max-age=86400')
+
+
+class CompleteUploadTests(LocalMediaTestCase):
+    name = 'images/abc_photo.jpg'
+
+    def setUp(self):
+        super().setUp()
+        head = {'ContentLength': 10, 'ContentType': 'image/jpeg', 'ETag': '"e"'}
+        for target, value in (('api.views.direct_uploads_enabled', True),
+                              ('api.views.verify_upload', (self.name, head))):
+            patcher = mock.patch(target, return_value=value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def complete(self):
+        return APIClient().post('/api/images/complete-upload/', {'upload_token': 'token'}, format='json')
+
+    def test_creates_the_record_once(self):
+        with mock.patch('api.views.image_from_upload',
+                        side_effect=lambda name, title: Image(title='Photo', image=name)):
+            self.assertEqual(self.complete().status_code, 201)
+            self.assertEqual(self.complete().status_code, 409)
+        self.assertEqual(Image.objects.filter(image=self.name).count(), 1)
+
+    def test_concurrent_completion_conflicts(self):
+        derivative = default_storage.save('images/abc_photo_640w.jpg', ContentFile(b'x'))
+
+        def image_from_upload(name, title):
+            # Another request completes the same upload while this one makes derivatives
+            Image.objects.create(title='Winner', image=name)
+            return Image(title='Loser', image=name, derivatives={'640': derivative})
+
+        with mock.patch('api.views.image_from_upload', side_effect=image_from_upload):
+            response = self.complete()
+
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(list(Image.objects.filter(image=self.name).values_list('title', flat=True)), ['Winner'])
+        self.assertFalse(default_storage.exists(derivative))
+
+    def test_records_without_a_file_are_not_unique(self):
+        Image.objects.create(title='a', image='')
+        Image.objects.create(title='b', image='')
+
+    def test_long_file_names_fit_the_column(self):
+        name = new_upload_name('p' * 200 + '.JPEG')
+        self.assertEqual(len(name), Image._meta.get_field('image').max_length)
+        self.assertTrue(name.endswith('p.jpeg'))
+        head = {'ContentLength': 10, 'ContentType': 'image/jpeg', 'ETag': '"e"'}
+
+        with mock.patch('api.views.verify_upload', return_value=(name, head)), \
+                mock.patch('api.views.image_from_upload',
+                           side_effect=lambda name, title: Image(title='Photo', image=name)):
+            self.assertEqual(self.complete().status_code, 201)
+        self.assertTrue(Image.objects.filter(image=name).exists())
+
+
+class DiskImageCacheTests(SimpleTestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory, ignore_errors=True)
+        self.cache = DiskImageCache(self.directory, max_bytes=1000, max_object_bytes=400, prefixes=['images/'])
+        self.last_modified = datetime(2024, 1, 1, tzinfo=dt_timezone.utc)
+
+    def fill(self, key, data, content_length=None):
+        s3_response = {
+            'ContentLength': len(data) if content_length is None else content_length,
+            'ContentType': 'image/png', 'ETag': '"etag"', 'LastModified': self.last_modified,
+            'CacheControl': 'max-age=60',
+        }
+        chunks = [data[i:i + 10] for i in range(0, len(data), 10)]
+        return b''.join(self.cache.fill(key, s3_response, iter(chunks)))
+
+    def files(self, suffix):
+        return [name for _, _, names in os.walk(self.directory) for name in names if name.endswith(suffix)]
+
+    def test_accepts(self):
+        self.assertTrue(self.cache.accepts('images/a.png', 400))
+        self.assertFalse(self.cache.accepts('images/a.png', 401))
+        self.assertFalse(self.cache.accepts('other/a.png'))
+
+    def test_fill_then_hit(self):
+        self.assertIsNone(self.cache.get('images/a.png'))
+        self.assertEqual(self.fill('images/a.png', b'x' * 95), b'x' * 95)
+
+        cached = self.cache.get('images/a.png')
+        with open(cached.path, 'rb') as f:
+            self.assertEqual(f.read(), b'x' * 95)
+        self.assertEqual((cached.size, cached.content_type, cached.etag, cached.cache_control),
+                         (95, 'image/png', '"etag"', 'max-age=60'))
+        self.assertEqual(cached.last_modified, self.last_modified.timestamp())
+        self.assertEqual(self.files('.tmp'), [])
+
+    def test_incomplete_bodies_are_not_published(self):
+        self.fill('images/short.png', b'x' * 50, content_length=60)
+
+        partial = self.cache.fill('images/abandoned.png', {'ContentLength': 30}, iter([b'x' * 10] * 3))
+        next(partial)
+        partial.close()
+
+        self.assertIsNone(self.cache.get('images/short.png'))
+        self.assertIsNone(self.cache.get('images/abandoned.png'))
+        self.assertEqual(self.files('.tmp'), [])
+
+    def test_least_recently_used_entries_are_evicted(self):
+        for n in range(3):
+            self.fill(f'images/{n}.png', b'x' * 300)
+            os.utime(self.cache.get(f'images/{n}.png').path, (n, n))
+        # A hit makes the oldest entry the most recently used
+        self.cache.get('images/0.png')
+
+        self.fill('images/3.png', b'x' * 300)
+
+        # Evicted down to 90% of the budget, oldest first
+        self.assertIsNone(self.cache.get('images/1.png'))
+        for n in (0, 2, 3):
+            self.assertIsNotNone(self.cache.get(f'images/{n}.png'))
+
+    def test_only_one_worker_evicts_at_a_time(self):
+        # Filled through a worker with a larger budget, so nothing is evicted yet
+        self.cache.max_bytes = 10 ** 6
+        for n in range(4):
+            self.fill(f'images/{n}.png', b'x' * 300)
+        self.cache.max_bytes = 1000
+        with open(os.path.join(self.directory, '.lock'), 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            self.cache.evict()
+            self.assertEqual(len(self.files('.bin')), 4)
+        self.cache.evict()
+        self.assertEqual(len(self.files('.bin')), 3)
+
+
+@override_settings(AWS_STORAGE_BUCKET_NAME='test-bucket', AWS_LOCATION='')
+class CachedImageProxyTests(TestCase):
+    data = bytes(range(256))
+
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory, ignore_errors=True)
+        self.cache = DiskImageCache(directory, 10000, 1000, ['images/'])
+        self.s3 = FakeS3({'images/a.png': self.data})
+        self.s3.get_object = mock.Mock(wraps=self.s3.get_object)
+        for target, value in (('api.views.get_s3_client', self.s3), ('api.views.get_image_cache', self.cache)):
+            patcher = mock.patch(target, return_value=value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def get(self, **headers):
+        response = APIClient().get('/api/s3-image/images/a.png', **headers)
+        return response, b''.join(response.streaming_content) if response.streaming else response.content
+
+    def test_hits_are_served_from_disk(self):
+        self.assertEqual(self.get()[1], self.data)
+        response, body = self.get()
+
+        self.assertEqual(body, self.data)
+        self.assertIsInstance(response, FileResponse)
+        self.assertEqual(response['ETag'], self.s3._etag(self.data))
+        self.assertEqual(self.s3.get_object.call_count, 1)
+
+    def test_conditional_and_range_requests(self):
+        self.get()
+        response, _ = self.get(HTTP_IF_NONE_MATCH=self.s3._etag(self.data))
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(self.s3.get_object.call_count, 1)
+
+        # Ranges go to S3
+        response, body = self.get(HTTP_RANGE='bytes=0-9')
+        self.assertEqual((response.status_code, body), (206, self.data[:10]))
+        self.assertEqual(self.s3.get_object.call_count, 2)
+
+    def test_entry_evicted_after_lookup_is_a_miss(self):
+        self.get()
+        lookup = self.cache.get
+
+        def get_then_evict(key):
+            cached = lookup(key)
+            os.unlink(cached.path)
+            return cached
+
+        with mock.patch.object(self.cache, 'get', side_effect=get_then_evict):
+            response, body = self.get()
+
+        self.assertEqual((response.status_code, body), (200, self.data))
+        self.assertEqual(self.s3.get_object.call_count, 2)
+
+    async def test_entry_evicted_after_lookup_is_a_miss_async(self):
+        await sync_to_async(self.get)()
+        lookup = self.cache.get
+
+        def get_then_evict(key):
+            cached = lookup(key)
+            os.unlink(cached.path)
+            return cached
+
+        request = AsyncRequestFactory().get('/api/s3-image/images/a.png')
+        with mock.patch.object(self.cache, 'get', side_effect=get_then_evict), \
+                mock.patch('api.async_views.get_image_cache', return_value=self.cache), \
+                mock.patch('api.async_views.get_async_s3_client', return_value=AsyncFakeS3(self.s3)):
+            response = await serve_s3_image_async(request, 'images/a.png')
+            self.assertEqual((response.status_code, await aread(response)), (200, self.data))
+
+
+@override_settings(AWS_STORAGE_BUCKET_NAME='test-bucket', AWS_LOCATION='', S3_IMAGE_CACHE_DIR='', USE_ASGI=True)
+class AsyncImageProxyTests(TestCase):
+    """The ASGI deployment's views, routed by api.urls when USE_ASGI is set"""
+    data = bytes(range(256)) * 4
+
+    def setUp(self):
+        self.route(asgi=True)
+        self.addCleanup(self.route, asgi=False)
+        self.s3 = FakeS3({'images/a.png': self.data})
+        patcher = mock.patch('api.async_views.get_async_s3_client', return_value=AsyncFakeS3(self.s3))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def route(self, asgi):
+        with override_settings(USE_ASGI=asgi):
+            importlib.reload(api_urls)
+            importlib.reload(importlib.import_module(settings.ROOT_URLCONF))
+        clear_url_caches()
+
+    def test_routes_to_the_async_views(self):
+        self.assertIs(resolve('/api/s3-image/images/a.png').func, serve_s3_image_async)
+
+    async def test_get(self):
+        response = await self.async_client.get('/api/s3-image/images/a.png')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Length'], '1024')
+        self.assertEqual(await aread(response), self.data)
+
+    async def test_head(self):
+        response = await self.async_client.head('/api/s3-image/images/a.png')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Length'], '1024')
+        self.assertEqual(response.content, b'')
+
+    async def test_not_modified(self):
+        response = await self.async_client.get('/api/s3-image/images/a.png',
+                                               headers={'If-None-Match': self.s3._etag(self.data)})
+
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], self.s3._etag(self.data))
+
+    async def test_ranges(self):
+        response = await self.async_client.get('/api/s3-image/images/a.png', headers={'Range': 'bytes=10-19'})
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response['Content-Range'], 'bytes 10-19/1024')
+        self.assertEqual(await aread(response), self.data[10:20])
+
+        response = await self.async_client.get('/api/s3-image/images/a.png',
+                                               headers={'Range': 'bytes=0-9, 100-109'})
+        self.assertEqual(response.status_code, 206)
+        body = await aread(response)
+        self.assertEqual(int(response['Content-Length']), len(body))
+        self.assertIn(self.data[100:110], body)
+
+        response = await self.async_client.get('/api/s3-image/images/a.png', headers={'Range': 'bytes=5000-'})
+        self.assertEqual(response.status_code, 416)
+
+    async def test_missing_object(self):
+        response = await self.async_client.get('/api/s3-image/images/missing.png')
+        self.assertEqual(response.status_code, 404)
@@ -0,0 +1,249 @@
+"""
+On-demand image transformations (resize, fit, format conversion) for the
+image proxy, cached back into S3 under deterministic keys
+"""
+import os
+import threading
+from io import BytesIO
+
+from django.conf import settings
+from django.http import HttpResponse
+from PIL import Image as PILImage, ImageOps, features
+
+from s3_client import object_params
+
+from .derivatives import encode_image
+from .image_proxy import apply_validators
+
+TRANSFORM_PARAMS = ('w', 'h', 'fit', 'fmt')
+FITS = ('inside', 'cover', 'contain', 'fill')
+
+# Output format name -> (Pillow format, content type)
+FORMATS = {
+    'jpeg': ('JPEG', 'image/jpeg'),
+    'png': ('PNG', 'image/png'),
+    'webp': ('WEBP', 'image/webp'),
+    'avif': ('AVIF', 'image/avif'),
+}
+
+# Output formats that can hold transparency (others are padded with white)
+ALPHA_FORMATS = ('png', 'webp', 'avif')
+
+# Fallback output format for originals that are not negotiated to WebP/AVIF
+EXTENSION_FORMATS = {
+    '.jpg': 'jpeg',
+    '.jpeg': 'jpeg',
+    '.png': 'png',
+    '.gif': 'png',
+    '.webp': 'webp',
+    '.avif': 'avif',
+}
+
+_slots = threading.BoundedSemaphore(settings.IMAGE_TRANSFORM_CONCURRENCY)
+
+
+class TransformError(ValueError):
+    """Raised for invalid transformation parameters"""
+
+
+class TransformBusy(Exception):
+    """Raised when every transformation slot of this worker stays busy"""
+
+
+class Transform:
+    """A parsed, validated set of transformation parameters"""
+
+    def __init__(self, width, height, fit, image_format, negotiated):
+        self.width = width
+        self.height = height
+        self.fit = fit
+        self.format = image_format
+        # Whether the format was picked from the Accept header (needs Vary)
+        self.negotiated = negotiated
+
+    @property
+    def content_type(self):
+        return FORMATS[self.format][1]
+
+    def variant_key(self, key):
+        """Deterministic S3 key the transformed variant of ``key`` is cached under"""
+        return '%s%s/w%s-h%s-%s.%s' % (
+            settings.IMAGE_TRANSFORM_PREFIX, key,
+            self.width or 0, self.height or 0, self.fit, self.format
+        )
+
+
+def wants_transform(request):
+    """Whether the request asks for a transformed variant"""
+    return any(param in request.GET for param in TRANSFORM_PARAMS)
+
+
+def _dimension(request, param):
+    value = request.GET.get(param)
+    if value in (None, ''):
+        return None
+    try:
+        value = int(value)
+    except ValueError:
+        raise TransformError(f"'{param}' must be an integer")
+    if not 0 < value <= settings.IMAGE_TRANSFORM_MAX_DIMENSION:
+        raise TransformError(
+            f"'{param}' must be between 1 and {settings.IMAGE_TRANSFORM_MAX_DIMENSION}"
+        )
+    return snap_dimension(value)
+
+
+def snap_dimension(value):
+    """
+    Round ``value`` up to the next of IMAGE_TRANSFORM_SIZES (the largest for
+    anything bigger): every variant is stored in S3, so clients must not be
+    able to create one per pixel
+    """
+    sizes = settings.IMAGE_TRANSFORM_SIZES
+    if not sizes:
+        return value
+    return next((size for size in sizes if size >= value), sizes[-1])
+
+
+def format_supported(image_format):
+    return image_format != 'avif' or features.check('avif')
+
+
+def accepted_types(accept):
+    """
+    Media types the Accept header lists explicitly, mapped to their
+    q-value; ``q=0`` means "not acceptable"
+    """
+    types = {}
+    for item in accept.split(','):
+        media_type, *params = item.split(';')
+        q = 1.0
+        for param in params:
+            name, _, value = param.partition('=')
+            if name.strip().lower() == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        types[media_type.strip().lower()] = q
+    return types
+
+
+def negotiate_format(request, key):
+    """
+    Pick the output format: an explicit ``fmt`` wins, otherwise AVIF or
+    WebP when the Accept header allows it (the higher q-value, AVIF on a
+    tie), otherwise the original's format. Returns ``(format, negotiated)``.
+    """
+    requested = request.GET.get('fmt', 'auto').lower()
+    if requested != 'auto':
+        if requested not in FORMATS or not format_supported(requested):
+            raise TransformError(f"Unsupported format '{requested}'")
+        return requested, False
+
+    accepted = accepted_types(request.META.get('HTTP_ACCEPT', ''))
+    candidates = [
+        (accepted.get(FORMATS[name][1], 0), name)
+        for name in ('avif', 'webp') if format_supported(name)
+    ]
+    q, best = max(candidates, key=lambda candidate: candidate[0])
+    if q > 0:
+        return best, True
+    extension = os.path.splitext(key)[1].lower()
+    return EXTENSION_FORMATS.get(extension, 'jpeg'), True
+
+
+def parse_transform(request, key):
+    """Build a Transform from the query string, raising TransformError if invalid"""
+    width = _dimension(request, 'w')
+    height = _dimension(request, 'h')
+    fit = request.GET.get('fit', 'inside').lower()
+    if fit not in FITS:
+        raise TransformError(f"'fit' must be one of: {', '.join(FITS)}")
+    if not (width and height):
+        # fit only matters for a box: one variant (and key) per single dimension
+        fit = 'inside'
+    image_format, negotiated = negotiate_format(request, key)
+    return Transform(width, height, fit, image_format, negotiated)
+
+
+def _on_white(img):
+    """``img`` as RGB, with any transparency flattened onto white"""
+    if img.mode in ('RGBA', 'LA', 'PA') or 'transparency' in img.info:
+        img = img.convert('RGBA')
+        background = PILImage.new('RGB', img.size, (255, 255, 255))
+        background.paste(img, mask=img.getchannel('A'))
+        return background
+    return img.convert('RGB')
+
+
+def apply_transform(data, transform):
+    """Resize/convert the original image bytes according to ``transform``"""
+    with PILImage.open(BytesIO(data)) as original:
+        # Checked from the header, before anything is decoded
+        if original.width * original.height > settings.IMAGE_TRANSFORM_MAX_PIXELS:
+            raise TransformError("Image is too large to transform")
+        img = ImageOps.exif_transpose(original)
+        img.load()
+
+    width, height = transform.width, transform.height
+    if width and height:
+        box = (width, height)
+        if transform.fit == 'cover':
+            img = ImageOps.fit(img, box, PILImage.LANCZOS)
+        elif transform.fit == 'contain':
+            if transform.format in ALPHA_FORMATS:
+                img = ImageOps.pad(img.convert('RGBA'), box, PILImage.LANCZOS, color=(0, 0, 0, 0))
+            else:
+                img = ImageOps.pad(_on_white(img), box, PILImage.LANCZOS, color=(255, 255, 255))
+        elif transform.fit == 'fill':
+            img = img.resize(box, PILImage.LANCZOS)
+        else:
+            img.thumbnail(box, PILImage.LANCZOS)
+    elif width or height:
+        # A single dimension scales proportionally, never upscaling
+        scale = (width / img.width) if width else (height / img.height)
+        if scale < 1:
+            img = img.resize(
+                (max(1, round(img.width * scale)), max(1, round(img.height * scale))),
+                PILImage.LANCZOS
+            )
+
+    return encode_image(img, FORMATS[transform.format][0])
+
+
+def render_variant(s3_client, bucket, key, transform):
+    """
+    Compute the variant of ``key`` and store it under its variant key.
+
+    At most IMAGE_TRANSFORM_CONCURRENCY transformations run at once per
+    worker; when no slot frees up within the (short)
+    IMAGE_TRANSFORM_QUEUE_TIMEOUT TransformBusy is raised, and the view
+    answers 503 with Retry-After rather than tie up a worker thread waiting.
+    """
+    if not _slots.acquire(timeout=settings.IMAGE_TRANSFORM_QUEUE_TIMEOUT):
+        raise TransformBusy()
+    try:
+        original = s3_client.get_object(Bucket=bucket, Key=key)
+        try:
+            if original.get('ContentLength', 0) > settings.IMAGE_TRANSFORM_MAX_SOURCE_BYTES:
+                raise TransformError("Image is too large to transform")
+            data = original['Body'].read()
+        finally:
+            original['Body'].close()
+        variant = apply_transform(data, transform)
+    finally:
+        _slots.release()
+
+    params = {
+        **object_params(),
+        'Bucket': bucket,
+        'Key': transform.variant_key(key),
+        'Body': variant,
+        'ContentType': transform.content_type,
+    }
+    stored = s3_client.put_object(**params)
+
+    response = HttpResponse(variant, content_type=transform.content_type)
+    apply_validators(response, {'ETag': stored.get('ETag'), 'CacheControl': params.get('CacheControl')})
+    return response
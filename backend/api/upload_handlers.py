@@ -0,0 +1,208 @@
+"""
+Upload handler that streams multipart/form-data file fields straight into
+an S3 multipart upload while the request body is being read, instead of
+spooling them to a temp file that the storage backend then uploads again
+"""
+import os
+import tempfile
+from io import BytesIO
+
+from botocore.exceptions import ClientError
+from django.conf import settings
+from django.core.files.uploadedfile import InMemoryUploadedFile, UploadedFile
+from django.core.files.uploadhandler import FileUploadHandler, StopFutureHandlers
+from PIL import Image as PILImage
+
+from s3_client import get_s3_client, object_params, s3_key
+from .direct_uploads import direct_uploads_enabled, new_upload_name
+
+# Bytes kept in memory from the start of each file so the image can be
+# identified without reading it back from S3 (covers large EXIF blocks)
+HEAD_BYTES = 256 * 1024
+
+
+def streaming_uploads_enabled():
+    return settings.S3_STREAMING_UPLOADS and direct_uploads_enabled()
+
+
+class StreamedS3File(UploadedFile):
+    """
+    A file that is already stored in S3 under ``staged_name``.
+
+    ``read()`` returns the whole file when ``whole`` is set (a local copy
+    was kept for the derivatives), else only its first HEAD_BYTES; ``size``
+    is the size of the whole object. The storage backends recognise it and
+    keep or copy the object instead of uploading it.
+    """
+
+    def __init__(self, file, staged_name, content_type, size, charset,
+                 content_type_extra=None, whole=False):
+        super().__init__(file, os.path.basename(staged_name), content_type,
+                         size, charset, content_type_extra)
+        self.staged_name = staged_name
+        self.whole = whole
+        # Set once a storage backend took ownership of the object
+        self.committed = False
+
+    def sniff_image(self):
+        """Identify the image from its header; raises if Pillow cannot"""
+        self.file.seek(0)
+        with PILImage.open(self.file) as img:
+            image_format = img.format
+        self.file.seek(0)
+        return image_format
+
+    def discard(self):
+        """Delete the object unless a storage backend took ownership of it"""
+        if self.committed:
+            return
+        try:
+            get_s3_client().delete_object(
+                Bucket=settings.AWS_STORAGE_BUCKET_NAME, Key=s3_key(self.staged_name)
+            )
+        except ClientError:
+            pass
+        self.committed = True
+
+
+class S3MultipartUploadHandler(FileUploadHandler):
+    """
+    Feed each image/* file field into an S3 multipart upload as it arrives.
+
+    Incoming chunks are collected into S3_STREAMING_UPLOAD_PART_SIZE parts
+    (S3 needs parts of at least 5 MiB but the last), so at most one part
+    per upload is held in memory. When derivatives are configured, files up
+    to S3_STREAMING_UPLOAD_SPOOL_BYTES are also copied to a spooled temp
+    file (in memory up to FILE_UPLOAD_MAX_MEMORY_SIZE) so the derivatives
+    are built without downloading the object again; larger files are read
+    back from S3. Other fields fall through to the next handler.
+    """
+
+    def __init__(self, request=None):
+        super().__init__(request)
+        # Every file this handler produced, so unclaimed objects can be deleted
+        self.files = []
+        self._reset()
+
+    def _reset(self):
+        self.upload_id = None
+        self.staged_name = None
+        self.parts = []
+        self.buffer = bytearray()
+        self.head = bytearray()
+        self.spool = None
+
+    @property
+    def _target(self):
+        return {
+            'Bucket': settings.AWS_STORAGE_BUCKET_NAME,
+            'Key': s3_key(self.staged_name),
+        }
+
+    def new_file(self, field_name, file_name, content_type, content_length,
+                 charset=None, content_type_extra=None):
+        super().new_file(field_name, file_name, content_type, content_length,
+                         charset, content_type_extra)
+        self._reset()
+        if not (content_type or '').startswith('image/'):
+            return
+
+        # Short enough for Image.image, so the storage can keep the object as-is
+        self.staged_name = new_upload_name(file_name)
+        params = {**object_params(), **self._target, 'ContentType': content_type}
+        self.upload_id = get_s3_client().create_multipart_upload(**params)['UploadId']
+        if settings.IMAGE_DERIVATIVE_WIDTHS and settings.S3_STREAMING_UPLOAD_SPOOL_BYTES:
+            self.spool = tempfile.SpooledTemporaryFile(
+                max_size=settings.FILE_UPLOAD_MAX_MEMORY_SIZE, dir=settings.FILE_UPLOAD_TEMP_DIR
+            )
+        raise StopFutureHandlers()
+
+    def _upload_part(self):
+        number = len(self.parts) + 1
+        response = get_s3_client().upload_part(
+            **self._target,
+            UploadId=self.upload_id,
+            PartNumber=number,
+            Body=bytes(self.buffer),
+        )
+        self.parts.append({'PartNumber': number, 'ETag': response['ETag']})
+        self.buffer.clear()
+
+    def receive_data_chunk(self, raw_data, start):
+        if self.upload_id is None:
+            return raw_data
+        try:
+            if len(self.head) < HEAD_BYTES:
+                self.head += raw_data[:HEAD_BYTES - len(self.head)]
+            if self.spool is not None:
+                if self.spool.tell() + len(raw_data) > settings.S3_STREAMING_UPLOAD_SPOOL_BYTES:
+                    # Too large to keep: derivatives read it back from S3
+                    self._close_spool()
+                else:
+                    self.spool.write(raw_data)
+            self.buffer += raw_data
+            if len(self.buffer) >= settings.S3_STREAMING_UPLOAD_PART_SIZE:
+                self._upload_part()
+        except Exception:
+            self.abort()
+            raise
+        return None
+
+    def file_complete(self, file_size):
+        if self.upload_id is None:
+            return None
+        if not file_size:
+            # Nothing to store, but a file must still be returned: None would
+            # hand the file to the next handlers, which never saw new_file().
+            # The serializer rejects it as empty.
+            self.abort()
+            return InMemoryUploadedFile(
+                BytesIO(), self.field_name, self.file_name, self.content_type, 0,
+                self.charset, self.content_type_extra
+            )
+        try:
+            if self.buffer or not self.parts:
+                self._upload_part()
+            get_s3_client().complete_multipart_upload(
+                **self._target,
+                UploadId=self.upload_id,
+                MultipartUpload={'Parts': self.parts},
+            )
+        except Exception:
+            self.abort()
+            raise
+
+        if self.spool is not None:
+            self.spool.seek(0)
+            file, whole = self.spool, True
+        else:
+            file, whole = BytesIO(bytes(self.head)), False
+        streamed = StreamedS3File(
+            file, self.staged_name, self.content_type, file_size,
+            self.charset, self.content_type_extra, whole=whole
+        )
+        self.files.append(streamed)
+        self._reset()
+        return streamed
+
+    def upload_interrupted(self):
+        self.abort()
+
+    def upload_complete(self):
+        self.abort()
+
+    def _close_spool(self):
+        if self.spool is not None:
+            self.spool.close()
+            self.spool = None
+
+    def abort(self):
+        """Abort a multipart upload left unfinished, e.g. by a dropped connection"""
+        if self.upload_id is None:
+            return
+        self._close_spool()
+        try:
+            get_s3_client().abort_multipart_upload(**self._target, UploadId=self.upload_id)
+        except ClientError:
+            pass
+        self._reset()
@@ -0,0 +1,256 @@
+"""
+Resumable chunked uploads mapped onto S3 multipart uploads.
+
+The session and every acknowledged part are stored in the database, so any
+worker can accept the next part and a client whose connection dropped can
+ask which parts arrived and resend only the missing ones.
+"""
+from botocore.exceptions import ClientError
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from s3_client import get_s3_client, object_params, s3_key
+from .direct_uploads import (
+    DirectUploadError, check_content_type, discard_upload, image_from_upload, new_upload_name
+)
+from .models import UploadPart, UploadSession
+from .object_index import record_object
+
+# S3 limits: part numbers run from 1 to 10,000
+MAX_PART_NUMBER = 10000
+
+
+class UploadSessionError(ValueError):
+    """Raised when a session operation is invalid"""
+
+
+class UploadSessionConflict(UploadSessionError):
+    """Raised when the session is no longer in a state that allows the operation"""
+
+
+class PartTooLarge(UploadSessionError):
+    """Raised when a part exceeds UPLOAD_SESSION_MAX_PART_BYTES"""
+
+
+def _bucket():
+    return settings.AWS_STORAGE_BUCKET_NAME
+
+
+def _check_active(session):
+    if session.status != UploadSession.ACTIVE:
+        raise UploadSessionConflict(f"Upload session is {session.status}")
+
+
+def start_session(filename, content_type, title='', total_size=None):
+    """Create the S3 multipart upload and the session that tracks it"""
+    check_content_type(content_type)
+    if total_size is not None:
+        try:
+            total_size = int(total_size)
+        except (TypeError, ValueError):
+            raise UploadSessionError("'total_size' must be an integer")
+        if not 0 < total_size <= settings.UPLOAD_SESSION_MAX_BYTES:
+            raise UploadSessionError(
+                f"'total_size' must be between 1 and {settings.UPLOAD_SESSION_MAX_BYTES}"
+            )
+
+    name = new_upload_name(filename)
+    params = {**object_params(), 'Bucket': _bucket(), 'Key': s3_key(name), 'ContentType': content_type}
+    upload = get_s3_client().create_multipart_upload(**params)
+
+    return UploadSession.objects.create(
+        name=name,
+        upload_id=upload['UploadId'],
+        content_type=content_type,
+        title=(title or '')[:200],
+        total_size=total_size,
+    )
+
+
+def read_part_body(stream, content_length):
+    """
+    Read a part body from the request stream, refusing oversized parts
+    before (when Content-Length is known) or while reading them
+    """
+    limit = settings.UPLOAD_SESSION_MAX_PART_BYTES
+    if content_length and content_length > limit:
+        raise PartTooLarge(f"Parts may be at most {limit} bytes")
+    body = stream.read(limit + 1) if stream is not None else b''
+    if len(body) > limit:
+        raise PartTooLarge(f"Parts may be at most {limit} bytes")
+    if not body:
+        raise UploadSessionError("Part body is empty")
+    return body
+
+
+def upload_part(session, number, body, content_md5=None):
+    """
+    Send one part to S3 and record its ETag. Re-sending a part number
+    replaces the earlier attempt, which is what makes retries safe.
+    """
+    _check_active(session)
+    if not 1 <= number <= MAX_PART_NUMBER:
+        raise UploadSessionError(f"Part number must be between 1 and {MAX_PART_NUMBER}")
+
+    received = sum(
+        part.size for part in session.parts.all() if part.number != number
+    )
+    limit = session.total_size or settings.UPLOAD_SESSION_MAX_BYTES
+    if received + len(body) > limit:
+        raise UploadSessionError(f"Upload would exceed {limit} bytes")
+
+    params = {
+        'Bucket': _bucket(),
+        'Key': s3_key(session.name),
+        'UploadId': session.upload_id,
+        'PartNumber': number,
+        'Body': body,
+    }
+    if content_md5:
+        # Let S3 reject parts that were corrupted on the way
+        params['ContentMD5'] = content_md5
+    try:
+        response = get_s3_client().upload_part(**params)
+    except ClientError as e:
+        code = e.response['Error']['Code']
+        if code == 'NoSuchUpload':
+            raise UploadSessionConflict("Upload no longer exists in S3")
+        if code in ('BadDigest', 'InvalidDigest'):
+            raise UploadSessionError("Part checksum does not match Content-MD5")
+        raise
+
+    part, _ = UploadPart.objects.update_or_create(
+        session=session,
+        number=number,
+        defaults={'etag': response['ETag'], 'size': len(body)},
+    )
+    # Keeps the session from looking stale to the cleanup script
+    session.save(update_fields=['updated_at'])
+    return part
+
+
+def missing_parts(parts):
+    """Part numbers absent from the contiguous 1..N range of ``parts``"""
+    numbers = {part.number for part in parts}
+    return sorted(set(range(1, max(numbers, default=0) + 1)) - numbers)
+
+
+def _set_status(session_id, status):
+    """Move a session out of COMPLETING (one UPDATE, no row lock needed)"""
+    if status == UploadSession.ABORTED:
+        UploadPart.objects.filter(session_id=session_id).delete()
+    UploadSession.objects.filter(pk=session_id).update(status=status, updated_at=timezone.now())
+
+
+def _complete_multipart_upload(session, parts):
+    try:
+        return get_s3_client().complete_multipart_upload(
+            Bucket=_bucket(),
+            Key=s3_key(session.name),
+            UploadId=session.upload_id,
+            MultipartUpload={'Parts': [
+                {'PartNumber': part.number, 'ETag': part.etag} for part in parts
+            ]},
+        )
+    except ClientError as e:
+        code = e.response['Error']['Code']
+        if code == 'EntityTooSmall':
+            raise UploadSessionError("Every part but the last must be at least 5 MiB")
+        if code in ('InvalidPart', 'InvalidPartOrder'):
+            raise UploadSessionError("S3 rejected the uploaded parts, re-send them")
+        if code == 'NoSuchUpload':
+            raise UploadSessionConflict("Upload no longer exists in S3")
+        raise
+
+
+def complete_session(session_id):
+    """
+    Assemble the uploaded parts into the final object and create its Image.
+
+    The session is marked COMPLETING in a short locked transaction; the
+    slow part (assembling, validating and resizing a possibly huge file)
+    runs without a transaction, and a second short one records the result.
+    Completing a session that is being completed raises
+    UploadSessionConflict.
+
+    The assembled object must be a raster image we accept (see
+    image_from_upload); otherwise it is deleted and the session aborted.
+    Completing an already completed session returns its Image again, so a
+    client that lost the response can safely retry.
+    """
+    with transaction.atomic():
+        session = UploadSession.objects.select_for_update().get(pk=session_id)
+        if session.status == UploadSession.COMPLETED and session.image_id:
+            return session.image, False
+        if session.status == UploadSession.COMPLETING:
+            raise UploadSessionConflict("Upload session is being completed, retry shortly")
+        _check_active(session)
+
+        parts = list(session.parts.all())
+        if not parts:
+            raise UploadSessionError("No parts have been uploaded")
+        gaps = missing_parts(parts)
+        if gaps:
+            raise UploadSessionError(f"Missing parts: {', '.join(map(str, gaps))}")
+        size = sum(part.size for part in parts)
+        if session.total_size is not None and size != session.total_size:
+            raise UploadSessionError(
+                f"Uploaded {size} bytes, expected {session.total_size}"
+            )
+        session.status = UploadSession.COMPLETING
+        session.save(update_fields=['status', 'updated_at'])
+
+    try:
+        completed = _complete_multipart_upload(session, parts)
+    except BaseException:
+        # Nothing was assembled: the client may fix the parts and retry
+        _set_status(session.pk, UploadSession.ACTIVE)
+        raise
+
+    try:
+        image = image_from_upload(session.name, session.title)
+    except DirectUploadError as e:
+        # The object was deleted; the session cannot be completed again
+        _set_status(session.pk, UploadSession.ABORTED)
+        raise UploadSessionError(str(e))
+    except BaseException:
+        # The multipart upload is gone, so the session cannot be retried
+        discard_upload(session.name)
+        _set_status(session.pk, UploadSession.ABORTED)
+        raise
+
+    with transaction.atomic():
+        session = UploadSession.objects.select_for_update().get(pk=session.pk)
+        image.save()
+        session.status = UploadSession.COMPLETED
+        session.image = image
+        session.save(update_fields=['status', 'image', 'updated_at'])
+    record_object(session.name, size, session.content_type, completed.get('ETag'))
+    return image, True
+
+
+def abort_session(session, force=False):
+    """
+    Abort the S3 multipart upload, releasing the stored parts. ``force``
+    also aborts a session left COMPLETING by a worker that died, deleting
+    the object it may have assembled.
+    """
+    if session.status == UploadSession.COMPLETED:
+        raise UploadSessionConflict("Upload session is completed")
+    if session.status == UploadSession.COMPLETING:
+        if not force:
+            raise UploadSessionConflict("Upload session is being completed")
+        discard_upload(session.name)
+    try:
+        get_s3_client().abort_multipart_upload(
+            Bucket=_bucket(),
+            Key=s3_key(session.name),
+            UploadId=session.upload_id,
+        )
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'NoSuchUpload':
+            raise
+    session.parts.all().delete()
+    session.status = UploadSession.ABORTED
+    session.save(update_fields=['status', 'updated_at'])
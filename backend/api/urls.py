@@ -1,13 +1,33 @@
+from django.conf import settings
 from django.urls import path, include
 from rest_framework.routers import DefaultRouter
-from .views import MessageViewSet, ImageViewSet, serve_s3_image, debug_s3_bucket
+from . import async_views, views
+from .views import (
+    MessageViewSet, ImageViewSet, UploadSessionViewSet, api_cache_stats,
+    api_profiles, api_profile_detail, api_profile_token
+)
+from .metrics import metrics_view
+
+if settings.USE_ASGI:
+    # Non-blocking S3 views for the uvicorn worker deployment
+    serve_image_view = async_views.serve_s3_image_async
+    debug_bucket_view = async_views.debug_s3_bucket_async
+else:
+    serve_image_view = views.serve_s3_image
+    debug_bucket_view = views.debug_s3_bucket
 
 router = DefaultRouter()
 router.register(r'messages', MessageViewSet)
 router.register(r'images', ImageViewSet)
+router.register(r'upload-sessions', UploadSessionViewSet)
 
 urlpatterns = [
     path('', include(router.urls)),
-    path('s3-image/<path:image_path>', serve_s3_image, name='serve_s3_image'),
-    path('debug-s3/', debug_s3_bucket, name='debug_s3_bucket'),
+    path('s3-image/<path:image_path>', serve_image_view, name='serve_s3_image'),
+    path('debug-s3/', debug_bucket_view, name='debug_s3_bucket'),
+    path('cache-stats/', api_cache_stats, name='api_cache_stats'),
+    path('metrics/', metrics_view, name='metrics'),
+    path('profiles/', api_profiles, name='api_profiles'),
+    path('profiles/token/', api_profile_token, name='api_profile_token'),
+    path('profiles/<str:profile_id>/', api_profile_detail, name='api_profile_detail'),
 ]
\ No newline at end of file
@@ -1,102 +1,484 @@
-from rest_framework import viewsets
-from rest_framework.parsers import MultiPartParser, FormParser
-from rest_framework.decorators import api_view
+from rest_framework import mixins, viewsets, status
+from rest_framework.parsers import MultiPartParser, FormParser, JSONParser
+from rest_framework.decorators import action, api_view, permission_classes
+from rest_framework.permissions import IsAdminUser
 from rest_framework.response import Response
-from django.http import HttpResponse, Http404
+from django.http import Http404, HttpResponseRedirect
+from django.utils.cache import patch_vary_headers
+from PIL import UnidentifiedImageError
 from django.conf import settings
-import boto3
+from django.db import IntegrityError, transaction
+from s3_client import get_s3_client, s3_key
 from botocore.exceptions import ClientError
-from .models import Message, Image
-from .serializers import MessageSerializer, ImageSerializer
+from .models import Message, Image, UploadSession
+from .serializers import MessageSerializer, ImageSerializer, UploadSessionSerializer
+from .pagination import ImageCursorPagination, MessageCursorPagination
+from .caching import CachedResponseMixin, cache_stats, invalidate_after_bulk_write
+from .parsers import NDJSONParser
+from .values_lists import ValuesListMixin
+from .image_proxy import proxy_s3_object
+from .image_cache import get_image_cache
+from .bucket_inventory import bucket_stats, format_page, parse_page_params
+from .delivery import presigned_delivery_enabled, presigned_image_url
+from .derivatives import DECODE_ERRORS, generate_derivatives
+from .batch_uploads import create_images
+from .object_index import record_object
+from .metrics import has_metrics_token
+from .profiling import get_profile, list_profiles, make_profile_token
+from .transforms import (
+    TransformBusy, TransformError, parse_transform, render_variant, wants_transform
+)
+from .direct_uploads import (
+    DirectUploadError, create_upload_policy, direct_uploads_enabled, image_from_upload, verify_upload
+)
+from .upload_handlers import S3MultipartUploadHandler, StreamedS3File, streaming_uploads_enabled
+from .upload_sessions import (
+    PartTooLarge, UploadSessionConflict, UploadSessionError,
+    abort_session, complete_session, read_part_body, start_session, upload_part
+)
 
-class MessageViewSet(viewsets.ModelViewSet):
+class MessageViewSet(CachedResponseMixin, ValuesListMixin, viewsets.ModelViewSet):
     queryset = Message.objects.all()
     serializer_class = MessageSerializer
+    pagination_class = MessageCursorPagination
 
-class ImageViewSet(viewsets.ModelViewSet):
+    @action(detail=False, methods=['post'], parser_classes=(JSONParser, NDJSONParser))
+    def bulk(self, request):
+        """
+        Create many messages at once from a JSON array or an NDJSON stream.
+
+        All messages are validated first; if any is invalid nothing is saved
+        and the errors are reported per item index. Valid batches are
+        inserted with bulk_create in one transaction. Bodies over Django's
+        DATA_UPLOAD_MAX_MEMORY_SIZE, which NDJSON streams would otherwise
+        escape, are refused with a 413 before they are read.
+        """
+        max_bytes = settings.DATA_UPLOAD_MAX_MEMORY_SIZE
+        try:
+            content_length = int(request.META.get('CONTENT_LENGTH') or 0)
+        except ValueError:
+            content_length = 0
+        if max_bytes is not None and content_length > max_bytes:
+            return Response({'error': f'Request body exceeds {max_bytes} bytes'},
+                            status=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
+
+        items = request.data
+        if not isinstance(items, list):
+            return Response({'error': 'Expected a list of messages'},
+                            status=status.HTTP_400_BAD_REQUEST)
+        if len(items) > settings.MESSAGE_BULK_MAX_ITEMS:
+            return Response({'error': f'At most {settings.MESSAGE_BULK_MAX_ITEMS} messages per request'},
+                            status=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
+
+        serializer = self.get_serializer(data=items, many=True)
+        if not serializer.is_valid():
+            return Response({
+                'error': 'Invalid messages, nothing was saved',
+                'errors': [
+                    {'index': index, 'errors': item_errors}
+                    for index, item_errors in enumerate(serializer.errors) if item_errors
+                ]
+            }, status=status.HTTP_400_BAD_REQUEST)
+
+        with transaction.atomic():
+            messages = Message.objects.bulk_create(
+                [Message(**item) for item in serializer.validated_data],
+                batch_size=settings.MESSAGE_BULK_BATCH_SIZE
+            )
+        invalidate_after_bulk_write(Message)
+        return Response({
+            'created': len(messages),
+            'ids': [message.pk for message in messages]
+        }, status=status.HTTP_201_CREATED)
+
+class ImageViewSet(CachedResponseMixin, ValuesListMixin, viewsets.ModelViewSet):
     queryset = Image.objects.all()
     serializer_class = ImageSerializer
     parser_classes = (MultiPartParser, FormParser)
+    pagination_class = ImageCursorPagination
+    upload_handler = None
 
-@api_view(['GET'])
+    def initialize_request(self, request, *args, **kwargs):
+        if streaming_uploads_enabled():
+            # Must be in place before anything parses the request body
+            self.upload_handler = S3MultipartUploadHandler(request)
+            request.upload_handlers.insert(0, self.upload_handler)
+        return super().initialize_request(request, *args, **kwargs)
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        if self.upload_handler is not None:
+            # Delete streamed objects no Image took ownership of (failed validation)
+            for uploaded in self.upload_handler.files:
+                uploaded.discard()
+        return super().finalize_response(request, response, *args, **kwargs)
+
+    @staticmethod
+    def _generate_derivatives(image, source):
+        # Generate the responsive derivatives while the upload is still at hand
+        # (a streamed upload too large to keep locally is read back from S3)
+        image.derivatives = generate_derivatives(
+            image.image, None if isinstance(source, StreamedS3File) and not source.whole else source
+        )
+
+    def perform_create(self, serializer):
+        image = serializer.save()
+        self._generate_derivatives(image, serializer.validated_data.get('image'))
+        if image.derivatives:
+            image.save(update_fields=['derivatives'])
+
+    def perform_update(self, serializer):
+        stale = set((serializer.instance.derivatives or {}).values())
+        image = serializer.save()
+        if 'image' not in serializer.validated_data:
+            return
+        # A new file: its derivatives replace those of the old one
+        self._generate_derivatives(image, serializer.validated_data['image'])
+        image.save(update_fields=['derivatives'])
+        # (with file overwriting on, the new ones may reuse the old names)
+        for name in stale - set(image.derivatives.values()):
+            try:
+                image.image.storage.delete(name)
+            except Exception:
+                pass
+
+    @action(detail=False, methods=['post'])
+    def batch(self, request):
+        """
+        Upload many images in one multipart request: files under ``images``,
+        optional titles (in the same order) under ``titles``.
+
+        All files are validated first; if any is invalid nothing is saved
+        and the errors are reported per file index.
+
+        With streaming uploads on, the files already reached S3 one after
+        the other while the body was parsed, so create_images' pool only
+        commits them and builds their derivatives concurrently.
+        """
+        uploads = request.FILES.getlist('images')
+        if not uploads:
+            return Response({'error': "No files under 'images'"},
+                            status=status.HTTP_400_BAD_REQUEST)
+        if len(uploads) > settings.IMAGE_BATCH_MAX_FILES:
+            return Response({'error': f'At most {settings.IMAGE_BATCH_MAX_FILES} files per request'},
+                            status=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
+
+        titles = request.data.getlist('titles')
+        items = [
+            self.get_serializer(data={
+                'image': upload,
+                'title': titles[index] if index < len(titles) else ''
+            })
+            for index, upload in enumerate(uploads)
+        ]
+        errors = [
+            {'index': index, 'errors': item.errors}
+            for index, item in enumerate(items) if not item.is_valid()
+        ]
+        if errors:
+            return Response({'error': 'Invalid images, nothing was saved', 'errors': errors},
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        images = create_images(
+            [item.validated_data['image'] for item in items],
+            [item.validated_data.get('title', '') for item in items]
+        )
+        serializer = self.get_serializer(images, many=True)
+        return Response(serializer.data, status=status.HTTP_201_CREATED)
+
+    @action(detail=False, methods=['post'], url_path='upload-url',
+            parser_classes=(JSONParser, FormParser))
+    def upload_url(self, request):
+        """
+        Issue a presigned POST so the browser uploads the file straight to S3
+        """
+        if not direct_uploads_enabled():
+            return Response({'error': 'Direct uploads require S3 storage'},
+                            status=status.HTTP_404_NOT_FOUND)
+        try:
+            policy = create_upload_policy(
+                request.data.get('filename'),
+                request.data.get('content_type')
+            )
+        except DirectUploadError as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        return Response(policy, status=status.HTTP_201_CREATED)
+
+    @action(detail=False, methods=['post'], url_path='complete-upload',
+            parser_classes=(JSONParser, FormParser))
+    def complete_upload(self, request):
+        """
+        Verify a direct upload (a HEAD and a ranged GET identifying the image)
+        and create its Image record
+        """
+        if not direct_uploads_enabled():
+            return Response({'error': 'Direct uploads require S3 storage'},
+                            status=status.HTTP_404_NOT_FOUND)
+        try:
+            name, head = verify_upload(request.data.get('upload_token'))
+        except DirectUploadError as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        except ClientError as e:
+            if e.response['Error']['Code'] in ('NoSuchKey', '404'):
+                return Response({'error': 'Upload not found in S3'},
+                                status=status.HTTP_400_BAD_REQUEST)
+            raise
+
+        if Image.objects.filter(image=name).exists():
+            return Response({'error': 'Upload already completed'},
+                            status=status.HTTP_409_CONFLICT)
+
+        try:
+            image = image_from_upload(name, request.data.get('title'))
+        except DirectUploadError as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            with transaction.atomic():
+                image.save()
+        except IntegrityError:
+            # A concurrent request completed the same upload first (one
+            # record per file, see Image.Meta): keep its file, drop our derivatives
+            for derivative in image.derivatives.values():
+                try:
+                    image.image.storage.delete(derivative)
+                except Exception:
+                    pass
+            return Response({'error': 'Upload already completed'},
+                            status=status.HTTP_409_CONFLICT)
+        record_object(name, head['ContentLength'], head.get('ContentType'), head.get('ETag'))
+
+        serializer = self.get_serializer(image)
+        return Response(serializer.data, status=status.HTTP_201_CREATED)
+
+class UploadSessionViewSet(mixins.CreateModelMixin,
+                          mixins.RetrieveModelMixin,
+                          mixins.DestroyModelMixin,
+                          viewsets.GenericViewSet):
+    """
+    Resumable uploads: create a session, PUT each part to
+    ``parts/<number>/``, then POST ``complete/``. GET shows which parts
+    arrived so an interrupted client only re-sends the missing ones;
+    DELETE aborts the upload.
+    """
+    queryset = UploadSession.objects.prefetch_related('parts')
+    serializer_class = UploadSessionSerializer
+    parser_classes = (JSONParser, FormParser)
+
+    def initial(self, request, *args, **kwargs):
+        super().initial(request, *args, **kwargs)
+        if not direct_uploads_enabled():
+            raise Http404("Upload sessions require S3 storage")
+
+    def handle_exception(self, exc):
+        if isinstance(exc, PartTooLarge):
+            return Response({'error': str(exc)}, status=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
+        if isinstance(exc, UploadSessionConflict):
+            return Response({'error': str(exc)}, status=status.HTTP_409_CONFLICT)
+        if isinstance(exc, UploadSessionError):
+            return Response({'error': str(exc)}, status=status.HTTP_400_BAD_REQUEST)
+        return super().handle_exception(exc)
+
+    def create(self, request, *args, **kwargs):
+        session = start_session(
+            request.data.get('filename'),
+            request.data.get('content_type'),
+            title=request.data.get('title'),
+            total_size=request.data.get('total_size') or None
+        )
+        serializer = self.get_serializer(session)
+        return Response(serializer.data, status=status.HTTP_201_CREATED)
+
+    def destroy(self, request, *args, **kwargs):
+        abort_session(self.get_object())
+        return Response(status=status.HTTP_204_NO_CONTENT)
+
+    @action(detail=True, methods=['put'], url_path=r'parts/(?P<number>[0-9]+)')
+    def part(self, request, pk=None, number=None):
+        """
+        Upload part ``number``; the request body is the raw part bytes.
+        An optional Content-MD5 header is checked by S3.
+        """
+        session = self.get_object()
+        # Read the raw body ourselves: no parser should buffer a multi-MB part
+        body = read_part_body(request.stream, int(request.META.get('CONTENT_LENGTH') or 0))
+        part = upload_part(session, int(number), body, request.META.get('HTTP_CONTENT_MD5'))
+        return Response({'number': part.number, 'size': part.size, 'etag': part.etag})
+
+    @action(detail=True, methods=['post'])
+    def complete(self, request, pk=None):
+        """
+        Assemble the parts into the final object and create its Image record
+        """
+        image, created = complete_session(self.get_object().pk)
+        serializer = ImageSerializer(image, context=self.get_serializer_context())
+        return Response(serializer.data,
+                        status=status.HTTP_201_CREATED if created else status.HTTP_200_OK)
+
+@api_view(['GET', 'HEAD'])
 def serve_s3_image(request, image_path):
     """
     Proxy endpoint to serve images from LocalStack S3
+
+    HEAD is answered from a HeadObject, without reading the object.
+    Supports conditional GET (If-None-Match / If-Modified-Since -> 304)
+    and single or multi byte-range requests (206). Full reads go through
+    the optional node-local disk cache when S3_IMAGE_CACHE_DIR is set.
+    In presigned delivery mode it redirects to a presigned S3 URL instead.
+
+    The w, h, fit and fmt query parameters request a transformed variant.
     """
+    if wants_transform(request):
+        return _serve_transformed(request, image_path)
+
+    if presigned_delivery_enabled():
+        return HttpResponseRedirect(presigned_image_url(image_path))
+
     try:
-        # Create S3 client
-        s3_client = boto3.client(
-            's3',
-            endpoint_url=settings.AWS_S3_ENDPOINT_URL,
-            aws_access_key_id=settings.AWS_ACCESS_KEY_ID,
-            aws_secret_access_key=settings.AWS_SECRET_ACCESS_KEY,
-            region_name=settings.AWS_S3_REGION_NAME,
-            verify=settings.AWS_S3_VERIFY,
-            use_ssl=settings.AWS_S3_USE_SSL
-        )
+        s3_client = get_s3_client()
         
-        # Get the object from S3
-        response = s3_client.get_object(
-            Bucket=settings.AWS_STORAGE_BUCKET_NAME,
-            Key=image_path
-        )
-        
-        # Get content type
-        content_type = response.get('ContentType', 'image/jpeg')
-        
-        # Return the image data
-        return HttpResponse(
-            response['Body'].read(),
-            content_type=content_type
+        # Get the object (or the requested ranges of it) from S3
+        return proxy_s3_object(
+            request,
+            s3_client,
+            settings.AWS_STORAGE_BUCKET_NAME,
+            s3_key(image_path),
+            cache=get_image_cache()
         )
         
     except ClientError as e:
-        if e.response['Error']['Code'] == 'NoSuchKey':
+        if e.response['Error']['Code'] in ('NoSuchKey', '404'):
             raise Http404("Image not found")
         else:
             raise Http404("Error retrieving image")
     except Exception as e:
         raise Http404("Error retrieving image")
 
+def _serve_transformed(request, image_path):
+    """
+    Serve a resized/converted variant of an image, computing and storing it
+    in S3 on first request so each variant is only rendered once
+    """
+    key = s3_key(image_path)
+    try:
+        transform = parse_transform(request, key)
+    except TransformError as e:
+        return Response({'error': str(e)}, status=400)
+
+    s3_client = get_s3_client()
+    bucket = settings.AWS_STORAGE_BUCKET_NAME
+    try:
+        try:
+            response = proxy_s3_object(
+                request,
+                s3_client,
+                bucket,
+                transform.variant_key(key),
+                cache=get_image_cache()
+            )
+        except ClientError as e:
+            if e.response['Error']['Code'] not in ('NoSuchKey', '404'):
+                raise
+            # First request for this variant: render it and store it in S3
+            response = render_variant(s3_client, bucket, key, transform)
+    except TransformBusy:
+        response = Response({'error': 'Too many image transformations in progress'}, status=503)
+        response['Retry-After'] = '1'
+        return response
+    except TransformError as e:
+        return Response({'error': str(e)}, status=400)
+    except UnidentifiedImageError:
+        return Response({'error': 'File is not a supported image'}, status=400)
+    except DECODE_ERRORS:
+        # Truncated/corrupt originals, or too many pixels for Pillow
+        return Response({'error': 'Image could not be decoded'}, status=422)
+    except ClientError as e:
+        if e.response['Error']['Code'] in ('NoSuchKey', '404'):
+            raise Http404("Image not found")
+        raise Http404("Error retrieving image")
+
+    if transform.negotiated:
+        patch_vary_headers(response, ('Accept',))
+    return response
+
 @api_view(['GET'])
 def debug_s3_bucket(request):
     """
-    Debug endpoint to list all objects in the S3 bucket
+    Debug endpoint to list the objects in the S3 bucket, one page at a time
+
+    Takes ``prefix``, ``continuation_token`` and ``page_size`` (max 1000)
+    query parameters. ``stats`` holds the object count, total bytes and a
+    size histogram for the prefix, computed by a cached background scan.
     """
     try:
-        # Create S3 client
-        s3_client = boto3.client(
-            's3',
-            endpoint_url=settings.AWS_S3_ENDPOINT_URL,
-            aws_access_key_id=settings.AWS_ACCESS_KEY_ID,
-            aws_secret_access_key=settings.AWS_SECRET_ACCESS_KEY,
-            region_name=settings.AWS_S3_REGION_NAME,
-            verify=settings.AWS_S3_VERIFY,
-            use_ssl=settings.AWS_S3_USE_SSL
-        )
-        
-        # List all objects in the bucket
-        response = s3_client.list_objects_v2(Bucket=settings.AWS_STORAGE_BUCKET_NAME)
+        params = parse_page_params(request.query_params)
+    except ValueError as e:
+        return Response({'error': str(e)}, status=400)
+
+    try:
+        s3_client = get_s3_client()
         
-        objects = []
-        if 'Contents' in response:
-            for obj in response['Contents']:
-                objects.append({
-                    'key': obj['Key'],
-                    'size': obj['Size'],
-                    'last_modified': obj['LastModified'].isoformat()
-                })
+        # List one page of the objects under the prefix
+        response = s3_client.list_objects_v2(**params)
         
         return Response({
-            'bucket': settings.AWS_STORAGE_BUCKET_NAME,
-            'endpoint': settings.AWS_S3_ENDPOINT_URL,
-            'object_count': len(objects),
-            'objects': objects
+            **format_page(params, response),
+            'stats': bucket_stats(params['Prefix'])
         })
         
     except Exception as e:
         return Response({
             'error': str(e),
-            'bucket': settings.AWS_STORAGE_BUCKET_NAME,
-            'endpoint': settings.AWS_S3_ENDPOINT_URL
+            'bucket': getattr(settings, 'AWS_STORAGE_BUCKET_NAME', None),
+            'endpoint': getattr(settings, 'AWS_S3_ENDPOINT_URL', None)
         }, status=500)
+
+@api_view(['GET'])
+def api_cache_stats(request):
+    """
+    Hit/miss counters of the list/detail response cache, for scrapers
+    holding the /api/metrics/ token (not served without one)
+    """
+    if not settings.METRICS_TOKEN:
+        return Response({'error': 'Not served without a METRICS_TOKEN'}, status=404)
+    if not has_metrics_token(request):
+        return Response({'error': 'Send "Authorization: Bearer <METRICS_TOKEN>"'}, status=401)
+    return Response({
+        'backend': settings.CACHES['default']['BACKEND'],
+        **cache_stats()
+    })
+
+@api_view(['GET'])
+@permission_classes([IsAdminUser])
+def api_profiles(request):
+    """
+    Stored request profiles, newest first (summaries; see api_profile_detail)
+    """
+    if not settings.PROFILING_ENABLED:
+        return Response({'error': 'Profiling is disabled (set PROFILING_ENABLED)'}, status=404)
+    return Response({'profiles': list_profiles()})
+
+@api_view(['GET'])
+@permission_classes([IsAdminUser])
+def api_profile_detail(request, profile_id):
+    """
+    One request profile: cProfile stats, SQL queries and S3 calls
+    """
+    if not settings.PROFILING_ENABLED:
+        return Response({'error': 'Profiling is disabled (set PROFILING_ENABLED)'}, status=404)
+    profile = get_profile(profile_id)
+    if profile is None:
+        return Response({'error': 'Profile not found or expired'}, status=404)
+    return Response(profile)
+
+@api_view(['POST'])
+@permission_classes([IsAdminUser])
+def api_profile_token(request):
+    """
+    A signed token; send it as the X-Profile header to profile a request
+    """
+    if not settings.PROFILING_ENABLED:
+        return Response({'error': 'Profiling is disabled (set PROFILING_ENABLED)'}, status=404)
+    return Response({
+        'header': 'X-Profile',
+        'token': make_profile_token(),
+        'expires_in': settings.PROFILING_TOKEN_MAX_AGE
+    })
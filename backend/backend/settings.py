@@ -56,7 +56,10 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'api.metrics.metrics_middleware',
+    'api.profiling.ProfilingMiddleware',
     'django.middleware.security.SecurityMiddleware',
+    'api.db_routing.replica_routing_middleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'corsheaders.middleware.CorsMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -84,21 +87,81 @@ TEMPLATES = [
 ]
 
 WSGI_APPLICATION = 'backend.wsgi.application'
+ASGI_APPLICATION = 'backend.asgi.application'
+
+# Serve the S3 proxy and debug endpoints with async views (aiobotocore).
+# Enable only when running under ASGI (uvicorn workers), see Dockerfile.
+USE_ASGI = os.environ.get('USE_ASGI', 'false').lower() == 'true'
 
 
 # Database
 # https://docs.djangoproject.com/en/5.2/ref/settings/#databases
 
+# Keep connections open between requests for this many seconds (0 closes
+# them after every request), pinging reused ones first when health checks are on
+DB_CONN_MAX_AGE = int(os.environ.get('DB_CONN_MAX_AGE', 60))
+DB_CONN_HEALTH_CHECKS = os.environ.get('DB_CONN_HEALTH_CHECKS', 'true').lower() == 'true'
+
+# In-process connection pool shared by a worker's threads (see
+# db_backends/postgresql_pool): at most DB_POOL_MAX_SIZE connections per worker
+DB_POOL = os.environ.get('DB_POOL', 'false').lower() == 'true'
+DB_POOL_MAX_SIZE = int(os.environ.get('DB_POOL_MAX_SIZE', 4))
+# Seconds a request waits for a free pooled connection before failing
+DB_POOL_TIMEOUT = float(os.environ.get('DB_POOL_TIMEOUT', 10))
+# Seconds an unused pooled connection is kept open
+DB_POOL_MAX_IDLE = int(os.environ.get('DB_POOL_MAX_IDLE', 300))
+
 DATABASES = {
     'default': {
-        'ENGINE': 'django.db.backends.postgresql',
+        'ENGINE': 'db_backends.postgresql_pool' if DB_POOL else 'django.db.backends.postgresql',
         'NAME': os.environ.get('POSTGRES_DB'),
         'USER': os.environ.get('POSTGRES_USER'),
-        'HOST': 'db', # The service name in docker-compose.yml
-        'PORT': 5432,
+        'HOST': os.environ.get('POSTGRES_HOST', 'db'), # The service name in docker-compose.yml
+        'PORT': int(os.environ.get('POSTGRES_PORT', 5432)),
         'PASSWORD': os.environ.get('POSTGRES_PASSWORD'),
+        # Pooled connections go back to the pool at the end of each request
+        'CONN_MAX_AGE': 0 if DB_POOL else DB_CONN_MAX_AGE,
+        'CONN_HEALTH_CHECKS': DB_CONN_HEALTH_CHECKS,
+        'OPTIONS': {
+            'connect_timeout': int(os.environ.get('DB_CONNECT_TIMEOUT', 10)),
+        },
     }
 }
+if DB_POOL:
+    DATABASES['default']['OPTIONS']['pool'] = {
+        'max_size': DB_POOL_MAX_SIZE,
+        'timeout': DB_POOL_TIMEOUT,
+        'max_idle': DB_POOL_MAX_IDLE,
+    }
+
+# Read replicas as comma-separated host[:port] (same database name and
+# credentials as the primary). GET/HEAD/OPTIONS requests read from them,
+# see api/db_routing.py.
+DATABASE_REPLICAS = []
+for index, address in enumerate(filter(None, os.environ.get('DB_REPLICA_HOSTS', '').split(',')), 1):
+    host, _, port = address.strip().partition(':')
+    alias = f'replica{index}'
+    DATABASES[alias] = {
+        **DATABASES['default'],
+        'HOST': host,
+        'PORT': int(port or DATABASES['default']['PORT']),
+        # Fail over to the primary quickly when a replica is down
+        'OPTIONS': {
+            **DATABASES['default']['OPTIONS'],
+            'connect_timeout': int(os.environ.get('DB_REPLICA_CONNECT_TIMEOUT', 2)),
+        },
+        'TEST': {'MIRROR': 'default'},
+    }
+    DATABASE_REPLICAS.append(alias)
+if DATABASE_REPLICAS:
+    DATABASE_ROUTERS = ['api.db_routing.ReplicaRouter']
+
+# Seconds a client reads from the primary after a write (read-your-writes)
+DB_REPLICA_STICKY_SECONDS = int(os.environ.get('DB_REPLICA_STICKY_SECONDS', 5))
+# Replicas lagging more than this many seconds are skipped
+DB_REPLICA_MAX_LAG = float(os.environ.get('DB_REPLICA_MAX_LAG', 5))
+# How often each worker re-checks replica health and lag
+DB_REPLICA_CHECK_INTERVAL = int(os.environ.get('DB_REPLICA_CHECK_INTERVAL', 10))
 
 
 # Password validation
@@ -147,12 +210,165 @@ MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
+# Cache framework backend: 'locmem' (per worker process, so the response
+# cache is off by default with it, see API_CACHE_ENABLED), 'file' (shared by
+# the workers of one node) or 'redis' (shared by every node; any
+# Redis-compatible server). CACHE_LOCATION is the directory or redis:// URL.
+CACHE_BACKENDS = {
+    'locmem': 'django.core.cache.backends.locmem.LocMemCache',
+    'file': 'django.core.cache.backends.filebased.FileBasedCache',
+    'redis': 'django.core.cache.backends.redis.RedisCache',
+}
+CACHE_BACKEND = os.environ.get('CACHE_BACKEND', 'locmem').lower()
+CACHE_DEFAULT_LOCATIONS = {
+    'locmem': 'default',
+    'file': '/tmp/django_cache',
+    'redis': 'redis://redis:6379/0',
+}
+CACHES = {
+    'default': {
+        'BACKEND': CACHE_BACKENDS[CACHE_BACKEND],
+        'LOCATION': os.environ.get('CACHE_LOCATION', CACHE_DEFAULT_LOCATIONS[CACHE_BACKEND]),
+    }
+}
+
+# Prometheus metrics at /api/metrics/ (aggregated across gunicorn workers
+# through PROMETHEUS_MULTIPROC_DIR, see gunicorn.conf.py). Scrapes must send
+# "Authorization: Bearer <METRICS_TOKEN>", so metrics are only enabled by
+# default when a token is set and the endpoint is not served without one.
+# /api/cache-stats/ takes the same token.
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN', '')
+METRICS_ENABLED = os.environ.get('METRICS_ENABLED', 'true' if METRICS_TOKEN else 'false').lower() == 'true'
+
+# Per-request profiling (cProfile, SQL queries, S3 time), off by default.
+# When enabled, requests with a signed X-Profile header (POST
+# /api/profiles/token/ as an admin) and a PROFILING_SAMPLE_RATE share of all
+# requests are profiled; results are kept in the cache for admins at
+# /api/profiles/ (use a shared cache backend with several workers).
+PROFILING_ENABLED = os.environ.get('PROFILING_ENABLED', 'false').lower() == 'true'
+PROFILING_SAMPLE_RATE = float(os.environ.get('PROFILING_SAMPLE_RATE', 0))
+PROFILING_TOKEN_MAX_AGE = int(os.environ.get('PROFILING_TOKEN_MAX_AGE', 3600))
+PROFILING_RESULT_TTL = int(os.environ.get('PROFILING_RESULT_TTL', 3600))
+PROFILING_MAX_STORED = int(os.environ.get('PROFILING_MAX_STORED', 100))
+PROFILING_TOP_FUNCTIONS = int(os.environ.get('PROFILING_TOP_FUNCTIONS', 50))
+
+# Response cache for the list/detail endpoints, invalidated on writes. On by
+# default only with a cache shared by the workers: with 'locmem' a write
+# invalidates the writing worker's cache alone (see api/checks.py)
+API_CACHE_ENABLED = os.environ.get(
+    'API_CACHE_ENABLED', 'true' if CACHE_BACKEND in ('file', 'redis') else 'false'
+).lower() == 'true'
+API_CACHE_TIMEOUT = int(os.environ.get('API_CACHE_TIMEOUT', 300))
+
+# Cursor pagination for the list endpoints (clients may ask for
+# ?page_size= up to API_MAX_PAGE_SIZE)
+API_PAGE_SIZE = int(os.environ.get('API_PAGE_SIZE', 50))
+API_MAX_PAGE_SIZE = int(os.environ.get('API_MAX_PAGE_SIZE', 200))
+
+# POST /api/messages/bulk/: most messages accepted per request and rows
+# per INSERT statement (bodies are capped by DATA_UPLOAD_MAX_MEMORY_SIZE)
+MESSAGE_BULK_MAX_ITEMS = int(os.environ.get('MESSAGE_BULK_MAX_ITEMS', 10000))
+MESSAGE_BULK_BATCH_SIZE = int(os.environ.get('MESSAGE_BULK_BATCH_SIZE', 500))
+
+# Keep the api_s3object index of stored objects up to date on every
+# storage write/delete (repair drift with sync_s3_index.py)
+S3_OBJECT_INDEX = os.environ.get('S3_OBJECT_INDEX', 'true').lower() == 'true'
+
+# /api/debug-s3/ aggregate stats: how long a background scan result is
+# fresh, and how long a scan may run before another worker may start one
+S3_INVENTORY_STATS_TTL = int(os.environ.get('S3_INVENTORY_STATS_TTL', 300))
+S3_INVENTORY_STATS_SCAN_TIMEOUT = int(os.environ.get('S3_INVENTORY_STATS_SCAN_TIMEOUT', 900))
+
+# Chunk size used when streaming S3 objects through the image proxy
+S3_PROXY_CHUNK_SIZE = int(os.environ.get('S3_PROXY_CHUNK_SIZE', 64 * 1024))
+# Ranges served per request (each costs a GetObject); a Range header asking
+# for more is ignored and the whole object is sent
+S3_PROXY_MAX_RANGES = int(os.environ.get('S3_PROXY_MAX_RANGES', 8))
+
+# Connection pool, keep-alive and timeouts for the shared per-process S3 client
+AWS_S3_MAX_POOL_CONNECTIONS = int(os.environ.get('AWS_S3_MAX_POOL_CONNECTIONS', 50))
+AWS_S3_CONNECT_TIMEOUT = float(os.environ.get('AWS_S3_CONNECT_TIMEOUT', 5))
+AWS_S3_READ_TIMEOUT = float(os.environ.get('AWS_S3_READ_TIMEOUT', 30))
+AWS_S3_TCP_KEEPALIVE = os.environ.get('AWS_S3_TCP_KEEPALIVE', 'true').lower() == 'true'
+AWS_S3_MAX_ATTEMPTS = int(os.environ.get('AWS_S3_MAX_ATTEMPTS', 3))
+
+# Optional node-local disk cache in front of S3 for the image proxy
+# (disabled when S3_IMAGE_CACHE_DIR is empty). Only keys under the listed
+# prefixes are cached, since those objects are never overwritten.
+S3_IMAGE_CACHE_DIR = os.environ.get('S3_IMAGE_CACHE_DIR', '')
+S3_IMAGE_CACHE_MAX_BYTES = int(os.environ.get('S3_IMAGE_CACHE_MAX_BYTES', 1024 * 1024 * 1024))
+S3_IMAGE_CACHE_MAX_OBJECT_BYTES = int(os.environ.get('S3_IMAGE_CACHE_MAX_OBJECT_BYTES', 32 * 1024 * 1024))
+S3_IMAGE_CACHE_PREFIXES = [p for p in os.environ.get('S3_IMAGE_CACHE_PREFIXES', 'images/').split(',') if p]
+
+# Image delivery mode: 'proxy' streams images through /api/s3-image/,
+# 'presigned' hands out short-lived presigned S3 GET URLs (and the proxy
+# endpoint answers with a 302 to one). A URL is reused until the refresh
+# margin and the response cache's lifetime (capped at the margin) would
+# outlast it, so the TTL must exceed both (checked at startup).
+S3_IMAGE_DELIVERY = os.environ.get('S3_IMAGE_DELIVERY', 'proxy').lower()
+S3_PRESIGNED_URL_TTL = int(os.environ.get('S3_PRESIGNED_URL_TTL', 900))
+S3_PRESIGNED_URL_REFRESH_MARGIN = int(os.environ.get('S3_PRESIGNED_URL_REFRESH_MARGIN', 60))
+
+# Widths (in pixels) of the responsive derivatives generated on upload
+IMAGE_DERIVATIVE_WIDTHS = [int(w) for w in os.environ.get('IMAGE_DERIVATIVE_WIDTHS', '160,480,1080').split(',') if w.strip()]
+
+# POST /api/images/batch/: most files per request and how many are
+# written to storage (and get derivatives) concurrently
+IMAGE_BATCH_MAX_FILES = int(os.environ.get('IMAGE_BATCH_MAX_FILES', 200))
+IMAGE_BATCH_WORKERS = int(os.environ.get('IMAGE_BATCH_WORKERS', 8))
+# Django rejects multipart requests with more files than this (default 100)
+DATA_UPLOAD_MAX_NUMBER_FILES = max(100, IMAGE_BATCH_MAX_FILES)
+
+# Stream multipart file fields of /api/images/ straight into an S3
+# multipart upload; parts are buffered up to this size
+S3_STREAMING_UPLOADS = os.environ.get('S3_STREAMING_UPLOADS', 'true').lower() == 'true'
+S3_STREAMING_UPLOAD_PART_SIZE = int(os.environ.get('S3_STREAMING_UPLOAD_PART_SIZE', 8 * 1024 * 1024))
+# Streamed files up to this size are also kept in a spooled temp file so
+# derivatives are built without downloading them again (0 disables)
+S3_STREAMING_UPLOAD_SPOOL_BYTES = int(os.environ.get('S3_STREAMING_UPLOAD_SPOOL_BYTES', 20 * 1024 * 1024))
+
+# Direct-to-S3 browser uploads (presigned POST): size limit enforced by
+# the policy and how long an issued policy stays valid, in seconds
+DIRECT_UPLOAD_MAX_BYTES = int(os.environ.get('DIRECT_UPLOAD_MAX_BYTES', 20 * 1024 * 1024))
+DIRECT_UPLOAD_URL_TTL = int(os.environ.get('DIRECT_UPLOAD_URL_TTL', 600))
+
+# Resumable upload sessions (S3 multipart uploads). S3 requires every part
+# but the last to be at least 5 MiB; sessions idle for longer than
+# UPLOAD_SESSION_MAX_AGE_HOURS are aborted by cleanup_upload_sessions.py
+UPLOAD_SESSION_PART_SIZE = int(os.environ.get('UPLOAD_SESSION_PART_SIZE', 8 * 1024 * 1024))
+UPLOAD_SESSION_MAX_PART_BYTES = int(os.environ.get('UPLOAD_SESSION_MAX_PART_BYTES', 64 * 1024 * 1024))
+UPLOAD_SESSION_MAX_BYTES = int(os.environ.get('UPLOAD_SESSION_MAX_BYTES', 1024 * 1024 * 1024))
+UPLOAD_SESSION_MAX_AGE_HOURS = int(os.environ.get('UPLOAD_SESSION_MAX_AGE_HOURS', 24))
+
+# On-demand transformations on /api/s3-image/<path>?w=&h=&fit=&fmt=
+# Variants are cached in S3 under IMAGE_TRANSFORM_PREFIX; at most
+# IMAGE_TRANSFORM_CONCURRENCY renders run at once per worker process; a
+# request that gets no slot within IMAGE_TRANSFORM_QUEUE_TIMEOUT seconds is
+# answered 503 (kept short: a waiting request holds a worker thread).
+IMAGE_TRANSFORM_PREFIX = os.environ.get('IMAGE_TRANSFORM_PREFIX', '_transforms/')
+IMAGE_TRANSFORM_CONCURRENCY = int(os.environ.get('IMAGE_TRANSFORM_CONCURRENCY', 2))
+IMAGE_TRANSFORM_QUEUE_TIMEOUT = float(os.environ.get('IMAGE_TRANSFORM_QUEUE_TIMEOUT', 0.25))
+IMAGE_TRANSFORM_MAX_DIMENSION = int(os.environ.get('IMAGE_TRANSFORM_MAX_DIMENSION', 4096))
+# Widths and heights variants are rendered at: a requested size is rounded
+# up to the next one (anything larger gets the largest), so each image has
+# a bounded number of variants. The derivative widths are always included.
+# Stored variants are expired by an S3 lifecycle rule on the prefix.
+IMAGE_TRANSFORM_SIZES = sorted(
+    {int(s) for s in os.environ.get('IMAGE_TRANSFORM_SIZES', '64,160,320,480,640,1080,1440,2048').split(',') if s.strip()}
+    | set(IMAGE_DERIVATIVE_WIDTHS)
+)
+IMAGE_TRANSFORM_MAX_SOURCE_BYTES = int(os.environ.get('IMAGE_TRANSFORM_MAX_SOURCE_BYTES', 50 * 1024 * 1024))
+# Originals with more pixels than this are not decoded for transformations
+IMAGE_TRANSFORM_MAX_PIXELS = int(os.environ.get('IMAGE_TRANSFORM_MAX_PIXELS', 40 * 1000 * 1000))
+
 USE_LOCALSTACK = os.environ.get('USE_LOCALSTACK', 'false').lower() == 'true'
 USE_AWS_S3 = os.environ.get('USE_AWS_S3', 'false').lower() == 'true'
 
 if USE_LOCALSTACK:
     # AWS/LocalStack S3 Configuration (Development)
     AWS_S3_ENDPOINT_URL = 'http://localstack:4566'
+    # Endpoint the browser can reach, used to sign presigned URLs
+    AWS_S3_PUBLIC_ENDPOINT_URL = os.environ.get('AWS_S3_PUBLIC_ENDPOINT_URL', 'http://localhost:4566')
     AWS_ACCESS_KEY_ID = os.environ.get('AWS_ACCESS_KEY_ID', 'test')
     AWS_SECRET_ACCESS_KEY = os.environ.get('AWS_SECRET_ACCESS_KEY', 'test')
     AWS_STORAGE_BUCKET_NAME = 'my-test-bucket'
@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+"""
+Utility script to abort stale resumable upload sessions
+
+S3 keeps (and bills) the parts of an unfinished multipart upload until it is
+aborted, so sessions nobody touched for a while are aborted here.
+"""
+import os
+import sys
+import django
+from datetime import timedelta
+
+# Setup Django
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'backend.settings')
+django.setup()
+
+from django.conf import settings
+from django.utils import timezone
+from api.models import UploadSession
+from api.upload_sessions import abort_session
+
+def cleanup_upload_sessions(older_than_hours, dry_run=True):
+    """
+    Abort active upload sessions that have not received a part recently,
+    and sessions whose completion never finished (the worker died)
+
+    Args:
+        older_than_hours (int): Sessions idle for longer than this are aborted
+        dry_run (bool): If True, only show what would be aborted
+    """
+    print("🧹 Cleaning up stale upload sessions...")
+    print(f"🔍 Mode: {'DRY RUN (no changes will be made)' if dry_run else 'LIVE (changes will be applied)'}")
+
+    cutoff = timezone.now() - timedelta(hours=older_than_hours)
+    stale = UploadSession.objects.filter(
+        status__in=(UploadSession.ACTIVE, UploadSession.COMPLETING), updated_at__lt=cutoff
+    ).order_by('updated_at')
+    print(f"📝 Found {stale.count()} sessions idle for more than {older_than_hours}h")
+
+    aborted_count = 0
+    for session in stale.iterator():
+        if dry_run:
+            print(f"  📋 Would abort: {session.id} ({session.name}, last activity {session.updated_at.isoformat()})")
+            continue
+        try:
+            abort_session(session, force=True)
+            aborted_count += 1
+            print(f"  🗑️  Aborted: {session.id} ({session.name})")
+        except Exception as e:
+            print(f"  ❌ Error aborting {session.id}: {e}")
+
+    if not dry_run:
+        print(f"\n✅ Aborted {aborted_count} upload sessions")
+
+if __name__ == '__main__':
+    hours = settings.UPLOAD_SESSION_MAX_AGE_HOURS
+    if '--older-than' in sys.argv:
+        hours = int(sys.argv[sys.argv.index('--older-than') + 1])
+
+    cleanup_upload_sessions(hours, dry_run='--fix' not in sys.argv)
+
+    if '--fix' not in sys.argv:
+        print(f"\n" + "="*60)
+        print("🔧 USAGE:")
+        print("  python cleanup_upload_sessions.py                    # Dry run")
+        print("  python cleanup_upload_sessions.py --fix              # Abort stale sessions")
+        print("  python cleanup_upload_sessions.py --older-than HOURS # Idle threshold (default UPLOAD_SESSION_MAX_AGE_HOURS)")
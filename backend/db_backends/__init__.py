@@ -0,0 +1,3 @@
+"""
+Custom Django database backends
+"""
@@ -0,0 +1,3 @@
+"""
+PostgreSQL backend that takes connections from a per-process pool
+"""
@@ -0,0 +1,141 @@
+"""
+PostgreSQL backend with an in-process connection pool.
+
+Django opens a connection per thread and closes it at the end of each
+request (CONN_MAX_AGE = 0). With this backend "opening" checks a connection
+out of a pool shared by the worker's threads and "closing" returns it, so
+requests skip the TCP/TLS/auth handshake and each worker process holds at
+most ``max_size`` connections however many threads it runs.
+
+Configured through ``OPTIONS['pool']``::
+
+    'OPTIONS': {'pool': {'max_size': 4, 'timeout': 10, 'max_idle': 300}}
+"""
+import collections
+import os
+import threading
+import time
+
+from django.db.backends.postgresql.base import DatabaseWrapper as PostgresDatabaseWrapper
+from psycopg2 import extensions, OperationalError
+
+_lock = threading.Lock()
+_pools = {}
+
+
+def _reset_after_fork():
+    """Forked workers must not reuse the parent's sockets (preload_app)"""
+    global _lock, _pools
+    _lock = threading.Lock()
+    _pools = {}
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+class ConnectionPool:
+    """
+    A bounded pool of psycopg2 connections. ``getconn`` blocks up to
+    ``timeout`` seconds when all ``max_size`` connections are checked out;
+    idle connections older than ``max_idle`` seconds are closed.
+    """
+
+    def __init__(self, connect, max_size=4, timeout=10, max_idle=300, health_checks=False):
+        self.connect = connect
+        self.max_size = max_size
+        self.timeout = timeout
+        self.max_idle = max_idle
+        self.health_checks = health_checks
+        self._idle = collections.deque()
+        self._idle_lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(max_size)
+
+    def _pop_idle(self):
+        """The most recently returned usable connection, or None"""
+        while True:
+            with self._idle_lock:
+                if not self._idle:
+                    return None
+                connection, returned_at = self._idle.pop()
+            if connection.closed or time.monotonic() - returned_at > self.max_idle:
+                connection.close()
+                continue
+            if self.health_checks and not self._is_usable(connection):
+                connection.close()
+                continue
+            return connection
+
+    @staticmethod
+    def _is_usable(connection):
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute('SELECT 1')
+            return True
+        except Exception:
+            return False
+
+    def getconn(self):
+        if not self._slots.acquire(timeout=self.timeout):
+            raise OperationalError(
+                f"No database connection available within {self.timeout}s "
+                f"(pool max_size is {self.max_size})"
+            )
+        try:
+            return self._pop_idle() or self.connect()
+        except BaseException:
+            self._slots.release()
+            raise
+
+    def putconn(self, connection, discard=False):
+        try:
+            if not discard and not connection.closed:
+                status = connection.info.transaction_status
+                if status == extensions.TRANSACTION_STATUS_UNKNOWN:
+                    discard = True
+                elif status != extensions.TRANSACTION_STATUS_IDLE:
+                    connection.rollback()
+            if discard or connection.closed:
+                connection.close()
+            else:
+                with self._idle_lock:
+                    self._idle.append((connection, time.monotonic()))
+        except Exception:
+            connection.close()
+        finally:
+            self._slots.release()
+
+
+class DatabaseWrapper(PostgresDatabaseWrapper):
+    def get_connection_params(self):
+        conn_params = super().get_connection_params()
+        conn_params.pop('pool', None)
+        return conn_params
+
+    def _get_pool(self, conn_params):
+        pool = _pools.get(self.alias)
+        if pool is None:
+            with _lock:
+                pool = _pools.get(self.alias)
+                if pool is None:
+                    options = self.settings_dict['OPTIONS'].get('pool') or {}
+                    pool = ConnectionPool(
+                        lambda: super(DatabaseWrapper, self).get_new_connection(conn_params),
+                        max_size=options.get('max_size', 4),
+                        timeout=options.get('timeout', 10),
+                        max_idle=options.get('max_idle', 300),
+                        health_checks=self.settings_dict['CONN_HEALTH_CHECKS'],
+                    )
+                    _pools[self.alias] = pool
+        return pool
+
+    def get_new_connection(self, conn_params):
+        self.pool = self._get_pool(conn_params)
+        return self.pool.getconn()
+
+    def _close(self):
+        if self.connection is not None:
+            with self.wrap_database_errors:
+                # close_if_unusable_or_obsolete() clears errors_occurred on
+                # connections that still work, so a set flag means a broken one
+                self.pool.putconn(self.connection, discard=self.errors_occurred)
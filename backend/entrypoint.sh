@@ -31,6 +31,16 @@ if [ "${USE_LOCALSTACK}" = "true" ]; then
         echo "Creating S3 bucket..."
         aws --endpoint-url=http://localstack:4566 s3 mb s3://my-test-bucket
     fi
+
+    # Allow the browser to upload directly to the bucket (presigned POST)
+    aws --endpoint-url=http://localstack:4566 s3api put-bucket-cors --bucket my-test-bucket \
+        --cors-configuration '{"CORSRules":[{"AllowedOrigins":["*"],"AllowedMethods":["GET","POST","PUT"],"AllowedHeaders":["*"],"ExposeHeaders":["ETag"]}]}' \
+        || echo "Could not configure bucket CORS"
+
+    # Transformation variants are re-rendered on demand, so let S3 expire them
+    aws --endpoint-url=http://localstack:4566 s3api put-bucket-lifecycle-configuration --bucket my-test-bucket \
+        --lifecycle-configuration "{\"Rules\":[{\"ID\":\"expire-transform-variants\",\"Status\":\"Enabled\",\"Filter\":{\"Prefix\":\"${IMAGE_TRANSFORM_PREFIX:-_transforms/}\"},\"Expiration\":{\"Days\":${IMAGE_TRANSFORM_EXPIRE_DAYS:-30}}}]}" \
+        || echo "Could not configure the bucket lifecycle"
 fi
 
 echo "Starting Django server..."
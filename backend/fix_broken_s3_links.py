@@ -1,207 +1,316 @@
 #!/usr/bin/env python
 """
 Utility script to fix broken S3 links in the database
+
+The bucket is listed with paginated, parallel key-range scans and the
+database is streamed, so the reconcile stays correct (and bounded in time)
+on buckets with millions of objects. Deletes are batched: 1,000 keys per
+DeleteObjects request and chunked queryset deletes for Image rows.
 """
 import os
+import sys
+import json
+import time
 import django
-from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
 
 # Setup Django
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'backend.settings')
 django.setup()
 
-import boto3
+from botocore.exceptions import ClientError
+from s3_client import get_s3_client, s3_key
 from django.conf import settings
-from api.models import Image
+from django.utils import timezone
+from api.models import Image, S3Object
+from api.bucket_inventory import list_bucket
+from api.object_index import broken_images, orphaned_objects, record_object
+
+# DeleteObjects accepts at most 1,000 keys per request
+S3_DELETE_BATCH = 1000
+DB_DELETE_BATCH = 1000
+LIST_WORKERS = 16
+HEAD_WORKERS = 16
+# Objects (and records) younger than this may belong to uploads still in progress
+MIN_ORPHAN_AGE = timedelta(hours=2)
+# How many entries of each category are printed (the JSON report has all)
+PRINT_LIMIT = 50
+
+def reconcile():
+    """
+    Compare the bucket with the database. Returns a report dict with the
+    broken Image records (original missing in S3), records with missing
+    derivatives and orphaned S3 keys (no record references them).
+    """
+    started = timezone.now()
+    bucket = settings.AWS_STORAGE_BUCKET_NAME
+    root = s3_key('')
+
+    print(f"\n📡 Listing S3 bucket: {bucket}{f' (prefix {root})' if root else ''}")
+    t0 = time.monotonic()
+    s3_names = set()
+    recent_names = set()
+    for obj in list_bucket(root, workers=LIST_WORKERS):
+        name = obj['Key'][len(root):]
+        s3_names.add(name)
+        if obj['LastModified'] > started - MIN_ORPHAN_AGE:
+            recent_names.add(name)
+    print(f"📁 Found {len(s3_names)} files in S3 ({time.monotonic() - t0:.1f}s)")
+
+    print(f"\n💾 Streaming database Image records...")
+    t0 = time.monotonic()
+    broken = []
+    missing_derivatives = []
+    referenced = set()
+    db_rows = 0
+    # Rows created after the listing started may point at files it missed
+    rows = Image.objects.filter(uploaded_at__lt=started).values_list(
+        'id', 'title', 'image', 'derivatives'
+    ).order_by('id')
+    for image_id, title, name, derivatives in rows.iterator(chunk_size=2000):
+        db_rows += 1
+        if not name or name not in s3_names:
+            broken.append({'id': image_id, 'title': title, 'name': name or None})
+        referenced.add(name)
+        missing = []
+        for derivative in (derivatives or {}).values():
+            referenced.add(derivative)
+            if derivative not in s3_names:
+                missing.append(derivative)
+        if missing:
+            missing_derivatives.append({'id': image_id, 'names': missing})
+    # Rows newer than the listing still own their files
+    for name, derivatives in Image.objects.filter(uploaded_at__gte=started).values_list('image', 'derivatives').iterator():
+        referenced.add(name)
+        referenced.update((derivatives or {}).values())
+    print(f"📝 Scanned {db_rows} Image records ({time.monotonic() - t0:.1f}s)")
+
+    orphaned = sorted(s3_key(name) for name in s3_names - referenced - recent_names)
+    return {
+        'bucket': bucket,
+        'prefix': root,
+        'started_at': started.isoformat(),
+        'source': 'bucket',
+        's3_objects': len(s3_names),
+        'db_records': db_rows,
+        'broken': broken,
+        'missing_derivatives': missing_derivatives,
+        'orphaned': orphaned,
+        'deleted_records': 0,
+        'deleted_objects': 0,
+        'errors': [],
+    }
+
+def head_object(s3_client, name):
+    """HEAD the object of ``name``; None if it does not exist"""
+    try:
+        return s3_client.head_object(Bucket=settings.AWS_STORAGE_BUCKET_NAME, Key=s3_key(name))
+    except ClientError as e:
+        if e.response['Error']['Code'] in ('404', 'NoSuchKey', 'NotFound'):
+            return None
+        raise
+
+def confirm_missing(candidates):
+    """
+    HEAD the original of each broken candidate found through the index and
+    return those really missing from S3. Objects that do exist were never
+    indexed (a failed index write, or a write outside the app): they are
+    added to the index rather than reported.
+    """
+    s3_client = get_s3_client()
+    named = [img for img in candidates if img['name']]
+    with ThreadPoolExecutor(max_workers=HEAD_WORKERS) as pool:
+        heads = list(pool.map(lambda img: head_object(s3_client, img['name']), named))
+    found = {}
+    for img, head in zip(named, heads):
+        if head is not None:
+            found[img['id']] = img['name']
+            record_object(img['name'], head['ContentLength'], head.get('ContentType'), head.get('ETag'))
+    if found:
+        print(f"🔁 {len(found)} originals missing from the index exist in S3 (re-indexed)")
+    return [img for img in candidates if img['id'] not in found]
 
-def fix_broken_s3_links(dry_run=True):
+def reconcile_from_index():
+    """
+    Same report as reconcile(), computed with SQL anti-joins against the
+    S3 object index (run sync_s3_index.py first if it may have drifted).
+    Broken candidates are confirmed with a HEAD request each before they
+    are reported. Missing derivatives are not checked in this mode.
+    """
+    started = timezone.now()
+    print(f"\n🗃️  Querying the S3 object index...")
+    t0 = time.monotonic()
+    candidates = [
+        {'id': image_id, 'title': title, 'name': name or None}
+        for image_id, title, name in broken_images(older_than=started - MIN_ORPHAN_AGE).values_list(
+            'id', 'title', 'image'
+        ).order_by('id').iterator()
+    ]
+    broken = confirm_missing(candidates)
+    orphaned = list(
+        orphaned_objects(older_than=started - MIN_ORPHAN_AGE).order_by('key').values_list('key', flat=True).iterator()
+    )
+    print(f"📝 Done in {time.monotonic() - t0:.1f}s")
+    return {
+        'bucket': settings.AWS_STORAGE_BUCKET_NAME,
+        'prefix': s3_key(''),
+        'started_at': started.isoformat(),
+        'source': 'index',
+        's3_objects': S3Object.objects.count(),
+        'db_records': Image.objects.count(),
+        'broken': broken,
+        'missing_derivatives': [],
+        'orphaned': orphaned,
+        'deleted_records': 0,
+        'deleted_objects': 0,
+        'errors': [],
+    }
+
+def delete_images(ids):
+    """Delete Image records in chunks; returns the number deleted"""
+    deleted = 0
+    for i in range(0, len(ids), DB_DELETE_BATCH):
+        deleted += Image.objects.filter(pk__in=ids[i:i + DB_DELETE_BATCH]).delete()[1].get('api.Image', 0)
+        print(f"  🗑️  Deleted {deleted}/{len(ids)} records")
+    return deleted
+
+def delete_s3_keys(keys, errors):
+    """Delete keys with DeleteObjects, 1,000 at a time; returns the number deleted"""
+    s3_client = get_s3_client()
+    deleted = 0
+    for i in range(0, len(keys), S3_DELETE_BATCH):
+        batch = keys[i:i + S3_DELETE_BATCH]
+        response = s3_client.delete_objects(
+            Bucket=settings.AWS_STORAGE_BUCKET_NAME,
+            Delete={'Objects': [{'Key': key} for key in batch], 'Quiet': True}
+        )
+        failures = response.get('Errors', [])
+        errors.extend({'key': e['Key'], 'error': e.get('Message', e.get('Code'))} for e in failures)
+        failed_keys = {e['Key'] for e in failures}
+        # Keep the S3 object index in step (these deletes bypass the storage backend)
+        S3Object.objects.filter(key__in=[key for key in batch if key not in failed_keys]).delete()
+        deleted += len(batch) - len(failures)
+        print(f"  🗑️  Deleted {deleted}/{len(keys)} S3 files")
+    return deleted
+
+def confirm(message, assume_yes):
+    print(f"\n⚠️  WARNING: {message}")
+    print("   This action cannot be undone.")
+    if assume_yes:
+        return True
+    return input("   Type 'DELETE' to confirm: ") == 'DELETE'
+
+def fix_broken_s3_links(report, dry_run=True, assume_yes=False):
     """
     Fix broken S3 links by removing database records that point to non-existent S3 files
-    
+
     Args:
+        report (dict): Result of reconcile()
         dry_run (bool): If True, only show what would be deleted without actually deleting
+        assume_yes (bool): Skip the interactive confirmation
     """
-    print("🔧 Fixing broken S3 links...")
+    print("\n🔧 Fixing broken S3 links...")
     print(f"🔍 Mode: {'DRY RUN (no changes will be made)' if dry_run else 'LIVE (changes will be applied)'}")
-    
-    try:
-        # Create S3 client
-        s3_client = boto3.client(
-            's3',
-            endpoint_url=settings.AWS_S3_ENDPOINT_URL,
-            aws_access_key_id=settings.AWS_ACCESS_KEY_ID,
-            aws_secret_access_key=settings.AWS_SECRET_ACCESS_KEY,
-            region_name=settings.AWS_S3_REGION_NAME,
-            verify=settings.AWS_S3_VERIFY,
-            use_ssl=settings.AWS_S3_USE_SSL
-        )
-        
-        # Get all S3 files
-        print(f"\n📡 Fetching S3 files from bucket: {settings.AWS_STORAGE_BUCKET_NAME}")
-        response = s3_client.list_objects_v2(Bucket=settings.AWS_STORAGE_BUCKET_NAME)
-        s3_files = set()
-        if 'Contents' in response:
-            s3_files = {obj['Key'] for obj in response['Contents']}
-            print(f"📁 Found {len(s3_files)} files in S3")
-        else:
-            print("📭 S3 bucket is empty")
-        
-        # Get all database Image records
-        print(f"\n💾 Checking database Image records...")
-        all_images = Image.objects.all()
-        print(f"📝 Found {all_images.count()} Image records in database")
-        
-        # Find broken links
-        broken_images = []
-        valid_images = []
-        
-        for img in all_images:
-            if img.image and img.image.name:
-                if img.image.name not in s3_files:
-                    broken_images.append(img)
-                else:
-                    valid_images.append(img)
-            else:
-                # Image record with no file reference
-                broken_images.append(img)
-        
-        print(f"\n🔗 Link Analysis:")
-        print(f"  ✅ Valid links: {len(valid_images)}")
-        print(f"  ❌ Broken links: {len(broken_images)}")
-        
-        if not broken_images:
-            print("\n🎉 No broken links found! All database records are valid.")
-            return
-        
-        # Show broken links
-        print(f"\n❌ Broken Image records:")
-        for img in broken_images:
-            file_ref = img.image.name if img.image else "No file reference"
-            print(f"  🗑️  ID:{img.id} - '{img.title or 'Untitled'}' -> {file_ref}")
-        
-        if dry_run:
-            print(f"\n🔍 DRY RUN: Would delete {len(broken_images)} broken Image records")
-            print("   Run with --fix flag to actually delete these records")
-        else:
-            # Confirm deletion
-            print(f"\n⚠️  WARNING: About to delete {len(broken_images)} Image records!")
-            print("   This action cannot be undone.")
-            
-            confirm = input("   Type 'DELETE' to confirm: ")
-            if confirm == 'DELETE':
-                deleted_count = 0
-                for img in broken_images:
-                    try:
-                        img_id = img.id
-                        img_title = img.title or 'Untitled'
-                        img.delete()
-                        deleted_count += 1
-                        print(f"  🗑️  Deleted: ID:{img_id} - '{img_title}'")
-                    except Exception as e:
-                        print(f"  ❌ Error deleting ID:{img.id}: {e}")
-                
-                print(f"\n✅ Successfully deleted {deleted_count} broken Image records")
-            else:
-                print("\n❌ Deletion cancelled")
-        
-    except Exception as e:
-        print(f"❌ Error during fix operation: {e}")
+    broken = report['broken']
+
+    print(f"\n🔗 Link Analysis:")
+    print(f"  ✅ Valid links: {report['db_records'] - len(broken)}")
+    print(f"  ❌ Broken links: {len(broken)}")
+    if report['missing_derivatives']:
+        print(f"  ⚠️  Records with missing derivatives: {len(report['missing_derivatives'])}")
 
-def clean_orphaned_s3_files(dry_run=True):
+    if not broken:
+        print("\n🎉 No broken links found! All database records are valid.")
+        return
+
+    print(f"\n❌ Broken Image records:")
+    for img in broken[:PRINT_LIMIT]:
+        print(f"  🗑️  ID:{img['id']} - '{img['title'] or 'Untitled'}' -> {img['name'] or 'No file reference'}")
+    if len(broken) > PRINT_LIMIT:
+        print(f"  ... and {len(broken) - PRINT_LIMIT} more (see --report)")
+
+    if dry_run:
+        print(f"\n🔍 DRY RUN: Would delete {len(broken)} broken Image records")
+        print("   Run with --fix flag to actually delete these records")
+    elif confirm(f"About to delete {len(broken)} Image records!", assume_yes):
+        report['deleted_records'] = delete_images([img['id'] for img in broken])
+        print(f"\n✅ Successfully deleted {report['deleted_records']} broken Image records")
+    else:
+        print("\n❌ Deletion cancelled")
+
+def clean_orphaned_s3_files(report, dry_run=True, assume_yes=False):
     """
     Clean up S3 files that have no corresponding database records
-    
+
     Args:
+        report (dict): Result of reconcile()
         dry_run (bool): If True, only show what would be deleted without actually deleting
+        assume_yes (bool): Skip the interactive confirmation
     """
     print("\n🧹 Cleaning orphaned S3 files...")
     print(f"🔍 Mode: {'DRY RUN (no changes will be made)' if dry_run else 'LIVE (changes will be applied)'}")
-    
+    orphaned = report['orphaned']
+
+    print(f"📁 S3 files: {report['s3_objects']}")
+    print(f"🗂️ Orphaned files: {len(orphaned)}")
+
+    if not orphaned:
+        print("\n🎉 No orphaned S3 files found!")
+        return
+
+    print(f"\n🗂️ Orphaned S3 files:")
+    for file_key in orphaned[:PRINT_LIMIT]:
+        print(f"  🗑️  {file_key}")
+    if len(orphaned) > PRINT_LIMIT:
+        print(f"  ... and {len(orphaned) - PRINT_LIMIT} more (see --report)")
+
+    if dry_run:
+        print(f"\n🔍 DRY RUN: Would delete {len(orphaned)} orphaned S3 files")
+        print("   Run with --clean-s3 flag to actually delete these files")
+    elif confirm(f"About to delete {len(orphaned)} S3 files!", assume_yes):
+        report['deleted_objects'] = delete_s3_keys(orphaned, report['errors'])
+        print(f"\n✅ Successfully deleted {report['deleted_objects']} orphaned S3 files")
+        for error in report['errors'][:PRINT_LIMIT]:
+            print(f"  ❌ Error deleting {error['key']}: {error['error']}")
+    else:
+        print("\n❌ Deletion cancelled")
+
+def write_report(report, path):
+    with open(path, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"\n📄 Report written to {path}")
+
+if __name__ == '__main__':
+    fix = '--fix' in sys.argv or '--clean-all' in sys.argv
+    clean = '--clean-s3' in sys.argv or '--clean-all' in sys.argv
+    assume_yes = '--yes' in sys.argv
+    report_path = sys.argv[sys.argv.index('--report') + 1] if '--report' in sys.argv else None
+
     try:
-        # Create S3 client
-        s3_client = boto3.client(
-            's3',
-            endpoint_url=settings.AWS_S3_ENDPOINT_URL,
-            aws_access_key_id=settings.AWS_ACCESS_KEY_ID,
-            aws_secret_access_key=settings.AWS_SECRET_ACCESS_KEY,
-            region_name=settings.AWS_S3_REGION_NAME,
-            verify=settings.AWS_S3_VERIFY,
-            use_ssl=settings.AWS_S3_USE_SSL
-        )
-        
-        # Get all S3 files
-        response = s3_client.list_objects_v2(Bucket=settings.AWS_STORAGE_BUCKET_NAME)
-        s3_files = []
-        if 'Contents' in response:
-            s3_files = [obj['Key'] for obj in response['Contents']]
-        
-        # Get all database file references
-        db_files = set()
-        for img in Image.objects.all():
-            if img.image and img.image.name:
-                db_files.add(img.image.name)
-        
-        # Find orphaned files
-        orphaned_files = [f for f in s3_files if f not in db_files]
-        
-        print(f"📁 S3 files: {len(s3_files)}")
-        print(f"💾 DB references: {len(db_files)}")
-        print(f"🗂️ Orphaned files: {len(orphaned_files)}")
-        
-        if not orphaned_files:
-            print("\n🎉 No orphaned S3 files found!")
-            return
-        
-        print(f"\n🗂️ Orphaned S3 files:")
-        for file_key in orphaned_files:
-            print(f"  🗑️  {file_key}")
-        
-        if dry_run:
-            print(f"\n🔍 DRY RUN: Would delete {len(orphaned_files)} orphaned S3 files")
-            print("   Run with --clean-s3 flag to actually delete these files")
-        else:
-            print(f"\n⚠️  WARNING: About to delete {len(orphaned_files)} S3 files!")
-            print("   This action cannot be undone.")
-            
-            confirm = input("   Type 'DELETE' to confirm: ")
-            if confirm == 'DELETE':
-                deleted_count = 0
-                for file_key in orphaned_files:
-                    try:
-                        s3_client.delete_object(
-                            Bucket=settings.AWS_STORAGE_BUCKET_NAME,
-                            Key=file_key
-                        )
-                        deleted_count += 1
-                        print(f"  🗑️  Deleted: {file_key}")
-                    except Exception as e:
-                        print(f"  ❌ Error deleting {file_key}: {e}")
-                
-                print(f"\n✅ Successfully deleted {deleted_count} orphaned S3 files")
-            else:
-                print("\n❌ Deletion cancelled")
-        
+        report = reconcile_from_index() if '--use-index' in sys.argv else reconcile()
     except Exception as e:
-        print(f"❌ Error during S3 cleanup: {e}")
+        print(f"❌ Error during reconcile: {e}")
+        sys.exit(1)
 
-if __name__ == '__main__':
-    import sys
-    
-    if '--fix' in sys.argv:
-        fix_broken_s3_links(dry_run=False)
-    elif '--clean-s3' in sys.argv:
-        clean_orphaned_s3_files(dry_run=False)
-    elif '--clean-all' in sys.argv:
-        fix_broken_s3_links(dry_run=False)
-        clean_orphaned_s3_files(dry_run=False)
+    if fix or clean:
+        if fix:
+            fix_broken_s3_links(report, dry_run=False, assume_yes=assume_yes)
+        if clean:
+            clean_orphaned_s3_files(report, dry_run=False, assume_yes=assume_yes)
     else:
         # Default: dry run for both operations
-        fix_broken_s3_links(dry_run=True)
-        clean_orphaned_s3_files(dry_run=True)
-        
+        fix_broken_s3_links(report, dry_run=True)
+        clean_orphaned_s3_files(report, dry_run=True)
+
         print(f"\n" + "="*60)
         print("🔧 USAGE:")
         print("  python fix_broken_s3_links.py           # Dry run (show what would be fixed)")
         print("  python fix_broken_s3_links.py --fix     # Fix broken database records")
         print("  python fix_broken_s3_links.py --clean-s3 # Clean orphaned S3 files")
-        print("  python fix_broken_s3_links.py --clean-all # Fix both issues")
\ No newline at end of file
+        print("  python fix_broken_s3_links.py --clean-all # Fix both issues")
+        print("  Add --yes to skip the confirmation and --report PATH for a JSON report")
+        print("  Add --use-index to query the S3 object index instead of listing the bucket")
+
+    if report_path:
+        write_report(report, report_path)
@@ -1,16 +1,176 @@
+"""
+Gunicorn configuration.
+
+GUNICORN_WORKER_CLASS selects a worker profile:
+
+- ``sync``: one request per process (the default)
+- ``gthread``: GUNICORN_THREADS requests per process on a thread pool
+- ``gevent``: greenlets, up to GUNICORN_WORKER_CONNECTIONS per process
+  (database connections are closed after each request unless DB_POOL=true)
+- ``uvicorn``: ASGI event loop per process, serving the async S3 views
+  (USE_ASGI=true selects it by default; database connections are closed
+  after each request unless DB_POOL=true, as with gevent)
+
+Worker counts are derived from the container's cgroup CPU quota and
+memory limit rather than the host's core count. Every value can be
+overridden with the GUNICORN_* variable named next to it.
+"""
+import glob
+import math
 import multiprocessing
 import os
 
+PROFILES = {
+    # timeout: for sync workers this bounds a request; the other classes
+    # keep heartbeating while they serve, so it only detects hung workers
+    'sync': {
+        'worker_class': 'sync',
+        'workers': lambda cpus: cpus * 2 + 1,
+        'timeout': 120,
+        'graceful_timeout': 30,
+        # Sync workers close the connection after each response anyway
+        'keepalive': 2,
+    },
+    'gthread': {
+        'worker_class': 'gthread',
+        'workers': lambda cpus: cpus + 1,
+        'threads': 8,
+        'timeout': 30,
+        'graceful_timeout': 30,
+        'keepalive': 5,
+    },
+    'gevent': {
+        'worker_class': 'gevent',
+        'workers': lambda cpus: cpus + 1,
+        'worker_connections': 1000,
+        'timeout': 30,
+        # Let long S3 transfers finish on shutdown
+        'graceful_timeout': 60,
+        'keepalive': 5,
+    },
+    'uvicorn': {
+        'worker_class': 'uvicorn_worker.UvicornWorker',
+        'workers': lambda cpus: cpus + 1,
+        'timeout': 30,
+        'graceful_timeout': 60,
+        'keepalive': 5,
+    },
+}
+
+# Rough resident memory of one worker, used to cap the worker count
+WORKER_MEMORY_MB = int(os.environ.get('GUNICORN_WORKER_MEMORY_MB', 200))
+# Share of the memory limit the workers may use together
+MEMORY_HEADROOM = 0.8
+
+
+def _read(path):
+    try:
+        with open(path) as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+
+def cgroup_cpus():
+    """CPUs available to this container: the CFS quota, else the affinity mask"""
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cpus = multiprocessing.cpu_count()
+
+    quota = period = None
+    cpu_max = _read('/sys/fs/cgroup/cpu.max')  # cgroup v2: "<quota|max> <period>"
+    if cpu_max:
+        value, _, value_period = cpu_max.partition(' ')
+        if value != 'max':
+            quota, period = int(value), int(value_period or 100000)
+    else:  # cgroup v1
+        value = _read('/sys/fs/cgroup/cpu/cpu.cfs_quota_us')
+        value_period = _read('/sys/fs/cgroup/cpu/cpu.cfs_period_us')
+        if value and value_period and int(value) > 0:
+            quota, period = int(value), int(value_period)
+    if quota and period:
+        cpus = min(cpus, max(1, math.ceil(quota / period)))
+    return cpus
+
+
+def cgroup_memory_bytes():
+    """The container's memory limit, else physical memory, else None"""
+    value = _read('/sys/fs/cgroup/memory.max')  # cgroup v2
+    if value is None:
+        value = _read('/sys/fs/cgroup/memory/memory.limit_in_bytes')  # cgroup v1
+    # v1 reports "no limit" as a huge number
+    if value and value != 'max' and int(value) < 1 << 60:
+        return int(value)
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    except (ValueError, OSError, AttributeError):
+        return None
+
+
+def _env_int(name, default):
+    value = os.environ.get(name)
+    return int(value) if value else default
+
+
+mode = os.environ.get('GUNICORN_WORKER_CLASS', '').lower() or (
+    'uvicorn' if os.environ.get('USE_ASGI', 'false').lower() == 'true' else 'sync'
+)
+if mode not in PROFILES:
+    raise RuntimeError(f"GUNICORN_WORKER_CLASS must be one of {', '.join(PROFILES)}, not {mode!r}")
+profile = PROFILES[mode]
+
+if mode in ('gevent', 'uvicorn') and os.environ.get('DB_POOL', 'false').lower() != 'true':
+    # Django's connections are per greenlet (gevent) or per thread, and
+    # under ASGI each request's sync ORM work runs in a fresh thread: a
+    # connection kept open past its request (CONN_MAX_AGE > 0) is never
+    # reused and stays open until it is garbage collected, so they would
+    # pile up per worker. Close them after every request instead (with
+    # DB_POOL they go back to the pool).
+    os.environ['DB_CONN_MAX_AGE'] = '0'
+
+if mode == 'uvicorn':
+    # The async S3 views are only routed when USE_ASGI is set (see api/urls.py)
+    os.environ['USE_ASGI'] = 'true'
+    wsgi_app = 'backend.asgi:application'
+else:
+    wsgi_app = 'backend.wsgi:application'
+
+# Every worker writes its metrics here and /api/metrics/ aggregates them.
+# Must be set before the app (and prometheus_client) is loaded. Same
+# default as METRICS_ENABLED in settings.py: the endpoint is only served
+# with a METRICS_TOKEN, so without one nothing would read the files.
+metrics_enabled = os.environ.get(
+    'METRICS_ENABLED', 'true' if os.environ.get('METRICS_TOKEN') else 'false'
+).lower() == 'true'
+if metrics_enabled:
+    os.environ.setdefault('PROMETHEUS_MULTIPROC_DIR', '/tmp/prometheus_multiproc')
+    os.makedirs(os.environ['PROMETHEUS_MULTIPROC_DIR'], exist_ok=True)
+    # Files of a previous run would add their counts to this one's
+    for path in glob.glob(os.path.join(os.environ['PROMETHEUS_MULTIPROC_DIR'], '*.db')):
+        os.remove(path)
+
+cpus = cgroup_cpus()
+memory = cgroup_memory_bytes()
+
 # Server socket
 bind = "0.0.0.0:8000"
 backlog = 2048
 
 # Worker processes
-workers = multiprocessing.cpu_count() * 2 + 1
-worker_class = "sync"
-worker_connections = 1000
-timeout = 120
-keepalive = 2
+worker_class = profile['worker_class']
+workers = profile['workers'](cpus)
+if memory:
+    workers = min(workers, max(1, int(memory * MEMORY_HEADROOM / (WORKER_MEMORY_MB * 1024 * 1024))))
+workers = _env_int('GUNICORN_WORKERS', workers)
+if 'threads' in profile:
+    threads = _env_int('GUNICORN_THREADS', profile['threads'])
+if 'worker_connections' in profile:
+    worker_connections = _env_int('GUNICORN_WORKER_CONNECTIONS', profile['worker_connections'])
+timeout = _env_int('GUNICORN_TIMEOUT', profile['timeout'])
+graceful_timeout = _env_int('GUNICORN_GRACEFUL_TIMEOUT', profile['graceful_timeout'])
+# Raise above the load balancer's idle timeout when running behind one
+keepalive = _env_int('GUNICORN_KEEPALIVE', profile['keepalive'])
 
 # Restart workers after this many requests, to help prevent memory leaks
 max_requests = 1000
@@ -26,7 +186,9 @@ access_log_format = '%(h)s %(l)s %(u)s %(t)s "%(r)s" %(s)s %(b)s "%(f)s" "%(a)s"
 proc_name = 'django_gunicorn'
 
 # Server mechanics
-preload_app = True
+# gevent must monkey-patch before the app imports ssl/threading, so it
+# loads the app in each worker instead
+preload_app = mode != 'gevent'
 daemon = False
 pidfile = '/tmp/gunicorn.pid'
 user = None
@@ -35,4 +197,29 @@ tmp_upload_dir = None
 
 # SSL (if needed in future)
 # keyfile = None
-# certfile = None
\ No newline at end of file
+# certfile = None
+
+
+def when_ready(server):
+    server.log.info(
+        "Worker profile %s: %d workers%s (%d CPUs, %s memory limit)",
+        mode,
+        workers,
+        f" x {threads} threads" if 'threads' in profile else '',
+        cpus,
+        f"{memory // (1024 * 1024)} MB" if memory else 'unknown',
+    )
+
+
+def post_fork(server, worker):
+    if mode == 'gevent':
+        # Make psycopg2 yield to other greenlets while waiting on Postgres
+        from psycogreen.gevent import patch_psycopg
+        patch_psycopg()
+
+
+def child_exit(server, worker):
+    if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        # Drop the dead worker's live gauges (its counters stay in the totals)
+        from prometheus_client import multiprocess
+        multiprocess.mark_process_dead(worker.pid)
@@ -1,78 +1,197 @@
 #!/usr/bin/env python
 """
 Script to migrate existing local images to LocalStack S3
+
+Rows are streamed from the database in batches and their files (originals
+and derivatives) are uploaded from MEDIA_ROOT by a pool of threads. A
+checkpoint file records progress, so an interrupted run can be resumed
+and only rows that are not finished yet are processed again.
 """
 import os
+import json
+import time
+import argparse
+import mimetypes
 import django
-from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
 
 # Setup Django
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'backend.settings')
 django.setup()
 
-from django.core.files.storage import default_storage
-from api.models import Image
-import boto3
+from botocore.exceptions import ClientError
 from django.conf import settings
+from django.db import connections
+from django.db.models import Q
+from api.caching import invalidate_after_bulk_write
+from api.models import Image
+from api.object_index import record_object
+from s3_client import get_s3_client, object_params, s3_key
+
+DEFAULT_CHECKPOINT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '.migrate_to_s3.checkpoint')
+
+def load_checkpoint(path):
+    """Last fully processed primary key and the rows that failed before it"""
+    if not os.path.exists(path):
+        return {'last_pk': 0, 'failed': []}
+    with open(path) as f:
+        return json.load(f)
+
+def save_checkpoint(path, checkpoint):
+    # Write to a temp file first so a crash never leaves a truncated checkpoint
+    with open(f'{path}.tmp', 'w') as f:
+        json.dump(checkpoint, f)
+    os.replace(f'{path}.tmp', path)
+
+def upload_file(s3_client, storage, name):
+    """
+    Upload MEDIA_ROOT/<name> to S3. Returns ``(stored_name, bytes_sent)``;
+    a file already in S3 with the same size is skipped, a different object
+    under the same name gets the file stored under a new available name.
+    The uploads bypass the storage backend, so the S3 object index is
+    updated here.
+    """
+    local_path = os.path.join(settings.MEDIA_ROOT, name)
+    if not os.path.exists(local_path):
+        raise FileNotFoundError(f"Local file not found: {local_path}")
+    size = os.path.getsize(local_path)
+    bucket = settings.AWS_STORAGE_BUCKET_NAME
+
+    try:
+        head = s3_client.head_object(Bucket=bucket, Key=s3_key(name))
+        if head['ContentLength'] == size:
+            record_object(name, size, head.get('ContentType'), head.get('ETag'))
+            return name, 0
+        name = storage.get_available_name(name)
+    except ClientError as e:
+        if e.response['Error']['Code'] not in ('404', 'NoSuchKey'):
+            raise
+
+    extra_args = {**object_params(), 'ContentType': mimetypes.guess_type(name)[0] or 'application/octet-stream'}
+    # upload_file streams from disk (multipart for large files)
+    s3_client.upload_file(local_path, bucket, s3_key(name), ExtraArgs=extra_args)
+    # upload_file does not return the ETag; sync_s3_index fills it in
+    record_object(name, size, extra_args['ContentType'])
+    return name, size
+
+def migrate_image(s3_client, storage, image):
+    """
+    Upload every file of one Image; returns ``(image, changed, bytes_sent)``.
+    Runs in a worker thread, whose database connections (used to index the
+    uploads) are closed when it is done: nothing else would.
+    """
+    try:
+        changed = False
+        sent = 0
+        if image.image and image.image.name:
+            name, size = upload_file(s3_client, storage, image.image.name)
+            changed |= name != image.image.name
+            image.image.name = name
+            sent += size
+        derivatives = {}
+        for width, derivative in (image.derivatives or {}).items():
+            name, size = upload_file(s3_client, storage, derivative)
+            changed |= name != derivative
+            derivatives[width] = name
+            sent += size
+        image.derivatives = derivatives
+        return image, changed, sent
+    finally:
+        connections.close_all()
 
-def migrate_images_to_s3():
+def format_duration(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}h{minutes:02d}m{seconds:02d}s"
+
+def migrate_images_to_s3(workers=8, batch_size=500, checkpoint_path=DEFAULT_CHECKPOINT, restart=False):
     """Migrate all existing images from local storage to S3"""
     print("Starting migration of images to LocalStack S3...")
-    
-    # Get all images from database
-    images = Image.objects.all()
-    migrated_count = 0
-    
-    for image in images:
-        if image.image:
-            # Get the local file path
-            local_path = image.image.path
-            
-            if os.path.exists(local_path):
-                print(f"Migrating: {image.image.name}")
-                
-                # Read the file content
-                with open(local_path, 'rb') as f:
-                    file_content = f.read()
-                
-                # Save to S3 using Django's storage backend
-                # This will automatically use the S3 storage configured in settings
-                file_name = image.image.name
-                saved_path = default_storage.save(file_name, f)
-                
-                # Update the image field to point to the S3 location
-                image.image.name = saved_path
-                image.save()
-                
-                migrated_count += 1
-                print(f"✅ Migrated: {file_name} -> {saved_path}")
-            else:
-                print(f"❌ Local file not found: {local_path}")
-    
-    print(f"\n🎉 Migration complete! Migrated {migrated_count} images to LocalStack S3")
-    
-    # List what's in the S3 bucket
-    try:
-        s3_client = boto3.client(
-            's3',
-            endpoint_url=settings.AWS_S3_ENDPOINT_URL,
-            aws_access_key_id=settings.AWS_ACCESS_KEY_ID,
-            aws_secret_access_key=settings.AWS_SECRET_ACCESS_KEY,
-            region_name=settings.AWS_S3_REGION_NAME,
-            verify=settings.AWS_S3_VERIFY,
-            use_ssl=settings.AWS_S3_USE_SSL
-        )
-        
-        response = s3_client.list_objects_v2(Bucket=settings.AWS_STORAGE_BUCKET_NAME)
-        if 'Contents' in response:
-            print(f"\n📁 Files now in S3 bucket '{settings.AWS_STORAGE_BUCKET_NAME}':")
-            for obj in response['Contents']:
-                print(f"  - {obj['Key']} ({obj['Size']} bytes)")
-        else:
-            print(f"\n📁 S3 bucket '{settings.AWS_STORAGE_BUCKET_NAME}' is empty")
-            
-    except Exception as e:
-        print(f"❌ Could not list S3 bucket contents: {e}")
+    if not getattr(settings, 'AWS_STORAGE_BUCKET_NAME', None):
+        print("❌ S3 storage is not configured (set USE_LOCALSTACK or USE_AWS_S3)")
+        return
+
+    checkpoint = {'last_pk': 0, 'failed': []} if restart else load_checkpoint(checkpoint_path)
+    if checkpoint['last_pk'] or checkpoint['failed']:
+        print(f"⏩ Resuming after id {checkpoint['last_pk']} (retrying {len(checkpoint['failed'])} failed rows)")
+
+    images = Image.objects.filter(
+        Q(pk__gt=checkpoint['last_pk']) | Q(pk__in=checkpoint['failed'])
+    ).only('id', 'image', 'derivatives').order_by('pk')
+    total = images.count()
+    print(f"📝 {total} images to process with {workers} workers")
+
+    s3_client = get_s3_client()
+    storage = Image._meta.get_field('image').storage
+    started = time.monotonic()
+    processed = migrated = failed_count = sent_bytes = 0
+    failed = []
+    # Earlier failures stay recorded until this run gets to retry them
+    pending = set(checkpoint['failed'])
+    last_pk = checkpoint['last_pk']
+
+    def flush(batch, pool):
+        nonlocal processed, migrated, failed_count, sent_bytes, last_pk
+        futures = [(image, pool.submit(migrate_image, s3_client, storage, image)) for image in batch]
+        renamed = []
+        for image, future in futures:
+            try:
+                image, changed, sent = future.result()
+            except Exception as e:
+                print(f"❌ Image {image.pk}: {e}")
+                failed.append(image.pk)
+                failed_count += 1
+                continue
+            if changed:
+                renamed.append(image)
+            if sent:
+                migrated += 1
+            sent_bytes += sent
+        if renamed:
+            Image.objects.bulk_update(renamed, ['image', 'derivatives'])
+            invalidate_after_bulk_write(Image)
+
+        processed += len(batch)
+        pending.difference_update(image.pk for image in batch)
+        last_pk = max(last_pk, max(image.pk for image in batch))
+        save_checkpoint(checkpoint_path, {'last_pk': last_pk, 'failed': sorted(pending.union(failed))})
+
+        elapsed = time.monotonic() - started
+        rate = processed / elapsed if elapsed else 0
+        eta = (total - processed) / rate if rate else 0
+        print(f"📦 {processed}/{total} images | {rate:.1f} img/s | "
+              f"{sent_bytes / elapsed / 1024 / 1024 if elapsed else 0:.2f} MB/s | "
+              f"ETA {format_duration(eta)}")
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        batch = []
+        for image in images.iterator(chunk_size=batch_size):
+            batch.append(image)
+            if len(batch) >= batch_size:
+                flush(batch, pool)
+                batch = []
+        if batch:
+            flush(batch, pool)
+
+    elapsed = time.monotonic() - started
+    print(f"\n🎉 Migration complete in {format_duration(elapsed)}!")
+    print(f"  ✅ Uploaded: {migrated} images ({sent_bytes / 1024 / 1024:.1f} MB)")
+    print(f"  ⏭️  Already in S3: {processed - migrated - failed_count}")
+    print(f"  ❌ Failed: {failed_count}")
+    if failed:
+        print(f"  🔁 Rerun the script to retry the failed rows (checkpoint: {checkpoint_path})")
 
 if __name__ == '__main__':
-    migrate_images_to_s3()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description='Migrate local images to S3')
+    parser.add_argument('--workers', type=int, default=8, help='Concurrent uploads (default 8)')
+    parser.add_argument('--batch-size', type=int, default=500, help='Rows per batch and checkpoint (default 500)')
+    parser.add_argument('--checkpoint', default=DEFAULT_CHECKPOINT, help='Checkpoint file path')
+    parser.add_argument('--restart', action='store_true', help='Ignore the checkpoint and start over')
+    args = parser.parse_args()
+
+    migrate_images_to_s3(
+        workers=args.workers,
+        batch_size=args.batch_size,
+        checkpoint_path=args.checkpoint,
+        restart=args.restart
+    )
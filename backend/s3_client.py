@@ -0,0 +1,190 @@
+"""
+Process-wide pooled S3 client shared by views, storage backends and scripts
+(boto3 resources are not thread-safe, so each thread wraps it in its own)
+"""
+import asyncio
+import os
+import threading
+import weakref
+
+import boto3
+from botocore.config import Config
+from django.conf import settings
+
+_lock = threading.Lock()
+_client = None
+_client_pid = None
+_resource_class = None
+_local = threading.local()
+_presign_client = None
+# aiobotocore clients are bound to the event loop they were created on
+_async_clients = weakref.WeakKeyDictionary()
+
+
+def _reset_after_fork():
+    """Drop the inherited client so a forked worker never reuses parent sockets"""
+    global _lock, _client, _client_pid, _local, _presign_client, _async_clients
+    _lock = threading.Lock()
+    _client = None
+    _client_pid = None
+    _local = threading.local()
+    _presign_client = None
+    _async_clients = weakref.WeakKeyDictionary()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def get_client_config(config_class=Config):
+    """Build the botocore config (connection pool, keep-alive, timeouts) from settings"""
+    return config_class(
+        max_pool_connections=settings.AWS_S3_MAX_POOL_CONNECTIONS,
+        connect_timeout=settings.AWS_S3_CONNECT_TIMEOUT,
+        read_timeout=settings.AWS_S3_READ_TIMEOUT,
+        tcp_keepalive=settings.AWS_S3_TCP_KEEPALIVE,
+        retries={'max_attempts': settings.AWS_S3_MAX_ATTEMPTS, 'mode': 'standard'},
+    )
+
+
+def get_s3_client():
+    """
+    Return the low-level S3 client shared by every thread of this process.
+
+    botocore clients are thread-safe, so all threads share its connection
+    pool. It is created lazily and re-created after a fork, so gunicorn
+    workers forked from a preloaded master each get their own pool.
+    """
+    global _client, _client_pid, _resource_class
+    pid = os.getpid()
+    if _client is not None and _client_pid == pid:
+        return _client
+
+    with _lock:
+        if _client is None or _client_pid != pid:
+            session = boto3.session.Session()
+            resource = session.resource(
+                's3',
+                endpoint_url=getattr(settings, 'AWS_S3_ENDPOINT_URL', None),
+                aws_access_key_id=settings.AWS_ACCESS_KEY_ID,
+                aws_secret_access_key=settings.AWS_SECRET_ACCESS_KEY,
+                region_name=settings.AWS_S3_REGION_NAME,
+                verify=settings.AWS_S3_VERIFY,
+                use_ssl=settings.AWS_S3_USE_SSL,
+                config=get_client_config(),
+            )
+            from api import metrics, profiling
+            metrics.instrument_s3_client(resource.meta.client)
+            profiling.instrument_s3_client(resource.meta.client)
+            _resource_class = type(resource)
+            _client = resource.meta.client
+            _client_pid = pid
+    return _client
+
+
+def get_s3_resource():
+    """
+    Return the S3 resource of the calling thread.
+
+    boto3 resources are not thread-safe, so each thread gets its own, but
+    they all wrap the shared client and use its connection pool.
+    """
+    client = get_s3_client()
+    resource = getattr(_local, 'resource', None)
+    if resource is None or resource.meta.client is not client:
+        resource = _resource_class(client=client)
+        _local.resource = resource
+        _local.buckets = {}
+    return resource
+
+
+def get_s3_bucket(bucket_name):
+    """Return the calling thread's ``Bucket`` resource for ``bucket_name``"""
+    resource = get_s3_resource()
+    bucket = _local.buckets.get(bucket_name)
+    if bucket is None:
+        bucket = _local.buckets[bucket_name] = resource.Bucket(bucket_name)
+    return bucket
+
+
+async def get_async_s3_client():
+    """
+    Return the non-blocking (aiobotocore) S3 client for the running event loop.
+
+    The client is entered once and kept open for the life of the loop, so
+    its aiohttp connection pool is reused by every request the worker
+    serves. aiobotocore is only imported here, keeping it optional for the
+    sync deployment.
+    """
+    loop = asyncio.get_running_loop()
+    client = _async_clients.get(loop)
+    if client is None:
+        from aiobotocore.config import AioConfig
+        from aiobotocore.session import get_session
+
+        client = await get_session().create_client(
+            's3',
+            endpoint_url=getattr(settings, 'AWS_S3_ENDPOINT_URL', None),
+            aws_access_key_id=settings.AWS_ACCESS_KEY_ID,
+            aws_secret_access_key=settings.AWS_SECRET_ACCESS_KEY,
+            region_name=settings.AWS_S3_REGION_NAME,
+            verify=settings.AWS_S3_VERIFY,
+            use_ssl=settings.AWS_S3_USE_SSL,
+            config=get_client_config(AioConfig),
+        ).__aenter__()
+        from api import metrics, profiling
+        metrics.instrument_s3_client(client)
+        profiling.instrument_s3_client(client)
+        # Another request may have raced us to create the client
+        existing = _async_clients.setdefault(loop, client)
+        if existing is not client:
+            await client.close()
+            client = existing
+    return client
+
+
+def get_presign_client():
+    """
+    Return the client used to sign URLs handed to browsers.
+
+    When AWS_S3_PUBLIC_ENDPOINT_URL differs from the endpoint the backend
+    talks to (e.g. LocalStack reachable as ``localstack:4566`` inside
+    Docker but ``localhost:4566`` from the browser), a second client bound
+    to the public endpoint is created once; signing itself never opens a
+    connection.
+    """
+    global _presign_client
+    public_endpoint = getattr(settings, 'AWS_S3_PUBLIC_ENDPOINT_URL', None)
+    if not public_endpoint or public_endpoint == getattr(settings, 'AWS_S3_ENDPOINT_URL', None):
+        return get_s3_client()
+
+    if _presign_client is None:
+        with _lock:
+            if _presign_client is None:
+                _presign_client = boto3.session.Session().client(
+                    's3',
+                    endpoint_url=public_endpoint,
+                    aws_access_key_id=settings.AWS_ACCESS_KEY_ID,
+                    aws_secret_access_key=settings.AWS_SECRET_ACCESS_KEY,
+                    region_name=settings.AWS_S3_REGION_NAME,
+                    config=Config(signature_version='s3v4'),
+                )
+    return _presign_client
+
+
+def object_params():
+    """
+    Parameters for objects written outside the storage backend (put_object,
+    create_multipart_upload, upload_file ExtraArgs): AWS_S3_OBJECT_PARAMETERS
+    plus AWS_DEFAULT_ACL, as django-storages applies them
+    """
+    params = dict(getattr(settings, 'AWS_S3_OBJECT_PARAMETERS', None) or {})
+    if getattr(settings, 'AWS_DEFAULT_ACL', None):
+        params['ACL'] = settings.AWS_DEFAULT_ACL
+    return params
+
+
+def s3_key(name):
+    """Map a storage-relative file name (``Image.image.name``) to its bucket key"""
+    location = (getattr(settings, 'AWS_LOCATION', '') or '').strip('/')
+    return f'{location}/{name}' if location else name
@@ -1,7 +1,71 @@
+import mimetypes
+
 from storages.backends.s3boto3 import S3Boto3Storage
 from django.conf import settings
+from s3_client import get_s3_bucket, get_s3_client, get_s3_resource, s3_key
+from api.delivery import presigned_delivery_enabled, presigned_image_url
+
+class ObjectIndexMixin:
+    """Keep the api_s3object index in step with writes and deletes"""
+    def save(self, name, content, max_length=None):
+        from api.object_index import record_object
+        name = super().save(name, content, max_length=max_length)
+        content_type = getattr(content, 'content_type', None) or mimetypes.guess_type(name)[0]
+        record_object(name, content.size, content_type)
+        return name
+
+    def delete(self, name):
+        from api.object_index import forget_object
+        super().delete(name)
+        forget_object(name)
+
+class StreamedUploadMixin:
+    """
+    Accept files the S3MultipartUploadHandler already streamed into the
+    bucket: keep the object when it is already at the target name, or copy
+    it server-side, instead of uploading the bytes a second time (e.g. to
+    a name shortened to ``max_length``)
+    """
+    def save(self, name, content, max_length=None):
+        staged_name = getattr(content, 'staged_name', None)
+        if staged_name is not None and name == staged_name and (max_length is None or len(name) <= max_length):
+            content.committed = True
+            return name
+        return super().save(name, content, max_length=max_length)
+
+    def _save(self, name, content):
+        staged_name = getattr(content, 'staged_name', None)
+        if staged_name is None:
+            return super()._save(name, content)
+        s3_client = get_s3_client()
+        extra_args = {'MetadataDirective': 'COPY'}
+        if self.default_acl:
+            extra_args['ACL'] = self.default_acl
+        s3_client.copy(
+            {'Bucket': self.bucket_name, 'Key': s3_key(staged_name)},
+            self.bucket_name,
+            s3_key(name),
+            ExtraArgs=extra_args
+        )
+        s3_client.delete_object(Bucket=self.bucket_name, Key=s3_key(staged_name))
+        content.committed = True
+        return name
+
+class SharedClientMixin:
+    """
+    Use this thread's S3 resource and Bucket, on the process-wide pooled
+    client. The storage instance is shared by every thread, so neither may
+    be cached on it (S3Boto3Storage keeps the Bucket in ``self._bucket``).
+    """
+    @property
+    def connection(self):
+        return get_s3_resource()
+
+    @property
+    def bucket(self):
+        return get_s3_bucket(self.bucket_name)
 
-class LocalStackS3Storage(S3Boto3Storage):
+class LocalStackS3Storage(SharedClientMixin, ObjectIndexMixin, StreamedUploadMixin, S3Boto3Storage):
     """
     Custom S3 storage backend for LocalStack (Development)
     """
@@ -29,11 +93,13 @@ class LocalStackS3Storage(S3Boto3Storage):
             raise
     
     def url(self, name):
-        """Override URL to return our proxy URL for LocalStack"""
+        """Override URL to return our proxy URL (or a presigned URL) for LocalStack"""
+        if presigned_delivery_enabled():
+            return presigned_image_url(name)
         # Return the proxy URL instead of direct S3 URL
         return f"/api/s3-image/{name}"
 
-class AWSS3Storage(S3Boto3Storage):
+class AWSS3Storage(SharedClientMixin, ObjectIndexMixin, StreamedUploadMixin, S3Boto3Storage):
     """
     Custom S3 storage backend for AWS S3 (Production)
     """
@@ -65,7 +131,9 @@ class AWSS3Storage(S3Boto3Storage):
             raise
     
     def url(self, name):
-        """Return direct AWS S3 URL or proxy URL based on configuration"""
+        """Return direct AWS S3 URL, presigned URL or proxy URL based on configuration"""
+        if presigned_delivery_enabled():
+            return presigned_image_url(name)
         if hasattr(settings, 'USE_S3_PROXY') and settings.USE_S3_PROXY:
             # Use proxy URL for additional security/control
             return f"/api/s3-image/{name}"
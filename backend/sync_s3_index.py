@@ -0,0 +1,39 @@
+#!/usr/bin/env python
+"""
+Utility script to rebuild the S3 object index (api_s3object) from a full
+bucket listing
+
+The storage backends keep the index up to date incrementally; run this
+periodically (or after writing to the bucket outside the app) to repair
+drift. Objects missing from the bucket are removed from the index.
+"""
+import os
+import time
+import django
+
+# Setup Django
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'backend.settings')
+django.setup()
+
+from django.conf import settings
+from django.utils import timezone
+from s3_client import s3_key
+from api.bucket_inventory import iter_bucket
+from api.object_index import sync_index
+
+def sync_s3_index():
+    """Stream the bucket listing into the index, then drop stale rows"""
+    print("🔄 Syncing the S3 object index...")
+    if not getattr(settings, 'AWS_STORAGE_BUCKET_NAME', None):
+        print("❌ S3 storage is not configured (set USE_LOCALSTACK or USE_AWS_S3)")
+        return
+
+    started = timezone.now()
+    t0 = time.monotonic()
+    # Upserted page by page as the listing streams in
+    upserted, deleted = sync_index(iter_bucket(s3_key('')), started)
+    print(f"✅ Indexed {upserted} objects, removed {deleted} stale index rows "
+          f"({time.monotonic() - t0:.1f}s total)")
+
+if __name__ == '__main__':
+    sync_s3_index()
@@ -10,7 +10,7 @@ from pathlib import Path
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'backend.settings')
 django.setup()
 
-import boto3
+from s3_client import get_s3_client
 from django.conf import settings
 from django.core.files.storage import default_storage
 from django.core.files.base import ContentFile
@@ -20,16 +20,7 @@ def test_s3_connection():
     print("Testing S3 connection...")
     
     try:
-        # Test boto3 client directly
-        s3_client = boto3.client(
-            's3',
-            endpoint_url=settings.AWS_S3_ENDPOINT_URL,
-            aws_access_key_id=settings.AWS_ACCESS_KEY_ID,
-            aws_secret_access_key=settings.AWS_SECRET_ACCESS_KEY,
-            region_name=settings.AWS_S3_REGION_NAME,
-            verify=settings.AWS_S3_VERIFY,
-            use_ssl=settings.AWS_S3_USE_SSL
-        )
+        s3_client = get_s3_client()
         
         # List buckets
         buckets = s3_client.list_buckets()
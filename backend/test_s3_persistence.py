@@ -10,7 +10,7 @@ from pathlib import Path
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'backend.settings')
 django.setup()
 
-import boto3
+from s3_client import get_s3_client
 from django.conf import settings
 from django.core.files.storage import default_storage
 from django.core.files.base import ContentFile
@@ -21,16 +21,7 @@ def test_s3_persistence():
     print("🧪 Testing S3 persistence and database-S3 link integrity...")
     
     try:
-        # Create S3 client
-        s3_client = boto3.client(
-            's3',
-            endpoint_url=settings.AWS_S3_ENDPOINT_URL,
-            aws_access_key_id=settings.AWS_ACCESS_KEY_ID,
-            aws_secret_access_key=settings.AWS_SECRET_ACCESS_KEY,
-            region_name=settings.AWS_S3_REGION_NAME,
-            verify=settings.AWS_S3_VERIFY,
-            use_ssl=settings.AWS_S3_USE_SSL
-        )
+        s3_client = get_s3_client()
         
         print(f"📡 Connected to S3 endpoint: {settings.AWS_S3_ENDPOINT_URL}")
         print(f"🪣 Using bucket: {settings.AWS_STORAGE_BUCKET_NAME}")
@@ -52,7 +43,7 @@ def test_s3_persistence():
         db_files = []
         if db_images.exists():
             for img in db_images:
-                db_files.append(img.image.name)
+                db_files.extend(img.stored_names())
                 print(f"  📝 ID:{img.id} - {img.title or 'Untitled'} -> {img.image.name}")
         else:
             print("  📭 No Image records in database")
@@ -71,7 +62,10 @@ def test_s3_persistence():
         print("\n🗂️ Checking for orphaned S3 files:")
         orphaned_files = []
         for s3_file in s3_files:
-            if s3_file not in db_files:
+            if s3_file.startswith(settings.IMAGE_TRANSFORM_PREFIX):
+                # Cached transformation variants are regenerated on demand
+                print(f"  ♻️  VARIANT: {s3_file}")
+            elif s3_file not in db_files:
                 orphaned_files.append(s3_file)
                 print(f"  🔍 ORPHANED: {s3_file} (no database record)")
             else:
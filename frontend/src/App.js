@@ -4,6 +4,17 @@ import './App.css';
 // API base URL - use environment variable or default to localhost for development
 const API_BASE_URL = process.env.REACT_APP_API_URL || 'http://localhost:8000';
 
+// Build an `srcset` attribute from the API's `{ width: url }` derivative map,
+// so the browser picks the smallest derivative that fits the grid cell.
+const buildSrcSet = (srcset) =>
+  Object.entries(srcset || {})
+    .map(([width, url]) => `${url} ${width}w`)
+    .join(', ');
+
+// Content types the backend accepts for direct-to-S3 uploads; other files
+// are posted to the API, which identifies the image itself.
+const DIRECT_UPLOAD_CONTENT_TYPES = ['image/jpeg', 'image/png', 'image/gif', 'image/webp'];
+
 // The main component of our application
 function App() {
   // `useState` is a React Hook that lets you add a state variable to your component.
@@ -20,6 +31,8 @@ function App() {
   const [selectedFile, setSelectedFile] = useState(null);
   const [imageTitle, setImageTitle] = useState('');
   const [uploadStatus, setUploadStatus] = useState('');
+  // Cursor URL of the next page of images (null when there are no more)
+  const [nextImagesUrl, setNextImagesUrl] = useState(null);
 
   // `useEffect` is a React Hook that lets you synchronize a component with an external system.
   // In this case, we use it to fetch data from our Django backend when the component first loads.
@@ -35,7 +48,8 @@ function App() {
       })
       .then(data => {
         console.log('Fetched messages:', data);
-        setMessages(data);
+        // The API pages newest-first; show the latest page oldest-first
+        setMessages([...data.results].reverse());
       })
       .catch(error => {
         console.error('Error fetching messages:', error);
@@ -51,7 +65,8 @@ function App() {
       })
       .then(data => {
         console.log('Fetched images:', data);
-        setImages(data);
+        setImages(data.results);
+        setNextImagesUrl(data.next);
       })
       .catch(error => {
         console.error('Error fetching images:', error);
@@ -87,27 +102,85 @@ function App() {
     });
   };
 
+  // Fetch the next page of images using the cursor returned by the API
+  const loadMoreImages = () => {
+    fetch(nextImagesUrl)
+      .then(response => {
+        if (!response.ok) {
+          throw new Error(`HTTP error! status: ${response.status}`);
+        }
+        return response.json();
+      })
+      .then(data => {
+        setImages([...images, ...data.results]);
+        setNextImagesUrl(data.next);
+      })
+      .catch(error => {
+        console.error('Error fetching images:', error);
+      });
+  };
+
   // Handle file selection
   const handleFileSelect = (e) => {
     setSelectedFile(e.target.files[0]);
   };
 
-  // Handle image upload
-  const handleImageUpload = (e) => {
-    e.preventDefault();
-    
-    if (!selectedFile) {
-      setUploadStatus('Please select a file first');
-      return;
+  // Upload the file straight to S3 with a presigned POST, then ask the API to
+  // record it. Resolves to `null` when direct uploads are not available or
+  // the backend refuses the file (e.g. its content type) for them.
+  const uploadDirectToS3 = (file, title) => {
+    if (!DIRECT_UPLOAD_CONTENT_TYPES.includes(file.type)) {
+      return Promise.resolve(null);
     }
+    return fetch(`${API_BASE_URL}/api/images/upload-url/`, {
+      method: 'POST',
+      headers: {
+        'Content-Type': 'application/json'
+      },
+      body: JSON.stringify({ filename: file.name, content_type: file.type })
+    })
+    .then(response => {
+      if (response.status === 404 || response.status === 400) {
+        return null;
+      }
+      if (!response.ok) {
+        throw new Error('Upload failed');
+      }
+      return response.json().then(policy => {
+        const s3Form = new FormData();
+        Object.entries(policy.fields).forEach(([name, value]) => s3Form.append(name, value));
+        // The file must be the last field of an S3 POST upload
+        s3Form.append('file', file);
+        return fetch(policy.url, { method: 'POST', body: s3Form })
+          .then(s3Response => {
+            if (!s3Response.ok) {
+              throw new Error('Upload failed');
+            }
+            return fetch(`${API_BASE_URL}/api/images/complete-upload/`, {
+              method: 'POST',
+              headers: {
+                'Content-Type': 'application/json'
+              },
+              body: JSON.stringify({ upload_token: policy.upload_token, title })
+            });
+          })
+          .then(completeResponse => {
+            if (!completeResponse.ok) {
+              throw new Error('Upload failed');
+            }
+            return completeResponse.json();
+          });
+      });
+    });
+  };
 
+  // Upload the file through the Django API as multipart form data
+  const uploadThroughApi = (file, title) => {
     const formData = new FormData();
-    formData.append('image', selectedFile);
-    formData.append('title', imageTitle);
-
-    setUploadStatus('Uploading...');
+    formData.append('image', file);
+    formData.append('title', title);
 
-    fetch(`${API_BASE_URL}/api/images/`, {
+    return fetch(`${API_BASE_URL}/api/images/`, {
       method: 'POST',
       body: formData
     })
@@ -116,7 +189,24 @@ function App() {
         throw new Error('Upload failed');
       }
       return response.json();
-    })
+    });
+  };
+
+  // Handle image upload
+  const handleImageUpload = (e) => {
+    e.preventDefault();
+    
+    if (!selectedFile) {
+      setUploadStatus('Please select a file first');
+      return;
+    }
+
+    setUploadStatus('Uploading...');
+
+    // Prefer a direct upload to S3; fall back to posting the file to Django
+    // when the backend has no S3 storage configured or refuses the file type.
+    uploadDirectToS3(selectedFile, imageTitle)
+    .then(data => data || uploadThroughApi(selectedFile, imageTitle))
     .then(data => {
       setImages([data, ...images]);
       setSelectedFile(null);
@@ -193,6 +283,9 @@ function App() {
               <div key={image.id} className="image-item">
                 <img
                   src={image.image_url}
+                  srcSet={buildSrcSet(image.srcset) || undefined}
+                  sizes="(max-width: 768px) 50vw, 300px"
+                  loading="lazy"
                   alt={image.title || 'Uploaded image'}
                   onError={(e) => {
                     console.error('Image failed to load:', image.image_url);
@@ -208,6 +301,9 @@ function App() {
               </div>
             ))}
           </div>
+          {nextImagesUrl && (
+            <button type="button" onClick={loadMoreImages}>Load more</button>
+          )}
         </div>
       </div>
     </div>
@@ -10,6 +10,17 @@ import sys
 
 API_BASE = "http://localhost:8000/api"
 
+def all_results(response):
+    """Collect the items of a paginated list response, following its 'next' links"""
+    page = response.json()
+    items = list(page['results'])
+    while page['next']:
+        next_response = requests.get(page['next'])
+        next_response.raise_for_status()
+        page = next_response.json()
+        items.extend(page['results'])
+    return items
+
 def test_messages():
     """Test the messages API"""
     print("🧪 Testing Messages API...")
@@ -19,7 +30,7 @@ def test_messages():
         response = requests.get(f"{API_BASE}/messages/")
         if response.status_code == 200:
             print("✅ GET /api/messages/ - Success")
-            messages = response.json()
+            messages = all_results(response)
             print(f"   Found {len(messages)} messages")
         else:
             print(f"❌ GET /api/messages/ - Failed ({response.status_code})")
@@ -57,7 +68,7 @@ def test_images():
         response = requests.get(f"{API_BASE}/images/")
         if response.status_code == 200:
             print("✅ GET /api/images/ - Success")
-            images = response.json()
+            images = all_results(response)
             print(f"   Found {len(images)} images")
             for img in images[:3]:  # Show first 3 images
                 print(f"   - {img.get('title', 'Untitled')}: {img.get('image_url', 'No URL')}")